@@ -11,24 +11,77 @@ from pathlib import Path
 import re
 import shutil
 import sys
+import tempfile
 import traceback
 
 from pywifes import pywifes
-from pywifes.data_classifier import classify, cube_matcher
+from pywifes.data_classifier import (
+    HeaderCatalogue, build_header_index, classify, cube_matcher, get_header_overrides
+)
+from pywifes.calib_library import CalibLibrary, LIBRARY_STEPS, get_calib_config, library_step_id
 from pywifes.extract_spec import detect_extract_and_save, plot_1D_spectrum
+from pywifes.master_store import MasterStore, master_step_keys
 from pywifes.quality_plots import flatfield_plot
+from pywifes.session_store import DATASET_RE, SessionStore
 from pywifes.splice import splice_spectra, splice_cubes
+from pywifes.step_scheduler import run_step_graph
 from pywifes.wifes_utils import (
     is_halfframe, is_nodshuffle, is_subnodshuffle, is_taros,
-    copy_files, get_file_names, load_config_file, move_files
+    copy_files, get_file_names, link_files, load_config_file, move_files, unpack_files
 )
 import pywifes.recipes as recipes
 
 
 def run_arm_indiv(temp_data_dir, obs_metadatas, arm, master_dir, output_master_dir,
                   output_dir, params_path, grism_key, just_calib, plot_dir,
-                  from_master, extra_skip_steps, return_dict, skip_done):
+                  from_master, extra_skip_steps, return_dict, skip_done,
+                  scratch_dir=None, checkpoints=None, parallel_steps=None,
+                  header_overrides=None, master_store=None, calib_library=None,
+                  var_dtype="float64", session_store=None, write_behind=0):
     # Reduces the data for an individual arm.
+    # If scratch_dir is set, the per-step intermediate frames are chained through a
+    # private directory there (e.g. in /dev/shm), and only the outputs of the steps
+    # listed in checkpoints (plus any non-frame products) are written to output_dir.
+    # If parallel_steps is set, the steps are run as a dependency graph across the
+    # observations, with up to parallel_steps recipes at once (-1 for all cores).
+    # header_overrides holds the header corrections recorded by the classifier for the
+    # raw frames, applied when they are first processed.
+    # If master_store is set, master calibration steps take their products from the
+    # store at that path when their provenance key matches, and add them otherwise.
+    # If calib_library is set, master calibrations that cannot be built from this
+    # night's frames are taken from the nearest epoch in the library at that path,
+    # and those that are built are added to it.
+    # var_dtype is the data type of the VAR extensions of the intermediate MEF files.
+    # If session_store is set ('uncompressed' or 'compressed', with scratch_dir), the
+    # checkpoint frames are archived in one container per frame instead of one file
+    # per step. The containers are not read back by the pipeline.
+    # write_behind is the number of output writes a recipe may leave running in the
+    # background while it goes on to the next frame (0 to write synchronously).
+    persist_dir_arm = None
+    frame_suffixes = []
+    sessions = None
+    packed_suffixes = []
+
+    def release_frames(suffix):
+        # The scratch frames of a non-checkpoint step are removed as soon as every
+        # step reading them has finished
+        if persist_dir_arm is not None and suffix in frame_suffixes:
+            for fn in get_file_names(gargs['out_dir_arm'], f"*.[ps]{suffix}.fits"):
+                os.remove(os.path.join(gargs['out_dir_arm'], fn))
+
+    def write_checkpoint(suffix):
+        # The frames of a checkpoint step are written through to disk (or to the
+        # session store) as soon as the step has finished
+        if sessions is not None:
+            sessions.pack(gargs['out_dir_arm'], suffixes=[suffix], remove=False)
+            packed_suffixes.append(suffix)
+        else:
+            copy_files(gargs['out_dir_arm'], persist_dir_arm,
+                       get_file_names(gargs['out_dir_arm'], f"*.[ps]{suffix}.fits"))
+
+    def step_finished(step):
+        if persist_dir_arm is not None and step["suffix"] is not None and step["step"] in checkpoints:
+            write_checkpoint(step["suffix"])
 
     try:
         # ------------------------------------------------------------------------
@@ -44,6 +97,7 @@ def run_arm_indiv(temp_data_dir, obs_metadatas, arm, master_dir, output_master_d
         gargs['from_master'] = from_master
         gargs['output_master_dir'] = output_master_dir
         gargs['output_dir'] = output_dir
+        gargs['header_overrides'] = header_overrides if header_overrides is not None else {}
 
         # Determine the grism and observing mode used in the first image of science,
         # standard, or arc of the respective arm.
@@ -59,6 +113,9 @@ def run_arm_indiv(temp_data_dir, obs_metadatas, arm, master_dir, output_master_d
             print("No science, standard, or arc files found in metadata.")
             raise ValueError("No science, standard, or arc files found in metadata.")
 
+        # Decompress the reference image if it was staged in compressed form
+        unpack_files(temp_data_dir, [reference_filename.replace(".fits", "")])
+
         # Check if reference image was taken with TAROS
         taros = is_taros(temp_data_dir + reference_filename)
         gargs['taros'] = taros
@@ -72,7 +129,8 @@ def run_arm_indiv(temp_data_dir, obs_metadatas, arm, master_dir, output_master_d
                                                        to_taros=taros)
 
         # Grism
-        grism = pyfits.getheader(temp_data_dir + reference_filename)[grism_key[arm]]
+        reference_header = pyfits.getheader(temp_data_dir + reference_filename)
+        grism = reference_header[grism_key[arm]]
 
         # Set the JSON file path and read it.
         if params_path[arm] is None:
@@ -98,6 +156,14 @@ def run_arm_indiv(temp_data_dir, obs_metadatas, arm, master_dir, output_master_d
         # Create data products directory structure
         gargs['out_dir_arm'] = os.path.join(output_dir, f"intermediate/{arm}")
         os.makedirs(gargs['out_dir_arm'], exist_ok=True)
+        if scratch_dir is not None:
+            scratch_dir_arm = tempfile.mkdtemp(prefix=f"pywifes_{arm}_", dir=scratch_dir)
+            persist_dir_arm = gargs['out_dir_arm']
+            gargs['out_dir_arm'] = scratch_dir_arm
+            if checkpoints is None:
+                checkpoints = []
+        if session_store is not None:
+            sessions = SessionStore(persist_dir_arm, compress=(session_store == "compressed"))
 
         calib_prefix = f"wifes_{arm}"
 
@@ -107,6 +173,12 @@ def run_arm_indiv(temp_data_dir, obs_metadatas, arm, master_dir, output_master_d
         # SET SKIP ALREADY DONE FILES ?
         gargs['skip_done'] = skip_done
 
+        # Precision of the variance in the intermediate files
+        gargs['var_dtype'] = var_dtype
+
+        # Number of output writes each recipe may leave running in the background
+        gargs['write_behind'] = write_behind
+
         # Creates a directory for diagnisis plots (one per arm).
         gargs['plot_dir_arm'] = os.path.join(plot_dir, arm)
         os.makedirs(gargs['plot_dir_arm'], exist_ok=True)
@@ -141,6 +213,7 @@ def run_arm_indiv(temp_data_dir, obs_metadatas, arm, master_dir, output_master_d
         # Slitlet definition
         gargs['slitlet_def_fn'] = os.path.join(master_dir, f"{calib_prefix}_slitlet_defs.pkl")
         gargs['wsol_out_fn'] = os.path.join(master_dir, f"{calib_prefix}_wave_soln.fits")
+        gargs['wsol_extra_fn'] = gargs['wsol_out_fn'] + "_extra.pkl"
         gargs['wire_out_fn'] = os.path.join(master_dir, f"{calib_prefix}_wire_soln.fits")
         gargs['flat_resp_fn'] = os.path.join(master_dir, f"{calib_prefix}_resp_mef.fits")
         gargs['calib_fn'] = os.path.join(master_dir, f"{calib_prefix}_calib.pkl")
@@ -154,9 +227,39 @@ def run_arm_indiv(temp_data_dir, obs_metadatas, arm, master_dir, output_master_d
             if os.path.exists(gargs['tellcorr_fn']):
                 extra_skip_steps.append("derive_telluric")
 
+        # Fill in master calibrations for any missing calibration frames from the
+        # library, skipping the steps that would build them.
+        library_skip_steps = []
+        library_entry = None
+        gargs['wsol_warm_start'] = None
+        if calib_library is not None and not from_master:
+            library = CalibLibrary(calib_library)
+            calib_config = get_calib_config(reference_header, arm, grism_key, halfframe, taros)
+            missing_types = [key for key in ["bias", "domeflat", "twiflat", "wire", "arc"]
+                             if not obs_metadata[key]]
+            if missing_types:
+                library_skip_steps, library_entry = library.fill(
+                    gargs, calib_config, reference_header["MJD-OBS"],
+                    [step for step in proc_steps[arm] if step["run"]], missing_types)
+            # Optical model wavelength solutions can start from the nearest stored one
+            wsol_entry = library.nearest(calib_config, reference_header["MJD-OBS"], ["wsol_extra_fn"])
+            if wsol_entry is not None:
+                gargs['wsol_warm_start'] = os.path.join(wsol_entry[0], wsol_entry[1]["wsol_extra_fn"])
+            library.close()
+
         # ------------------------------------------------------------------------
         # Run proccessing steps
         # ------------------------------------------------------------------------
+        store = None
+        if master_store is not None:
+            store = MasterStore(master_store)
+            run_steps = [step for step in proc_steps[arm]
+                         if step["run"] and step["step"] not in extra_skip_steps
+                         and library_step_id(step) not in library_skip_steps]
+            step_keys = dict(zip([id(step) for step in run_steps],
+                                 master_step_keys(run_steps, obs_metadata, temp_data_dir, arm,
+                                                  extra=(library_entry, var_dtype), gargs=gargs)))
+
         flog_filename = os.path.join(gargs['output_dir'], f"{arm}.log")
         print("")
         print(f"Starting processing of {arm} arm")
@@ -174,44 +277,79 @@ def run_arm_indiv(temp_data_dir, obs_metadatas, arm, master_dir, output_master_d
         # open a separate log file to direct all recipe stdout/stderr to
         with open(flog_filename, 'a') as flog:
             with contextlib.redirect_stdout(flog), contextlib.redirect_stderr(flog):
-                counter = 1
-                nsteps = len(proc_steps[arm])
-                for step in proc_steps[arm]:
-                    step_name = step["step"]
-                    step_run = step["run"]
-                    step_suffix = step["suffix"]
-                    step_args = step["args"]
-                    func_name = "run_" + step_name
-
-                    print(f"Running {arm}/{func_name} ({counter}/{nsteps})", file=old_stdout)
-                    func = getattr(recipes, func_name)
-
-                    # When master calibrations are in use, the steps listed in skip_steps
-                    # will be skipped.
-                    if step_name in extra_skip_steps:
-                        print('======================')
-                        print(f"Skipping step: {step_name}")
-                        print('======================')
-                        continue
-
-                    if step_run:
-                        print('======================')
-                        print(step_name)
-                        print('======================')
+                if parallel_steps is not None:
+                    # Build the list of steps to run, with the suffix each one reads
+                    graph_steps = []
+                    for step in proc_steps[arm]:
+                        if step["step"] in extra_skip_steps or library_step_id(step) in library_skip_steps:
+                            print('======================')
+                            print(f"Skipping step: {step['step']}")
+                            print('======================')
+                            continue
+                        if not step["run"]:
+                            continue
+                        graph_steps.append({"step": step["step"], "suffix": step["suffix"],
+                                            "prev_suffix": prev_suffix, "args": step["args"]})
+                        if store is not None and step_keys[id(step)] is not None:
+                            graph_steps[-1]["func"] = store.wrap(
+                                getattr(recipes, "run_" + step["step"]), step_keys[id(step)], step["step"])
+                        if step["suffix"] is not None:
+                            prev_suffix = step["suffix"]
+                            if persist_dir_arm is not None and step["step"] not in checkpoints:
+                                frame_suffixes.append(step["suffix"])
+                    obs_metadata = run_step_graph(recipes, graph_steps, obs_metadata, gargs,
+                                                  max_processes=parallel_steps,
+                                                  progress_file=old_stdout,
+                                                  on_consumed=release_frames,
+                                                  on_finished=step_finished)
+                else:
+                    counter = 1
+                    nsteps = len(proc_steps[arm])
+                    for step in proc_steps[arm]:
+                        step_name = step["step"]
+                        step_run = step["run"]
+                        step_suffix = step["suffix"]
+                        step_args = step["args"]
+                        func_name = "run_" + step_name
+
+                        print(f"Running {arm}/{func_name} ({counter}/{nsteps})", file=old_stdout)
+                        func = getattr(recipes, func_name)
+                        if store is not None and step_keys.get(id(step)) is not None:
+                            func = store.wrap(func, step_keys[id(step)], step_name)
+
+                        # When master calibrations are in use, the steps listed in skip_steps
+                        # will be skipped.
+                        if step_name in extra_skip_steps or library_step_id(step) in library_skip_steps:
+                            print('======================')
+                            print(f"Skipping step: {step_name}")
+                            print('======================')
+                            continue
+
+                        if step_run:
+                            print('======================')
+                            print(step_name)
+                            print('======================')
+
+                            func(
+                                obs_metadata,
+                                gargs,
+                                prev_suffix=prev_suffix,
+                                curr_suffix=step_suffix,
+                                **step_args,
+                            )
+                            if step_suffix is not None:
+                                if prev_suffix is not None:
+                                    release_frames(prev_suffix)
+                                prev_suffix = step_suffix
+                                if persist_dir_arm is not None:
+                                    if step_name in checkpoints:
+                                        write_checkpoint(step_suffix)
+                                    else:
+                                        frame_suffixes.append(step_suffix)
 
-                        func(
-                            obs_metadata,
-                            gargs,
-                            prev_suffix=prev_suffix,
-                            curr_suffix=step_suffix,
-                            **step_args,
-                        )
-                        if step_suffix is not None:
-                            prev_suffix = step_suffix
-
-                    else:
-                        pass
-                    counter = counter + 1
+                        else:
+                            pass
+                        counter = counter + 1
                 duration = datetime.datetime.now() - start_time
                 # this print goes to the log file, since we don't specify file=old_stdout
                 print(f"WiFeS {arm} arm reductions took a total of {duration.total_seconds()} seconds.")
@@ -238,6 +376,17 @@ def run_arm_indiv(temp_data_dir, obs_metadatas, arm, master_dir, output_master_d
         except Exception:
             pass
 
+        # Add the master calibrations built from this night's frames to the library
+        if calib_library is not None and not from_master:
+            library = CalibLibrary(calib_library)
+            built_keys = [key for step in proc_steps[arm]
+                          if step["run"] and library_step_id(step) in LIBRARY_STEPS
+                          and library_step_id(step) not in library_skip_steps
+                          for key in LIBRARY_STEPS[library_step_id(step)][1] + LIBRARY_STEPS[library_step_id(step)][2]]
+            library.add(gargs, calib_config, reference_header["MJD-OBS"],
+                        reference_header["DATE-OBS"][:10], built_keys)
+            library.close()
+
         print(f"Successfully completed {arm} arm\n")
 
     except Exception:
@@ -246,6 +395,27 @@ def run_arm_indiv(temp_data_dir, obs_metadatas, arm, master_dir, output_master_d
         traceback.print_exc()
         print("")
 
+    finally:
+        if persist_dir_arm is not None:
+            # keep everything except the intermediate frames of non-checkpoint steps
+            frame_re = None
+            if frame_suffixes:
+                frame_re = re.compile(r"\.[ps](%s)\.fits$" % "|".join(re.escape(sfx) for sfx in frame_suffixes))
+            if sessions is not None:
+                # store the checkpoint frames not yet written through in their containers
+                stored_suffixes = frame_suffixes + packed_suffixes
+                frame_matches = [DATASET_RE.match(fn) for fn in get_file_names(gargs['out_dir_arm'], "*.fits")]
+                sessions.pack(gargs['out_dir_arm'], suffixes=set(
+                    m.group("dataset")[1:] for m in frame_matches
+                    if m is not None and m.group("dataset")[1:] not in stored_suffixes))
+            keep_names = [fn for fn in get_file_names(gargs['out_dir_arm'], "*")
+                          if os.path.isfile(os.path.join(gargs['out_dir_arm'], fn))
+                          and (frame_re is None or not frame_re.search(fn))
+                          and (sessions is None or not DATASET_RE.match(fn))]
+            copy_files(gargs['out_dir_arm'], persist_dir_arm, keep_names)
+            shutil.rmtree(gargs['out_dir_arm'], ignore_errors=True)
+            gargs['out_dir_arm'] = persist_dir_arm
+
     return_dict.update(gargs)
 # end of run_arm_indiv
 
@@ -368,6 +538,110 @@ def main():
              "extracting the spectra.",
     )
 
+    # Option to chain intermediate frames through a scratch (e.g. RAM-backed) directory
+    parser.add_argument(
+        "--in-memory",
+        type=str,
+        const="/dev/shm",
+        nargs="?",
+        help="Optional: Keep intermediate frames in a scratch directory (default: "
+             "/dev/shm, i.e. in memory) and only write the --checkpoints steps to disk.",
+    )
+
+    # Option for specifying which steps write their frames to disk in --in-memory mode
+    parser.add_argument(
+        "--checkpoints",
+        type=str,
+        default="slitlet_mef,cube_gen",
+        help="Optional: Comma-separated list of steps whose output frames are written "
+             "to disk when using --in-memory. Default: 'slitlet_mef,cube_gen'.",
+    )
+
+    # Option to keep the per-frame intermediate files in one container per frame
+    parser.add_argument(
+        "--session-store",
+        type=str,
+        const="uncompressed",
+        nargs="?",
+        choices=["uncompressed", "compressed"],
+        help="Optional: With --in-memory, archive the checkpoint frames in one FITS "
+             "container per frame ('<frame>.session.fits') instead of one file per step, "
+             "optionally with lossless compression ('compressed'). Default: 'uncompressed' "
+             "when given.",
+    )
+
+    # Option to overlap the writing of each frame with the processing of the next
+    parser.add_argument(
+        "--write-behind",
+        type=int,
+        const=2,
+        nargs="?",
+        default=0,
+        help="Optional: Let each step write up to N output frames in the background "
+             "while it processes the next frames (default N: 2). All writes finish "
+             "before the next step starts. Default: 0 (write synchronously).",
+    )
+
+    # Option to run the steps of different observations concurrently
+    parser.add_argument(
+        "--parallel-steps",
+        type=int,
+        const=-1,
+        nargs="?",
+        help="Optional: Run the per-frame steps of different observations concurrently, "
+             "as soon as the calibrations they need are ready, with up to N recipes at once "
+             "(default: number of cores).",
+    )
+
+    # Option for how the raw data are staged for processing
+    parser.add_argument(
+        "--stage",
+        type=str,
+        choices=["copy", "symlink", "hardlink"],
+        default="copy",
+        help="Optional: How to stage the raw data in the intermediate directory: copy "
+             "(decompressing all files up front), or symlink/hardlink (decompressing "
+             "compressed files only when first needed). Default: 'copy'.",
+    )
+
+    # Option for the location of the persistent header catalogue
+    parser.add_argument(
+        "--catalogue",
+        type=str,
+        help="Optional: Path of the SQLite catalogue of raw frame headers, reused to skip "
+             "reading unchanged files on later runs. Default: "
+             "'<output_dir>/intermediate/header_catalogue.sqlite'.",
+    )
+
+    # Option for a store of master calibrations shared between reductions
+    parser.add_argument(
+        "--master-store",
+        type=str,
+        help="Optional: Directory of a store of master calibration products, keyed by "
+             "their raw input frames, processing parameters, and pipeline version. "
+             "Matching products are taken from the store instead of being rebuilt, and "
+             "new products are added to it.",
+    )
+
+    # Option for a library of master calibrations from other nights
+    parser.add_argument(
+        "--calib-library",
+        type=str,
+        help="Optional: Directory of a library of master calibrations by instrument "
+             "configuration and date. Master calibrations that cannot be built because "
+             "this night lacks the calibration frames are taken from the nearest date in "
+             "the library, and those built from this night are added to it.",
+    )
+
+    # Option to store the variance of the intermediate files in single precision
+    parser.add_argument(
+        "--float32-var",
+        action="store_true",
+        help="Optional: Store the VAR extensions of the intermediate files as float32 "
+             "instead of float64, halving their size and the data read and written by "
+             "each step. Default: False.",
+    )
+
     # Option to skip processing (and only extract or extract-and-splice)
     parser.add_argument(
         "--no-processing",
@@ -441,6 +715,31 @@ def main():
     # Skip processing and only extract or extract-and-splice
     no_processing = args.no_processing
 
+    # Share master calibrations through a store
+    master_store = os.path.abspath(args.master_store) if args.master_store else None
+
+    # Fill in missing master calibrations from a library
+    calib_library = os.path.abspath(args.calib_library) if args.calib_library else None
+
+    # Precision of the variance in the intermediate files
+    var_dtype = "float32" if args.float32_var else "float64"
+
+    # Keep the per-frame intermediate files in one container per frame
+    session_store = args.session_store
+
+    # Keep intermediate frames in a scratch directory, writing only the checkpoints
+    if args.in_memory:
+        scratch_dir = os.path.abspath(args.in_memory)
+        if not os.path.isdir(scratch_dir):
+            raise ValueError(f"No such scratch directory {scratch_dir}")
+        checkpoints = [s.strip() for s in args.checkpoints.split(",") if s.strip()]
+        print(f"Keeping intermediate frames in {scratch_dir}, writing to disk after: {checkpoints}")
+    else:
+        scratch_dir = None
+        checkpoints = None
+        if session_store is not None:
+            raise ValueError("--session-store requires --in-memory")
+
     # Creates a directory for plot.
     plot_dir = os.path.join(output_dir, "plots/")
     os.makedirs(plot_dir, exist_ok=True)
@@ -451,15 +750,34 @@ def main():
         os.makedirs(temp_data_dir, exist_ok=True)
 
         all_fits_names = get_file_names(user_data_dir, "*.fits*")
-        # Copy raw data from user's direcory into temporaty raw directory.
-        copy_files(user_data_dir, temp_data_dir, all_fits_names)
+        # Copy (or link) raw data from user's direcory into temporaty raw directory.
+        # Copies are made on all cores in the background while the data are classified.
+        wait_for_copies = None
+        if args.stage == "copy":
+            wait_for_copies = copy_files(user_data_dir, temp_data_dir, all_fits_names,
+                                         max_processes=-1, wait=False)
+        else:
+            link_files(user_data_dir, temp_data_dir, all_fits_names,
+                       hardlink=(args.stage == "hardlink"))
 
-        # Classify all raw data (red and blue arm)
+        # Classify all raw data (red and blue arm), reading only the headers of new or
+        # changed files in the user's directory
         mode_save_fn = os.path.join(output_dir, "coadd_mode.json5")
+        if args.catalogue:
+            catalogue_path = os.path.abspath(args.catalogue)
+        else:
+            catalogue_path = os.path.join(output_dir, "intermediate/header_catalogue.sqlite")
+        catalogue = HeaderCatalogue(catalogue_path)
+        header_index = build_header_index(user_data_dir, sorted(all_fits_names), catalogue=catalogue)
+        catalogue.close()
         obs_metadatas = classify(temp_data_dir,
                                  greedy_stds=args.greedy_stds,
                                  coadd_mode=args.coadd_mode,
-                                 mode_save_fn=mode_save_fn)
+                                 mode_save_fn=mode_save_fn,
+                                 header_index=header_index)
+        header_overrides = get_header_overrides(header_index)
+        if wait_for_copies is not None:
+            wait_for_copies()
 
         # Set grism_key dictionary due to different keyword names for red and blue arms.
         grism_key = {
@@ -501,7 +819,7 @@ def main():
         if args.run_both:
             # Try and reduce both arms at the same time
             for arm in obs_metadatas.keys():
-                p = multiprocessing.Process(target=run_arm_indiv, args=(temp_data_dir, obs_metadatas, arm, master_dir, output_master_dir, output_dir, params_path, grism_key, just_calib, plot_dir, from_master, extra_skip_steps, return_dict, skip_done))
+                p = multiprocessing.Process(target=run_arm_indiv, args=(temp_data_dir, obs_metadatas, arm, master_dir, output_master_dir, output_dir, params_path, grism_key, just_calib, plot_dir, from_master, extra_skip_steps, return_dict, skip_done, scratch_dir, checkpoints, args.parallel_steps, header_overrides, master_store, calib_library, var_dtype, session_store, args.write_behind))
                 jobs.append(p)
                 p.start()
 
@@ -510,7 +828,7 @@ def main():
         else:
             # Otherwise reduce them sequentially
             for arm in obs_metadatas.keys():
-                p = multiprocessing.Process(target=run_arm_indiv, args=(temp_data_dir, obs_metadatas, arm, master_dir, output_master_dir, output_dir, params_path, grism_key, just_calib, plot_dir, from_master, extra_skip_steps, return_dict, skip_done))
+                p = multiprocessing.Process(target=run_arm_indiv, args=(temp_data_dir, obs_metadatas, arm, master_dir, output_master_dir, output_dir, params_path, grism_key, just_calib, plot_dir, from_master, extra_skip_steps, return_dict, skip_done, scratch_dir, checkpoints, args.parallel_steps, header_overrides, master_store, calib_library, var_dtype, session_store, args.write_behind))
                 jobs.append(p)
                 p.start()
 
@@ -1,6 +1,6 @@
 """Python package for optical data reduction pipeline."""
 
-from . import data_classifier, js_wifes_adr, lacosmic, \
-    mpfit, multiprocessing_utils, optical_model, \
-    pywifes, quality_plots, wifes_adr, wifes_calib, wifes_ephemeris, \
+from . import calib_library, data_classifier, js_wifes_adr, lacosmic, \
+    master_store, mpfit, multiprocessing_utils, optical_model, \
+    pywifes, quality_plots, session_store, step_scheduler, wifes_adr, wifes_calib, wifes_ephemeris, \
     wifes_imtrans, wifes_metadata, wifes_utils, wifes_wsol
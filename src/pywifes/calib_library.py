@@ -0,0 +1,227 @@
+import os
+import pyjson5
+import shutil
+import sqlite3
+
+
+# Master calibration steps that can be filled from the library when a night lacks
+# the raw calibration frames they are built from: (raw frame type, [required products],
+# [optional products]), with products given by their keys in the global arguments.
+# Steps taking a 'source' argument are listed as '<step>_<source>'.
+LIBRARY_STEPS = {
+    "superbias": ("bias", ["superbias_fn", "superbias_fit_fn"], []),
+    "superflat_dome": ("domeflat", ["super_dflat_raw"], []),
+    "superflat_twi": ("twiflat", ["super_tflat_raw"], []),
+    "superflat_wire": ("wire", ["super_wire_raw"], []),
+    "superflat_arc": ("arc", ["super_arc_raw"], []),
+    "slitlet_profile": ("domeflat", ["slitlet_def_fn"], []),
+    "flat_cleanup": ("domeflat", ["super_dflat_fn"], ["super_tflat_fn"]),
+    "superflat_mef_dome": ("domeflat", ["super_dflat_mef"], []),
+    "superflat_mef_twi": ("twiflat", ["super_tflat_mef"], []),
+    "superflat_mef_wire": ("wire", ["super_wire_mef"], []),
+    "superflat_mef_arc": ("arc", ["super_arc_mef"], []),
+    "wave_soln": ("arc", ["wsol_out_fn"], ["wsol_extra_fn"]),
+    "wire_soln": ("wire", ["wire_out_fn"], []),
+    "flat_response": ("domeflat", ["flat_resp_fn"], ["smooth_shape_fn"]),
+}
+
+# Instrument configuration that library entries must match
+CONFIG_KEYS = ["arm", "grating", "beamsplitter", "binning", "halfframe", "taros"]
+
+
+def library_step_id(step):
+    """
+    Name of a processing step in `LIBRARY_STEPS`, including any 'source' argument.
+    """
+    if "source" in step["args"]:
+        return f"{step['step']}_{step['args']['source']}"
+    return step["step"]
+
+
+def get_calib_config(header, arm, grism_key, halfframe, taros):
+    """
+    Instrument configuration of a raw frame, for matching library entries.
+
+    Parameters
+    ----------
+    header : astropy.io.fits.Header
+        Header of the reference frame.
+    arm : str
+        The arm being reduced.
+    grism_key : dict
+        The grating keyword of each arm.
+    halfframe : bool
+        Whether the data are half-frame.
+    taros : bool
+        Whether the data were taken with TAROS.
+
+    Returns
+    -------
+    dict
+        The values of `CONFIG_KEYS`.
+    """
+    return {
+        "arm": arm,
+        "grating": header[grism_key[arm]],
+        "beamsplitter": header["BEAMSPLT"],
+        "binning": header["CCDSUM"],
+        "halfframe": int(halfframe),
+        "taros": int(taros),
+    }
+
+
+class CalibLibrary:
+    """
+    Library of master calibration sets from past nights, stored in a directory tree
+    by arm, instrument configuration and date, with an SQLite index.
+
+    Parameters
+    ----------
+    root_dir : str
+        Root directory of the library, created if it does not exist.
+    """
+
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+        os.makedirs(root_dir, exist_ok=True)
+        self.conn = sqlite3.connect(os.path.join(root_dir, "index.sqlite"))
+        col_defs = ", ".join(CONFIG_KEYS)
+        self.conn.execute(
+            f"CREATE TABLE IF NOT EXISTS masters ({col_defs}, mjd REAL, path TEXT PRIMARY KEY, products TEXT)"
+        )
+        self.conn.execute(
+            f"CREATE INDEX IF NOT EXISTS masters_config ON masters ({col_defs}, mjd)"
+        )
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def add(self, gargs, config, mjd, date, product_keys):
+        """
+        Copy a set of master calibrations into the library, adding to (or replacing
+        products of) any earlier entry for the same configuration and date.
+
+        Parameters
+        ----------
+        gargs : dict
+            Global arguments, giving the paths of the master calibration files.
+        config : dict
+            Instrument configuration, from `get_calib_config`.
+        mjd : float
+            MJD of the observations.
+        date : str
+            Date of the observations (YYYY-MM-DD), naming the entry directory.
+        product_keys : list of str
+            Keys of the products in `gargs` to add, where they exist.
+
+        Returns
+        -------
+        None
+        """
+        product_keys = [key for key in product_keys if os.path.isfile(gargs[key])]
+        if not product_keys:
+            return
+        config_dir = "_".join(str(config[key]).replace(" ", "x") for key in CONFIG_KEYS[1:])
+        entry_dir = os.path.join(self.root_dir, config["arm"], config_dir, date)
+        os.makedirs(entry_dir, exist_ok=True)
+        path = os.path.relpath(entry_dir, self.root_dir)
+        existing = self.conn.execute("SELECT products FROM masters WHERE path = ?", (path,)).fetchone()
+        products = {} if existing is None else pyjson5.loads(existing[0])
+        for key in product_keys:
+            fn = os.path.basename(gargs[key])
+            shutil.copy2(gargs[key], os.path.join(entry_dir, fn))
+            products[key] = fn
+        self.conn.execute(
+            f"INSERT OR REPLACE INTO masters VALUES ({', '.join(['?'] * (len(CONFIG_KEYS) + 3))})",
+            [config[key] for key in CONFIG_KEYS]
+            + [mjd, path, pyjson5.dumps(products)],
+        )
+        self.conn.commit()
+        print(f"Added {len(product_keys)} master calibrations to library entry {entry_dir}")
+
+    def nearest(self, config, mjd, product_keys, max_days=None):
+        """
+        Find the entry closest in time with the given configuration and products.
+
+        Parameters
+        ----------
+        config : dict
+            Instrument configuration, from `get_calib_config`.
+        mjd : float
+            MJD of the observations.
+        product_keys : list of str
+            Keys of the products the entry must hold.
+        max_days : float, optional
+            Largest time difference allowed.
+            Default: None (no limit).
+
+        Returns
+        -------
+        tuple or None
+            Directory of the entry, dictionary of its product filenames, and its MJD;
+            or None if no entry qualifies.
+        """
+        where = " AND ".join(f"{key} = ?" for key in CONFIG_KEYS)
+        params = [config[key] for key in CONFIG_KEYS]
+        if max_days is not None:
+            where += " AND ABS(mjd - ?) <= ?"
+            params += [mjd, max_days]
+        results = self.conn.execute(
+            f"SELECT path, products, mjd FROM masters WHERE {where} ORDER BY ABS(mjd - ?)",
+            params + [mjd],
+        )
+        for path, products, entry_mjd in results:
+            products = pyjson5.loads(products)
+            if all(key in products for key in product_keys):
+                return os.path.join(self.root_dir, path), products, entry_mjd
+        return None
+
+    def fill(self, gargs, config, mjd, steps, missing_types, max_days=None):
+        """
+        Copy the master calibrations that cannot be built from the frames of this
+        night from the nearest suitable library entry.
+
+        Parameters
+        ----------
+        gargs : dict
+            Global arguments, giving the paths of the master calibration files.
+        config : dict
+            Instrument configuration, from `get_calib_config`.
+        mjd : float
+            MJD of the observations.
+        steps : list of dict
+            The processing steps to run.
+        missing_types : list of str
+            The raw calibration frame types missing from this night.
+        max_days : float, optional
+            Largest time difference allowed.
+            Default: None (no limit).
+
+        Returns
+        -------
+        list of str
+            Library step names (see `library_step_id`) whose products were filled,
+            and which should therefore be skipped.
+        str or None
+            Directory of the library entry used.
+        """
+        fill_steps = [library_step_id(step) for step in steps
+                      if library_step_id(step) in LIBRARY_STEPS
+                      and LIBRARY_STEPS[library_step_id(step)][0] in missing_types]
+        if not fill_steps:
+            return [], None
+        required = [key for step_id in fill_steps for key in LIBRARY_STEPS[step_id][1]]
+        optional = [key for step_id in fill_steps for key in LIBRARY_STEPS[step_id][2]]
+        # take all products from the one epoch, so that they are consistent
+        entry = self.nearest(config, mjd, required, max_days=max_days)
+        if entry is None:
+            print(f"No calibration library entry found for {config} with {required}")
+            return [], None
+        entry_dir, products, entry_mjd = entry
+        for key in required + optional:
+            if key in products:
+                shutil.copy(os.path.join(entry_dir, products[key]), gargs[key])
+        print(f"Using calibrations for missing {missing_types} from library entry {entry_dir} "
+              f"({abs(entry_mjd - mjd):.1f} days away)")
+        return fill_steps, entry_dir
@@ -4,10 +4,32 @@ import os
 import pandas as pd
 import pyjson5
 import re
+import sqlite3
 import string
 
 from pywifes import wifes_calib
-from pywifes.wifes_utils import is_taros, is_nodshuffle
+from pywifes.multiprocessing_utils import get_task, map_tasks_threaded
+from pywifes.wifes_metadata import __version__
+
+
+# Primary header keywords needed to classify the raw frames
+INDEX_KEYWORDS = [
+    "CAMERA",
+    "NAXIS2",
+    "IMAGETYP",
+    "OBJECT",
+    "GRATINGB",
+    "GRATINGR",
+    "BEAMSPLT",
+    "RA",
+    "DEC",
+    "EXPTIME",
+    "WIFESOBS",
+    "NSUBEXPS",
+    "OBSEQID",
+    "DATE-OBS",
+    "MJD-OBS",
+]
 
 
 def _column_name_generator():
@@ -19,7 +41,238 @@ def _column_name_generator():
             yield ''.join(p)
 
 
-def get_obs_metadata(filenames, data_dir, greedy_stds=False, coadd_mode="all", mode_save_fn=None, camera="blue"):
+def _read_index_row(filepath):
+    # Read only the primary header (of the image, for fpack-compressed files),
+    # returning None for anything that is not FITS.
+    try:
+        header = pyfits.getheader(filepath, ext=1 if re.search("\\.fz$", filepath) else 0)
+    except Exception:
+        return None
+    row = {key: header.get(key, None) for key in INDEX_KEYWORDS}
+    # Fix TAROS Nod-and-Shuffle exposure times, recorded rather than written to the file
+    row["OVERRIDES"] = None
+    if row["OBSEQID"] is not None and row["WIFESOBS"] == "NodAndShuffle" \
+            and row["NSUBEXPS"] is not None and row["EXPTIME"] is not None:
+        total_exptime = row["NSUBEXPS"] * row["EXPTIME"]
+        row["OVERRIDES"] = {"EXPTIME": total_exptime, "SEXPTIME": total_exptime}
+    return row
+
+
+def _to_sql_value(value):
+    # SQLite only takes scalars: keywords without a value (astropy's Undefined) are
+    # stored as NULL, and any other non-scalar value as its string representation
+    if value is None or isinstance(value, pyfits.card.Undefined):
+        return None
+    if isinstance(value, (bool, int, float, str)):
+        return value
+    return str(value)
+
+
+class HeaderCatalogue:
+    """
+    On-disk (SQLite) catalogue of the header index rows of FITS files, keyed by the
+    absolute path, size and modification time of each file, so that files are only
+    read again when they are new or have changed. A catalogue written by another
+    PyWiFeS version or catalogue revision is emptied on opening, as its rows may
+    hold outdated header overrides.
+
+    Parameters
+    ----------
+    db_path : str
+        Path of the SQLite database file, created if it does not exist.
+
+    Examples
+    --------
+    All B3000 arcs within 2 days of MJD 60500.5, without opening any FITS file:
+
+    >>> catalogue = HeaderCatalogue("header_catalogue.sqlite")
+    >>> catalogue.query(mjd=60500.5, within_days=2., IMAGETYP="ARC", GRATINGB="B3000")
+    """
+
+    columns = INDEX_KEYWORDS + ["OVERRIDES"]
+    # Bump when the indexed values or the header overrides change between releases
+    revision = 1
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path)
+        col_defs = ", ".join(f'"{col}"' for col in self.columns)
+        version = f"{__version__}/{self.revision}"
+        self.conn.execute("CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value TEXT)")
+        stored = self.conn.execute("SELECT value FROM info WHERE key = 'version'").fetchone()
+        existing = [info[1] for info in self.conn.execute("PRAGMA table_info(headers)")]
+        if existing and (existing != ["path", "size", "mtime"] + self.columns
+                         or stored is None or stored[0] != version):
+            # catalogue written with a different set of keywords, or by another
+            # version: start afresh
+            self.conn.execute("DROP TABLE headers")
+        self.conn.execute(
+            f"CREATE TABLE IF NOT EXISTS headers (path TEXT PRIMARY KEY, size INTEGER, mtime REAL, {col_defs})"
+        )
+        self.conn.execute("INSERT OR REPLACE INTO info VALUES ('version', ?)", (version,))
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def _to_row(self, values):
+        row = dict(zip(self.columns, values))
+        if row["OVERRIDES"] is not None:
+            row["OVERRIDES"] = pyjson5.loads(row["OVERRIDES"])
+        return row
+
+    def lookup(self, filepaths):
+        """
+        Return the catalogued row of each file, or None where the file is not
+        catalogued or its size or modification time has changed.
+        """
+        rows = []
+        for filepath in filepaths:
+            try:
+                stat = os.stat(filepath)
+            except OSError:
+                rows.append(None)
+                continue
+            result = self.conn.execute(
+                "SELECT * FROM headers WHERE path = ? AND size = ? AND mtime = ?",
+                (os.path.abspath(filepath), stat.st_size, stat.st_mtime),
+            ).fetchone()
+            rows.append(None if result is None else self._to_row(result[3:]))
+        return rows
+
+    def store(self, filepaths, rows):
+        """
+        Store (or replace) the rows for the given files.
+        """
+        records = []
+        for filepath, row in zip(filepaths, rows):
+            stat = os.stat(filepath)
+            values = [_to_sql_value(row[col]) for col in self.columns[:-1]]
+            values.append(None if row["OVERRIDES"] is None else pyjson5.dumps(row["OVERRIDES"]))
+            records.append([os.path.abspath(filepath), stat.st_size, stat.st_mtime] + values)
+        placeholders = ", ".join(["?"] * (3 + len(self.columns)))
+        self.conn.executemany(f"INSERT OR REPLACE INTO headers VALUES ({placeholders})", records)
+        self.conn.commit()
+
+    def query(self, mjd=None, within_days=None, **keywords):
+        """
+        Find the catalogued files matching the given keyword values.
+
+        Parameters
+        ----------
+        mjd : float, optional
+            Reference MJD for `within_days`.
+            Default: None.
+        within_days : float, optional
+            If set (with `mjd`), only return files with MJD-OBS within this many days
+            of `mjd`.
+            Default: None.
+        **keywords
+            Required values of any of the `INDEX_KEYWORDS`, e.g. IMAGETYP="ARC".
+            Keywords with hyphens may be given with underscores (e.g. DATE_OBS).
+
+        Returns
+        -------
+        pandas.DataFrame
+            The matching rows, indexed by path and sorted by MJD-OBS.
+        """
+        clauses = []
+        params = []
+        for key, val in keywords.items():
+            key = key.replace("_", "-")
+            if key not in INDEX_KEYWORDS:
+                raise ValueError(f"Cannot query keyword {key}: not one of {INDEX_KEYWORDS}")
+            clauses.append(f'"{key}" = ?')
+            params.append(val)
+        if within_days is not None:
+            if mjd is None:
+                raise ValueError("Must give the reference mjd with within_days")
+            clauses.append('"MJD-OBS" BETWEEN ? AND ?')
+            params.extend([mjd - within_days, mjd + within_days])
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ""
+        results = self.conn.execute(
+            f'SELECT * FROM headers{where} ORDER BY "MJD-OBS"', params
+        ).fetchall()
+        return pd.DataFrame([self._to_row(result[3:]) for result in results],
+                            index=[result[0] for result in results],
+                            columns=self.columns)
+
+
+def build_header_index(data_dir, filenames=None, max_threads=-1, catalogue=None):
+    """
+    Build a table of the primary header keywords needed for classification, reading
+    only the headers of the files, in parallel threads.
+
+    Parameters
+    ----------
+    data_dir : str
+        The directory containing the FITS files.
+    filenames : list of str, optional
+        The files to index. Default: None (all files in `data_dir`).
+    max_threads : int, optional
+        Maximum number of threads to use (-1 uses all available cores).
+        Default: -1.
+    catalogue : HeaderCatalogue, optional
+        Persistent catalogue to take unchanged files from, and to update with the
+        files that had to be read.
+        Default: None.
+
+    Returns
+    -------
+    pandas.DataFrame
+        One row per readable FITS file, indexed by filename (without any '.fz' or
+        '.gz' compression extension, as for the staged copies), with a column for
+        each of `INDEX_KEYWORDS` (None where absent) and an 'OVERRIDES' column
+        holding any header corrections to apply when the frame is first processed
+        (e.g. the total exposure time of TAROS Nod & Shuffle frames), or None.
+    """
+    if filenames is None:
+        # sort to ensure repeatability
+        filenames = sorted(os.listdir(data_dir))
+    filepaths = [os.path.join(data_dir, fn) for fn in filenames]
+    if catalogue is None:
+        rows = [None] * len(filepaths)
+    else:
+        rows = catalogue.lookup(filepaths)
+    to_read = [i for i, row in enumerate(rows) if row is None]
+    tasks = [get_task(_read_index_row, filepaths[i]) for i in to_read]
+    for i, row in zip(to_read, map_tasks_threaded(tasks, max_threads=max_threads)):
+        rows[i] = row
+    if catalogue is not None:
+        new_rows = [i for i in to_read if rows[i] is not None]
+        catalogue.store([filepaths[i] for i in new_rows], [rows[i] for i in new_rows])
+        print(f"Read {len(to_read)} of {len(filenames)} headers, others from catalogue {catalogue.db_path}")
+    good = [i for i, row in enumerate(rows) if row is not None]
+    index = pd.DataFrame([rows[i] for i in good],
+                         index=[re.sub("\\.(fz|gz)$", "", filenames[i]) for i in good],
+                         columns=INDEX_KEYWORDS + ["OVERRIDES"])
+    index = index[~index.index.duplicated()]
+    # keep missing keywords as None rather than NaN
+    return index.astype(object).where(index.notna(), None)
+
+
+def get_header_overrides(header_index):
+    """
+    Collect the header corrections recorded in a header index.
+
+    Parameters
+    ----------
+    header_index : pandas.DataFrame
+        Table returned by `build_header_index`.
+
+    Returns
+    -------
+    dict
+        Dictionary of {keyword: value} corrections for each affected frame, keyed by
+        the filename without the '.fits' extension.
+    """
+    return {filename.replace(".fits", ""): overrides
+            for filename, overrides in header_index["OVERRIDES"].items()
+            if overrides is not None}
+
+
+def get_obs_metadata(filenames, data_dir, greedy_stds=False, coadd_mode="all", mode_save_fn=None, camera="blue",
+                     header_index=None):
     """
     Retrieve metadata for observed data files.
 
@@ -44,6 +297,9 @@ def get_obs_metadata(filenames, data_dir, greedy_stds=False, coadd_mode="all", m
         Filename for saving grouping of images to coadd if coadd_mode = 'prompt'.
     camera : str
         Which camera, for parsing of coadd association dictionary. Allowed values: "blue", "red".
+    header_index : pandas.DataFrame, optional
+        Table of header keywords from `build_header_index` covering `filenames`.
+        Default: None (read the headers of `filenames`).
 
     Returns
     -------
@@ -67,6 +323,8 @@ def get_obs_metadata(filenames, data_dir, greedy_stds=False, coadd_mode="all", m
 
     """
     stdstar_list = wifes_calib.ref_fname_lookup.keys()
+    if header_index is None:
+        header_index = build_header_index(data_dir, filenames)
 
     blue_grating = []
     red_grating = []
@@ -88,20 +346,20 @@ def get_obs_metadata(filenames, data_dir, greedy_stds=False, coadd_mode="all", m
     for filename in filenames:
         basename = filename.replace(".fits", "")
 
-        f = pyfits.open(data_dir + filename)
-        imagetype = f[0].header["IMAGETYP"].upper()
-        obj_name = f[0].header["OBJECT"]
-        this_gratingb = f[0].header["GRATINGB"]
-        this_gratingr = f[0].header["GRATINGR"]
-        this_beamsplitter = f[0].header["BEAMSPLT"]
-        f.close()
+        row = header_index.loc[filename]
+        imagetype = row["IMAGETYP"].upper()
+        obj_name = row["OBJECT"]
+        this_gratingb = row["GRATINGB"]
+        this_gratingr = row["GRATINGR"]
+        this_beamsplitter = row["BEAMSPLT"]
         # ---------------------------
         # Check if it is within a close distance to a standard star.
         # If so and greedy_stds is True, fix the object name to be the good one from the list
         std_type = None
         try:
             if (greedy_stds or imagetype == "STANDARD"):
-                near_std, std_dist, temp_std_type = wifes_calib.find_nearest_stdstar(data_dir + filename, stdtype="any")
+                near_std, std_dist, temp_std_type = wifes_calib.find_nearest_stdstar(
+                    data_dir + filename, stdtype="any", radec=f"{row['RA']} {row['DEC']}")
                 if imagetype == "STANDARD" or std_dist < 200.0:
                     obj_name = near_std
                     std_type = temp_std_type
@@ -395,10 +653,15 @@ def get_obs_metadata(filenames, data_dir, greedy_stds=False, coadd_mode="all", m
     return obs_metadata
 
 
-def classify(data_dir, naxis2_to_process=0, greedy_stds=False, coadd_mode='all', mode_save_fn=None):
+def classify(data_dir, naxis2_to_process=0, greedy_stds=False, coadd_mode='all', mode_save_fn=None,
+             header_index=None):
     """
     Classify FITS files in the specified directory based on the CAMERA keyword in the header. It filters files into blue and red (arms) observations, extracting metadata for each. It returns a dictionary containing metadata for the blue and red observations.
 
+    Only the primary headers are read (see `build_header_index`), and the files are
+    not modified. Header corrections, such as the total exposure time of TAROS Nod &
+    Shuffle frames, are recorded in the index and returned by `get_header_overrides`.
+
 
     Parameters
     ----------
@@ -413,6 +676,9 @@ def classify(data_dir, naxis2_to_process=0, greedy_stds=False, coadd_mode='all',
         'all' (default), 'none', 'prompt' (user-selected).
     mode_save_fn : str
         Filename for saving grouping of images to coadd if coadd_mode = 'prompt'.
+    header_index : pandas.DataFrame, optional
+        Table of header keywords from `build_header_index`.
+        Default: None (index all files in `data_dir`).
 
     Returns
     -------
@@ -421,24 +687,17 @@ def classify(data_dir, naxis2_to_process=0, greedy_stds=False, coadd_mode='all',
 
     """
 
-    # Get list of all fits files in directory and sort to ensure repeatability
-    filenames = sorted(os.listdir(data_dir))
+    if header_index is None:
+        header_index = build_header_index(data_dir)
 
     # Filtering the data as per blue and red arm
     blue_filenames = []
     red_filenames = []
 
-    for filename in filenames:
-        try:
-            f = pyfits.open(data_dir + filename, mode="update")
-            camera = f[0].header["CAMERA"]
-            naxis2 = f[0].header["NAXIS2"]
-            # Fix TAROS Nod-and-Shuffle exposure times
-            if is_taros(f) and is_nodshuffle(f) and "NSUBEXPS" in f[0].header:
-                f[0].header["SEXPTIME"] = f[0].header["NSUBEXPS"] * f[0].header["EXPTIME"]
-                f[0].header["EXPTIME"] = f[0].header["NSUBEXPS"] * f[0].header["EXPTIME"]
-            f.close()
-        except Exception:
+    for filename, row in header_index.iterrows():
+        camera = row["CAMERA"]
+        naxis2 = row["NAXIS2"]
+        if camera is None or naxis2 is None:
             continue
         if naxis2_to_process != 0 and naxis2_to_process != naxis2:
             continue
@@ -455,10 +714,10 @@ def classify(data_dir, naxis2_to_process=0, greedy_stds=False, coadd_mode='all',
 
     blue_obs_metadata = get_obs_metadata(blue_filenames, data_dir, greedy_stds=greedy_stds,
                                          coadd_mode=coadd_mode, mode_save_fn=mode_save_fn,
-                                         camera="blue")
+                                         camera="blue", header_index=header_index)
     red_obs_metadata = get_obs_metadata(red_filenames, data_dir, greedy_stds=greedy_stds,
                                         coadd_mode=coadd_mode, mode_save_fn=mode_save_fn,
-                                        camera="red")
+                                        camera="red", header_index=header_index)
 
     return {"blue": blue_obs_metadata, "red": red_obs_metadata}
 
@@ -4,9 +4,9 @@ import scipy.signal
 import scipy.ndimage
 import scipy.interpolate
 
-from pywifes.multiprocessing_utils import get_task, map_tasks
-from pywifes.wifes_imtrans import blkrep, blkavg, transform_data, detransform_data
-from pywifes.wifes_utils import arguments, is_halfframe, is_taros
+from pywifes.multiprocessing_utils import get_task, imap_tasks, map_tasks
+from pywifes.wifes_imtrans import blkrep, blkavg, Rectifier, get_rectifier
+from pywifes.wifes_utils import arguments, is_halfframe, is_taros, write_fits
 
 
 # -----------------------------------------------------------------------------
@@ -28,6 +28,7 @@ def lacos_spec_data(
     n_nx=1,
     n_ny=5,
     verbose=True,
+    rectifier=None,
 ):
     """
     Perform cosmic ray rejection on spectroscopic data using the L.A.Cosmic algorithm. The L.A.Cosmic algorithm is a Laplacian cosmic ray detection algorithm that uses a noise model to identify cosmic rays. The algorithm is described in van Dokkum (2001, PASP, 113, 1420).
@@ -59,6 +60,9 @@ def lacos_spec_data(
         The number of neighboring pixels to consider in the y-direction. Default is 5.
     verbose : bool, optional
         Whether to print verbose output. Default is True.
+    rectifier : Rectifier, optional
+        Precomputed rectification operators for this slitlet, used instead of
+        building them from `wave`. Default is None.
 
     Returns
     -------
@@ -68,26 +72,30 @@ def lacos_spec_data(
         The bad pixel mask indicating the locations of cosmic rays.
     """
     ny, nx = numpy.shape(data)
-    x_mg, y_mg = numpy.meshgrid(numpy.arange(nx), numpy.arange(ny))
+    # offsets of the neighbouring pixels used to repair each cosmic ray
+    win_dy, win_dx = [d.ravel() for d in numpy.mgrid[-n_ny:n_ny + 1, -n_nx:n_nx + 1]]
     # set up bad pix mask that will persist through multiple iterations
     # retain previously flagged bad pixels if mask if supplied
     global_bpm = numpy.zeros(numpy.shape(data)) if input_dq is None else input_dq
     clean_data = 1.0 * data
+    # build the rectification operators once for all iterations
+    if rectifier is None and wave is not None:
+        rectifier = Rectifier(wave)
 
     # ------------------------------------------------------------------------
     # MULTIPLE ITERATIONS
     for i in range(niter):
         # ------------------------------------
         # step 1 - subtract sky lines
-        if wave is None:
+        if rectifier is None:
             sky_model = scipy.ndimage.median_filter(clean_data, size=[7, 1])
             m5_model = scipy.ndimage.median_filter(clean_data, size=[5, 5])
         else:
-            rect_data = transform_data(clean_data, wave)
+            rect_data = rectifier.transform(clean_data)
             med_rect = scipy.ndimage.median_filter(rect_data, size=[7, 1])
             m5_rect = scipy.ndimage.median_filter(rect_data, size=[5, 5])
-            sky_model = detransform_data(med_rect, clean_data, wave)
-            m5_model = detransform_data(m5_rect, clean_data, wave)
+            sky_model = rectifier.detransform(med_rect)
+            m5_model = rectifier.detransform(m5_rect)
         subbed_data = clean_data - sky_model
 
         # ------------------------------------
@@ -165,18 +173,19 @@ def lacos_spec_data(
 
         # ------------------------------------
         # step 7 - interpolate over neighboring pixels to fill the bad CR pix
-        all_bpix = numpy.nonzero(new_bpm)  # tends to spread original bad pixels if looping over global_bpm here
-        n_bpix = len(all_bpix[0])
-        for i in range(n_bpix):
-            bpy = all_bpix[0][i]
-            bpx = all_bpix[1][i]
-            n_inds = numpy.nonzero(
-                (numpy.abs(y_mg - bpy) <= n_ny)
-                * (numpy.abs(x_mg - bpx) <= n_nx)
-                * (global_bpm == 0)
-            )
-            if n_inds[0].size > 0:
-                clean_data[bpy, bpx] = numpy.nanmedian(data[n_inds])
+        # using the median of the unflagged original data in a window around
+        # each flagged pixel, gathered for all flagged pixels at once
+        bpy, bpx = numpy.nonzero(new_bpm)  # tends to spread original bad pixels if looping over global_bpm here
+        win_y = bpy[:, None] + win_dy[None, :]
+        win_x = bpx[:, None] + win_dx[None, :]
+        in_frame = (win_y >= 0) * (win_y < ny) * (win_x >= 0) * (win_x < nx)
+        win_y = numpy.clip(win_y, 0, ny - 1)
+        win_x = numpy.clip(win_x, 0, nx - 1)
+        usable = in_frame * (global_bpm[win_y, win_x] == 0)
+        has_neighbours = numpy.any(usable, axis=1)
+        win_data = numpy.where(usable, data[win_y, win_x], numpy.nan)[has_neighbours]
+        if win_data.size > 0:
+            clean_data[bpy[has_neighbours], bpx[has_neighbours]] = numpy.nanmedian(win_data, axis=1)
 
         clean_data[numpy.isnan(clean_data)] = data[numpy.isnan(clean_data)]
 
@@ -337,8 +346,6 @@ def lacos_wifes_oneproc(
         nslits = 25
 
     outfits = pyfits.HDUList(hdus)
-    if wsol_filepath:
-        wsol_hdus = pyfits.open(wsol_filepath)
 
     for i in range(nslits):
         curr_hdu = i + 1
@@ -346,15 +353,14 @@ def lacos_wifes_oneproc(
         orig_dq = hdus[curr_hdu + 2 * nslits].data
 
         if wsol_filepath:
-            wave = wsol_hdus[curr_hdu].data
+            rectifier = get_rectifier(wsol_filepath, curr_hdu)
         else:
-            wave = None
+            rectifier = None
         clean_data, global_bpm = lacos_spec_data(
             orig_data,
             input_dq=orig_dq,
             gain=gain,
             rdnoise=rdnoise,
-            wave=wave,
             sig_clip=sig_clip,
             sig_frac=sig_frac,
             obj_lim=obj_lim,
@@ -362,6 +368,7 @@ def lacos_wifes_oneproc(
             n_nx=n_nx,
             n_ny=n_ny,
             verbose=False,
+            rectifier=rectifier,
         )
         # update the data hdu
         outfits[curr_hdu].data = clean_data.astype("float32", casting="same_kind")
@@ -372,11 +379,8 @@ def lacos_wifes_oneproc(
         global_bpm[global_bpm < -32768] = -32768
         outfits[curr_hdu + 2 * nslits].data = global_bpm.astype("int16", casting="unsafe")
         outfits[curr_hdu + 2 * nslits].scale("int16")
-    if wsol_filepath:
-        wsol_hdus.close()
 
-    outfits.writeto(out_filepath, overwrite=True)
-    hdus.close()
+    write_fits(outfits, out_filepath, close=[hdus])
     return
 
 
@@ -486,6 +490,131 @@ def lacos_wifes_multithread(
         outfits[i_dq_slit].data = global_bpm.astype("int16", casting="unsafe")
         outfits[i_dq_slit].scale("int16")
 
-    outfits.writeto(out_filepath, overwrite=True)
-    hdus.close()
+    write_fits(outfits, out_filepath, close=[hdus])
+    return
+
+
+def _lacos_slitlet(data, input_dq, wsol_filepath, curr_hdu, **kwargs):
+    """
+    Clean one slitlet, reusing the worker's rectifier for its wavelength solution.
+    """
+    if wsol_filepath:
+        rectifier = get_rectifier(wsol_filepath, curr_hdu)
+    else:
+        rectifier = None
+    return lacos_spec_data(data, input_dq=input_dq, rectifier=rectifier, **kwargs)
+
+
+def lacos_wifes_frames(
+    in_img_filepaths,
+    out_filepaths,
+    gain=1.0,  # assume data has been scaled by its gain
+    rdnoises=None,
+    wsol_filepath=None,
+    sig_clip=4.0,
+    sig_frac=0.5,
+    obj_lim=1.0,
+    niter=4,
+    n_nx=1,
+    n_ny=5,
+    max_processes=-1,
+):
+    """
+    Apply the L.A.Cosmic cosmic ray removal algorithm to several WiFeS images
+    using a single pool of processes.
+
+    The slitlets of all frames are scheduled as independent tasks on one pool,
+    so the workers stay busy across frame boundaries rather than waiting for
+    the slowest slitlet of each frame. Each worker builds the rectification
+    operators for the wavelength solution once and reuses them for every
+    frame. Each output is written as soon as all of its slitlets are done.
+
+    Parameters:
+    ----------
+    in_img_filepaths : list of str
+        Filepaths of the input images.
+    out_filepaths : list of str
+        Filepaths to save the output images, matching `in_img_filepaths`.
+    gain : float, optional
+        Gain of the data (default is 1.0).
+    rdnoises : list of float, optional
+        Read noise of each input image (default is None, which uses 5.0 for all).
+    wsol_filepath : str, optional
+        Filepath of the wavelength solution data (default is None).
+    sig_clip : float, optional
+        Sigma clipping threshold for cosmic ray detection (default is 4.0).
+    sig_frac : float, optional
+        Fractional threshold for cosmic ray detection (default is 0.5).
+    obj_lim : float, optional
+        Object limit for cosmic ray detection (default is 1.0).
+    niter : int, optional
+        Number of iterations for cosmic ray detection (default is 4).
+    n_nx : int, optional
+        Number of pixels in the x-direction for cosmic ray detection (default is 1).
+    n_ny : int, optional
+        Number of pixels in the y-direction for cosmic ray detection (default is 5).
+    max_processes : int, optional
+        Maximum number of processes to use for parallelization (default is -1, which uses all available processes).
+
+    Returns:
+    -------
+    None
+    """
+    if rdnoises is None:
+        rdnoises = [5.0] * len(in_img_filepaths)
+
+    # count the slitlets of each frame up front, so the results can be
+    # regrouped by frame as they stream back from the pool
+    frame_nslits = []
+    for in_img_filepath in in_img_filepaths:
+        with pyfits.open(in_img_filepath) as hdus:
+            if is_halfframe(hdus):
+                nslits = 12 if is_taros(hdus) else 13
+            else:
+                nslits = 25
+        frame_nslits.append(nslits)
+
+    def _tasks():
+        # read one frame at a time while the pool works on earlier ones
+        for in_img_filepath, rdnoise, nslits in zip(in_img_filepaths, rdnoises, frame_nslits):
+            with pyfits.open(in_img_filepath) as hdus:
+                for i in range(nslits):
+                    curr_hdu = i + 1
+                    yield get_task(
+                        _lacos_slitlet,
+                        hdus[curr_hdu].data.copy(),
+                        hdus[curr_hdu + 2 * nslits].data.copy(),
+                        wsol_filepath,
+                        curr_hdu,
+                        gain=gain,
+                        rdnoise=rdnoise,
+                        sig_clip=sig_clip,
+                        sig_frac=sig_frac,
+                        obj_lim=obj_lim,
+                        niter=niter,
+                        n_nx=n_nx,
+                        n_ny=n_ny,
+                        verbose=False,
+                    )
+
+    results = imap_tasks(_tasks(), max_processes=max_processes)
+    for in_img_filepath, out_filepath, nslits in zip(in_img_filepaths, out_filepaths, frame_nslits):
+        hdus = pyfits.open(in_img_filepath)
+        outfits = pyfits.HDUList(hdus)
+        for i in range(nslits):
+            clean_data, global_bpm = next(results)
+            i_slit = i + 1
+            i_dq_slit = i_slit + 2 * nslits
+
+            # update the data hdu
+            outfits[i_slit].data = clean_data.astype("float32", casting="same_kind")
+            outfits[i_slit].scale("float32")
+            # save the bad pixel mask in the DQ extentions
+            # trim data beyond range
+            global_bpm[global_bpm > 32767] = 32767
+            global_bpm[global_bpm < -32768] = -32768
+            outfits[i_dq_slit].data = global_bpm.astype("int16", casting="unsafe")
+            outfits[i_dq_slit].scale("int16")
+
+        write_fits(outfits, out_filepath, close=[hdus])
     return
@@ -0,0 +1,273 @@
+import functools
+import hashlib
+import os
+import pyjson5
+import shutil
+
+from pywifes.calib_library import LIBRARY_STEPS, library_step_id
+from pywifes.wifes_metadata import __version__
+from pywifes.wifes_utils import get_file_hash, unpack_files
+
+
+# Steps whose products (master calibrations, and any local calibrations) can be taken
+# from the store, and whether they also depend on the standard star frames.
+MASTER_STEPS = {
+    "superbias": False,
+    "superflat": False,
+    "slitlet_profile": False,
+    "flat_cleanup": False,
+    "superflat_mef": False,
+    "wave_soln": False,
+    "wire_soln": False,
+    "flat_response": False,
+    "derive_calib": True,
+    "derive_telluric": True,
+}
+
+# Calibration frame types in the metadata
+CALIB_TYPES = ["bias", "dark", "domeflat", "twiflat", "wire", "arc"]
+
+# Master products of the steps not in the calibration library, by their keys in the
+# global arguments (the others are listed in `LIBRARY_STEPS`)
+MASTER_PRODUCTS = {
+    "derive_calib": ["calib_fn"],
+    "derive_telluric": ["tellcorr_fn"],
+}
+
+# Local calibrations written to the intermediate directory: the calibration frame
+# type they are built from and the endings of the files for each such frame
+LOCAL_PRODUCTS = {
+    "superbias": ("bias", [".lsb.fits", ".lsb_fit.fits"]),
+    "wave_soln": ("arc", [".wsol.fits", ".wsol.fits_extra.pkl"]),
+    "wire_soln": ("wire", [".wire.fits"]),
+}
+
+
+def _calib_frames(metadata):
+    # All calibration frames, with their associations to science and standard frames
+    frames = set(fn for key in CALIB_TYPES for fn in metadata[key])
+    associations = []
+    for obs in metadata["sci"] + metadata["std"]:
+        for key in CALIB_TYPES:
+            if key in obs and obs[key]:
+                frames.update(obs[key])
+                associations.append((obs["sci"][0], key, sorted(obs[key])))
+    return sorted(frames), sorted(associations)
+
+
+def _std_frames(metadata):
+    # The standard star frames, with their sky frames, names and types
+    frames = set()
+    stars = []
+    for obs in metadata["std"]:
+        frames.update(obs["sci"])
+        frames.update(obs.get("sky", []))
+        stars.append((sorted(obs["sci"]), obs.get("name", None), obs.get("stdtype", None)))
+    return sorted(frames), sorted(stars, key=repr)
+
+
+def _wsol_extra_hash(wsol_fn):
+    # Hash of the stored optical model solution a wavelength solution starts from
+    # (the '_extra.pkl' file of `wsol_fn`), or None if there is none
+    if not wsol_fn:
+        return None
+    extra_fn = wsol_fn if wsol_fn.endswith("_extra.pkl") else wsol_fn + "_extra.pkl"
+    if not os.path.isfile(extra_fn):
+        return None
+    return get_file_hash(extra_fn)
+
+
+def _key_args(step, gargs):
+    # The arguments of a step as they enter its key. A warm-started optical model
+    # wavelength solution also depends on the stored solution its master solution
+    # starts from: `warm_start`, or the calibration library entry. (The local arc
+    # solutions start from that master solution, which the other inputs fix.)
+    args = dict(step["args"])
+    if (step["step"] == "wave_soln" and args.get("warm_start")
+            and args.get("method", "optical") == "optical" and gargs is not None):
+        warm_start = gargs['wsol_warm_start'] if args["warm_start"] is True else args["warm_start"]
+        args["warm_start_hash"] = _wsol_extra_hash(warm_start)
+    return sorted(args.items(), key=repr)
+
+
+def master_step_keys(steps, metadata, data_dir, arm, extra=None, gargs=None):
+    """
+    Compute the provenance key of each master calibration step.
+
+    The key of a step is a hash of the pipeline version, the arm, the contents of
+    the raw calibration frames (and standard star frames, for the steps that use
+    them), and the name, suffix and arguments of this and every earlier step. Any
+    change upstream of a master product therefore changes its key. The arguments
+    of a warm-started wavelength solution include the hash of the stored
+    solution it starts from.
+
+    Parameters
+    ----------
+    steps : list of dict
+        The steps to run, in order, each with 'step', 'suffix' and 'args' entries.
+    metadata : dict
+        Metadata containing information about the observations.
+    data_dir : str
+        Directory of the raw frames.
+    arm : str
+        The arm being reduced.
+    extra : optional
+        Any further provenance of the products (e.g. master calibrations taken from
+        elsewhere), included in every key.
+        Default: None.
+    gargs : dict, optional
+        The global arguments, giving the calibration library solution a warm-started
+        wavelength solution starts from ('wsol_warm_start').
+        Default: None.
+
+    Returns
+    -------
+    list
+        The key (hexadecimal string) of each step in `MASTER_STEPS`, or None for the
+        other steps.
+    """
+    file_hashes = {}
+
+    def _frame_hashes(frames):
+        unpack_files(data_dir, [fn for fn in frames if fn not in file_hashes])
+        for fn in frames:
+            if fn not in file_hashes:
+                file_hashes[fn] = get_file_hash(os.path.join(data_dir, f"{fn}.fits"))
+        return [(fn, file_hashes[fn]) for fn in frames]
+
+    calib_frames, associations = _calib_frames(metadata)
+    std_frames, std_stars = _std_frames(metadata)
+    if any(step["step"] in MASTER_STEPS for step in steps):
+        calib_hashes = _frame_hashes(calib_frames)
+    provenance = [__version__, arm, extra]
+    keys = []
+    for step in steps:
+        provenance.append((step["step"], step["suffix"], _key_args(step, gargs)))
+        if step["step"] not in MASTER_STEPS:
+            keys.append(None)
+            continue
+        key_items = provenance + [calib_hashes, associations]
+        if MASTER_STEPS[step["step"]]:
+            key_items += [_frame_hashes(std_frames), std_stars]
+        keys.append(hashlib.sha256(repr(key_items).encode()).hexdigest())
+    return keys
+
+
+class MasterStore:
+    """
+    Content-addressed store of master calibration products.
+
+    Each entry holds the products written by one master calibration step, under the
+    key given by `master_step_keys`: its master calibrations (in the master directory
+    or, when reducing from master calibrations, the output master directory) and any
+    local calibrations in the intermediate directory of the arm. Only the products
+    declared for the step (`LIBRARY_STEPS`, `MASTER_PRODUCTS` and `LOCAL_PRODUCTS`)
+    are stored.
+
+    Parameters
+    ----------
+    store_dir : str
+        Directory of the store, created if it does not exist.
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        os.makedirs(store_dir, exist_ok=True)
+
+    def _product_dirs(self, gargs):
+        product_dirs = {"master": gargs['master_dir'], "intermediate": gargs['out_dir_arm']}
+        if gargs['output_master_dir']:
+            product_dirs["output_master"] = gargs['output_master_dir']
+        return product_dirs
+
+    def _declared_products(self, step_name, args, metadata, gargs):
+        # The files a step may write, as (label, filename) pairs: its master products
+        # (which may be moved to the output master directory) and local calibrations
+        step_id = library_step_id({"step": step_name, "args": args})
+        if step_id in LIBRARY_STEPS:
+            keys = LIBRARY_STEPS[step_id][1] + LIBRARY_STEPS[step_id][2]
+        else:
+            keys = MASTER_PRODUCTS.get(step_name, [])
+        products = []
+        for key in keys:
+            products.append(("master", os.path.basename(gargs[key])))
+            if gargs['output_master_dir']:
+                products.append(("output_master", os.path.basename(gargs[key])))
+        if step_name in LOCAL_PRODUCTS:
+            calib_type, endings = LOCAL_PRODUCTS[step_name]
+            frames = sorted(set(fn for obs in metadata["sci"] + metadata["std"]
+                                for fn in obs.get(calib_type, [])))
+            products += [("intermediate", fn + ending) for fn in frames for ending in endings]
+        return products
+
+    def run_step(self, key, step_name, func, metadata, gargs, prev_suffix, curr_suffix, **args):
+        """
+        Restore the products of a master calibration step from the store if they are
+        there under `key`, or otherwise run the step (recipe `func`) and store its
+        products.
+        """
+        entry_dir = os.path.join(self.store_dir, key[:2], key)
+        product_dirs = self._product_dirs(gargs)
+        manifest_fn = os.path.join(entry_dir, "manifest.json5")
+        if os.path.isfile(manifest_fn):
+            try:
+                with open(manifest_fn, "r") as f:
+                    manifest = pyjson5.load(f)
+                # restore in the original order, to keep the relative modification times
+                for label, fn in manifest["products"]:
+                    shutil.copy(os.path.join(entry_dir, label, fn),
+                                os.path.join(product_dirs[label], fn))
+                print(f"Restored {len(manifest['products'])} products of {manifest['step']} "
+                      f"from master store entry {key}")
+                return
+            except Exception as e:
+                print(f"Could not restore master store entry {key}: {e}")
+
+        # only the files this step declares are considered, as other steps may be
+        # writing to the same directories at the same time
+        declared = self._declared_products(step_name, args, metadata, gargs)
+
+        def _mtimes():
+            mtimes = {}
+            for label, fn in declared:
+                path = os.path.join(product_dirs[label], fn)
+                if os.path.isfile(path):
+                    mtimes[(label, fn)] = os.path.getmtime(path)
+            return mtimes
+
+        before = _mtimes()
+        func(metadata, gargs, prev_suffix=prev_suffix, curr_suffix=curr_suffix, **args)
+        products = [(mtime, label, fn) for (label, fn), mtime in _mtimes().items()
+                    if before.get((label, fn), None) != mtime]
+        if not products:
+            # nothing written (e.g. outputs were already done)
+            return
+
+        # write the entry under a temporary name, so that it only appears complete
+        temp_dir = f"{entry_dir}.tmp{os.getpid()}"
+        try:
+            for _, label, fn in products:
+                os.makedirs(os.path.join(temp_dir, label), exist_ok=True)
+                shutil.copy2(os.path.join(product_dirs[label], fn), os.path.join(temp_dir, label, fn))
+            manifest = {
+                "step": step_name,
+                "version": __version__,
+                "arm": gargs['arm'],
+                "args": args,
+                "products": [[label, fn] for _, label, fn in sorted(products)],
+            }
+            with open(os.path.join(temp_dir, "manifest.json5"), "w") as f:
+                pyjson5.dump(manifest, f)
+            os.makedirs(os.path.dirname(entry_dir), exist_ok=True)
+            os.rename(temp_dir, entry_dir)
+            print(f"Stored {len(products)} products of {step_name} as master store entry {key}")
+        except Exception as e:
+            print(f"Could not store master store entry {key}: {e}")
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    def wrap(self, func, key, step_name):
+        """
+        Return a recipe function that runs the recipe `func` of step `step_name`
+        through the store under `key`.
+        """
+        return functools.partial(self.run_step, key, step_name, func)
@@ -1079,13 +1079,13 @@ class mpfit:
                 if nlpeg > 0:
                     # Total derivative of sum wrt lower pegged parameters
                     for i in range(nlpeg):
-                        sum0 = sum(fvec * fjac[:, whlpeg[i]])
+                        sum0 = numpy.sum(fvec * fjac[:, whlpeg[i]])
                         if sum0 > 0:
                             fjac[:, whlpeg[i]] = 0
                 if nupeg > 0:
                     # Total derivative of sum wrt upper pegged parameters
                     for i in range(nupeg):
-                        sum0 = sum(fvec * fjac[:, whupeg[i]])
+                        sum0 = numpy.sum(fvec * fjac[:, whupeg[i]])
                         if sum0 < 0:
                             fjac[:, whupeg[i]] = 0
 
@@ -1118,7 +1118,7 @@ class mpfit:
                     fj = fjac[j:, lj]
                     wj = wa4[j:]
                     # *** optimization wa4(j:*)
-                    wa4[j:] = wj - fj * sum(fj * wj) / temp3
+                    wa4[j:] = wj - fj * numpy.sum(fj * wj) / temp3
                 fjac[j, lj] = wa1[j]
                 qtf[j] = wa4[j]
             # From this point on, only the square matrix, consisting of the
@@ -1143,7 +1143,7 @@ class mpfit:
                 for j in range(n):
                     this_l = ipvt[j]
                     if wa2[this_l] != 0:
-                        sum0 = sum(fjac[0:j + 1, j] * qtf[0: j + 1]) / self.fnorm
+                        sum0 = numpy.sum(fjac[0:j + 1, j] * qtf[0: j + 1]) / self.fnorm
                         gnorm = numpy.max([gnorm, numpy.abs(sum0 / wa2[this_l])])
 
             # Test for convergence of the gradient norm
@@ -1515,22 +1515,21 @@ class mpfit:
             mperr = 0
             fjac = numpy.zeros(nall, dtype=float)
             fjac[ifree] = 1.0  # Specify which parameters need derivatives
-            [status, fp] = self.call(fcn, xall, functkw, fjac=fjac)
+            [status, fp, pderiv] = self.call(fcn, xall, functkw, fjac=fjac)
+            if status < 0:
+                return None
 
-            if len(fjac) != m * nall:
+            fjac = numpy.asarray(pderiv, dtype=float)
+            if fjac.size != m * nall:
                 print('ERROR: Derivative matrix was not computed properly.')
                 return None
 
             # This definition is consistent with CURVEFIT
             # Sign error found (thanks Jesus Fernandez <fernande@irm.chu-caen.fr>)
-            fjac.shape = [m, nall]
-            fjac = -fjac
+            fjac = -fjac.reshape(m, nall)
 
             # Select only the free parameters
-            if len(ifree) < nall:
-                fjac = fjac[:, ifree]
-                fjac.shape = [m, n]
-                return fjac
+            return fjac[:, ifree]
 
         fjac = numpy.zeros([m, n], dtype=float)
 
@@ -1790,7 +1789,7 @@ class mpfit:
                     # *** Note optimization a(j:*,lk)
                     # (corrected 20 Jul 2000)
                     if a[j, lj] != 0:
-                        a[j:, lk] = ajk - ajj * sum(ajk * ajj) / a[j, lj]
+                        a[j:, lk] = ajk - ajj * numpy.sum(ajk * ajj) / a[j, lj]
                         if (pivot != 0) and (rdiag[k] != 0):
                             temp = a[j, lk] / rdiag[k]
                             rdiag[k] = rdiag[k] * numpy.sqrt(numpy.max([(1. - temp**2), 0.]))
@@ -1946,7 +1945,7 @@ class mpfit:
             wa[nsing - 1] = wa[nsing - 1] / sdiag[nsing - 1]  # Degenerate case
             # *** Reverse loop ***
             for j in range(nsing - 2, -1, -1):
-                sum0 = sum(r[j + 1:nsing, j] * wa[j + 1:nsing])
+                sum0 = numpy.sum(r[j + 1:nsing, j] * wa[j + 1:nsing])
                 wa[j] = (wa[j] - sum0) / sdiag[j]
 
         # Permute the components of z back to components of x
@@ -2094,7 +2093,7 @@ class mpfit:
             wa1 = diag[ipvt] * wa2[ipvt] / dxnorm
             wa1[0] = wa1[0] / r[0, 0]  # Degenerate case
             for j in range(1, n):  # Note "1" here, not zero
-                sum0 = sum(r[0:j, j] * wa1[0:j])
+                sum0 = numpy.sum(r[0:j, j] * wa1[0:j])
                 wa1[j] = (wa1[j] - sum0) / r[j, j]
 
             temp = self.enorm(wa1)
@@ -2102,7 +2101,7 @@ class mpfit:
 
         # Calculate an upper bound, paru, for the zero of the function
         for j in range(n):
-            sum0 = sum(r[0:j + 1, j] * qtb[0:j + 1])
+            sum0 = numpy.sum(r[0:j + 1, j] * qtb[0:j + 1])
             wa1[j] = sum0 / diag[ipvt[j]]
         gnorm = self.enorm(wa1)
         paru = gnorm / delta
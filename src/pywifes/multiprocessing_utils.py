@@ -1,3 +1,4 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import math
 import multiprocessing
 import os
@@ -66,6 +67,70 @@ def map_tasks(tasks, max_processes=-1, chunksize=-1):
     return results
 
 
+def imap_tasks(tasks, max_processes=-1):
+    """
+    Run the `tasks` on one pool of up to `max_processes` processes, yielding the
+    results in order as they become available.
+
+    Each task should follow the pattern in `get_task`, storing the function, args and
+    kwargs to run. `tasks` may be a generator, so that inputs can be prepared while
+    earlier tasks are running.
+
+    The pool is kept alive until the returned generator has been exhausted.
+    """
+    num_processes = _get_num_processes(max_processes)
+
+    with multiprocessing.Pool(num_processes) as pool:
+        for result in pool.imap(_unwrap_and_run, tasks):
+            yield result
+
+
+def map_tasks_threaded(tasks, max_threads=-1):
+    """
+    Run the `tasks` on a pool of up to `max_threads` threads in this process.
+
+    Suited to tasks dominated by NumPy work that releases the GIL, where the inputs
+    (e.g. memory-mapped arrays) should be shared rather than pickled to other processes.
+
+    Each task should follow the pattern in `get_task`, storing the function, args and
+    kwargs to run.
+
+    The results will be returned in order.
+    """
+    num_threads = _get_num_processes(max_threads)
+
+    with ThreadPoolExecutor(num_threads) as executor:
+        results = list(executor.map(_unwrap_and_run, tasks))
+
+    return results
+
+
+def submit_tasks(tasks, max_processes=-1):
+    """
+    Start running the `tasks` in the background on a pool of up to `max_processes`
+    processes, so that the caller can carry on with other work meanwhile.
+
+    Each task should follow the pattern in `get_task`, storing the function, args and
+    kwargs to run.
+
+    Returns a function that waits for all the tasks to finish, shuts down the pool,
+    and returns the results in order.
+    """
+    num_processes = _get_num_processes(max_processes)
+
+    # The worker processes are started here, before the caller starts any threads
+    executor = ProcessPoolExecutor(num_processes)
+    futures = [executor.submit(_unwrap_and_run, task) for task in tasks]
+
+    def wait_for_results():
+        try:
+            return [future.result() for future in futures]
+        finally:
+            executor.shutdown()
+
+    return wait_for_results
+
+
 def get_task(func, *args, **kwargs):
     """
     Convert the arguments provided into a 'task' tuple, suitable for `map_tasks`
@@ -39,7 +39,7 @@ def saveData(fname, grating, params, lines, meta):
 
 def loadData(fname):
     """ Load the grating, parameters, and lines of data from a file"""
-    (grating, params, lines, meta) = pickle.load(open(fname, "r"))
+    (grating, params, lines, meta) = pickle.load(open(fname, "rb"))
     return grating, params, lines, meta
 
 
@@ -180,12 +180,17 @@ def mpfitfunc(p, fjac=None, s=None, y=None, x=None, grating=None, arc=None, err=
     # Parameter values are passed in "p"
     # If fjac==None then partial derivatives should not
     # computed.  It will always be None if MPFIT is called with default
-    # flag.
-    model = fitfunc(grating, p[:nparams], p[nparams:], s, y, x)
+    # flag. Otherwise (autoderivative=0) it flags the free parameters, and
+    # the derivatives of the model are returned as well.
     # Non-negative status value means MPFIT should continue, negative means
     # stop the
     status = 0
-    return [status, (arc - model) / err]
+    if fjac is None:
+        model = fitfunc(grating, p[:nparams], p[nparams:], s, y, x)
+        return [status, (arc - model) / err]
+    model, jac = fitfunc_jacobian(grating, p[:nparams], p[nparams:], s, y, x,
+                                  free=np.nonzero(fjac)[0])
+    return [status, (arc - model) / err, jac / err[:, np.newaxis]]
 
 
 def mperrfunc_alphap(alphap, arg):
@@ -347,6 +352,136 @@ def snell(n1, n2, norm, light):
     return a + (nratio * costheta1 - np.sqrt(1 - sintheta12))[:, np.newaxis] * norm
 
 
+class _Dual:
+    """
+    A quantity and its derivatives with respect to some of the model parameters
+    (along the first axis of `der`, of length 1 along the others for a scalar
+    quantity), for forward-mode automatic differentiation of the ray trace in
+    fitfunc.
+    """
+
+    # make numpy arrays defer to our reflected operators
+    __array_ufunc__ = None
+
+    def __init__(self, val, der):
+        self.val = val
+        self.der = der
+
+    def __add__(self, other):
+        return _Dual(self.val + _val(other), self.der + _der(other))
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        return _Dual(self.val - _val(other), self.der - _der(other))
+
+    def __rsub__(self, other):
+        return _Dual(_val(other) - self.val, _der(other) - self.der)
+
+    def __neg__(self):
+        return _Dual(-self.val, -self.der)
+
+    def __mul__(self, other):
+        if isinstance(other, _Dual):
+            return _Dual(self.val * other.val,
+                         self.der * other.val + self.val * other.der)
+        return _Dual(self.val * other, self.der * other)
+
+    __rmul__ = __mul__
+
+    def __truediv__(self, other):
+        if isinstance(other, _Dual):
+            val = self.val / other.val
+            return _Dual(val, (self.der - val * other.der) / other.val)
+        return _Dual(self.val / other, self.der / other)
+
+    def __rtruediv__(self, other):
+        val = other / self.val
+        return _Dual(val, -(val / self.val) * self.der)
+
+    def __pow__(self, exponent):
+        return _Dual(self.val**exponent,
+                     (exponent * self.val**(exponent - 1)) * self.der)
+
+
+def _val(a):
+    return a.val if isinstance(a, _Dual) else a
+
+
+def _der(a):
+    return a.der if isinstance(a, _Dual) else 0.0
+
+
+def _chain(a, f, df):
+    # f(a), given f and its derivative df
+    if isinstance(a, _Dual):
+        return _Dual(f(a.val), df(a.val) * a.der)
+    return f(a)
+
+
+def _sqrt(a):
+    return _chain(a, np.sqrt, lambda v: np.where(v > 0, 0.5 / np.sqrt(np.where(v > 0, v, 1.0)), 0.0))
+
+
+def _sin(a):
+    return _chain(a, np.sin, np.cos)
+
+
+def _cos(a):
+    return _chain(a, np.cos, lambda v: -np.sin(v))
+
+
+def _tan(a):
+    return _chain(a, np.tan, lambda v: 1 + np.tan(v)**2)
+
+
+def _arcsin(a):
+    return _chain(a, np.arcsin,
+                  lambda v: np.where(np.abs(v) < 1, 1 / np.sqrt(np.where(np.abs(v) < 1, 1 - v**2, 1.0)), 0.0))
+
+
+def _arctan(a):
+    return _chain(a, np.arctan, lambda v: 1 / (1 + v**2))
+
+
+def _clip(a, lo, hi):
+    return _chain(a, lambda v: np.clip(v, lo, hi), lambda v: (v >= lo) & (v <= hi))
+
+
+def _where(cond, a, b):
+    # np.where, for quantities with derivatives
+    val = np.where(cond, _val(a), _val(b))
+    if not isinstance(a, _Dual) and not isinstance(b, _Dual):
+        return val
+    return _Dual(val, np.where(cond, _der(a), _der(b)))
+
+
+def _norm3(v):
+    # Normalise a vector given as its 3 components
+    norm = _sqrt(v[0]**2 + v[1]**2 + v[2]**2)
+    return [v[0] / norm, v[1] / norm, v[2] / norm]
+
+
+def _snell3(n1, n2, norm, light):
+    # As snell, for vectors given as their 3 components
+    nratio = n1 / n2
+    costheta1 = -(norm[0] * light[0] + norm[1] * light[1] + norm[2] * light[2])
+    sintheta12 = nratio**2 * (1 - costheta1**2)
+
+    # When we would get internal reflection we cheat by making the light continue straight on.
+    # There are no valid solutions in which this happens, so it seems like an ok compromise.
+    sintheta12 = _where(_val(1 - sintheta12) < 0, 1.0, sintheta12)
+
+    k = nratio * costheta1 - _sqrt(1 - sintheta12)
+    return [nratio * light[i] + k * norm[i] for i in range(3)]
+
+
+def _sellmeier_n2(lam):
+    # Square of the refractive index of the prisms at wavelength lam (Angstroms)
+    l2 = (lam / 1e4)**2
+    return 1 + (A1 * l2 / (l2 - B1)) + (A2 * l2 / (l2 - B2)) + (A3 * l2 / (l2 - B3))
+
+
 def fitfunc(grating, p, alphap, s, y, x):
     # The function that produces lambda given the list of parameters in p and alphap, the list of
     # slitlets in s, and the y and x values of each data point.
@@ -354,6 +489,114 @@ def fitfunc(grating, p, alphap, s, y, x):
     # Test for empty inputs
     if (s.size == 0) or (y.size == 0) or (x.size == 0):
         return np.array([])
+    rays = _trace_to_grating(grating, p, np.asarray(alphap)[s - 1], s, y, x)
+    return _disperse(grating, *rays)[0]
+
+
+def fitfunc_jacobian(grating, p, alphap, s, y, x, free=None):
+    """
+    Evaluate fitfunc, and its derivatives with respect to the parameters.
+
+    The derivatives are propagated alongside the values (forward-mode automatic
+    differentiation), first through the geometry of the detector and camera
+    with respect to the parameters, then through the dispersion with respect
+    to the resulting rays, which are combined by the chain rule. They are
+    exact, except that the iteration for the refractive index of the prisms
+    (3000 gratings) is differentiated at its fixed point. The derivatives with
+    respect to all the alphap terms take a single pass, as each data point
+    only depends on the term of its slitlet.
+
+    Parameters
+    ----------
+    grating : str
+        Grating name (lower case).
+    p : numpy.ndarray
+        The nparams model parameters.
+    alphap : numpy.ndarray
+        The input angle offset of each slitlet.
+    s, y, x : numpy.ndarray
+        Slitlet, y and x of each data point.
+    free : array_like, optional
+        Indices (in p followed by alphap) of the parameters to differentiate
+        with respect to; the other columns of the Jacobian are zero.
+        Default: None (all parameters).
+
+    Returns
+    -------
+    model : numpy.ndarray
+        The wavelength of each data point.
+    jac : numpy.ndarray
+        The derivatives of the wavelengths, shape (len(x), nparams + len(alphap)).
+    """
+    nall = nparams + len(alphap)
+    jac = np.zeros((len(x), nall))
+    if (s.size == 0) or (y.size == 0) or (x.size == 0):
+        return np.array([]), jac
+    if free is None:
+        free = np.arange(nall)
+    free = np.asarray(free, dtype=int)
+    free_p = free[free < nparams]
+    free_alphap = free[free >= nparams] - nparams
+    ndirs = len(free_p) + (len(free_alphap) > 0)
+
+    # Seed one derivative direction per free model parameter ...
+    pd = [float(v) for v in p[:nparams]]
+    for k, i in enumerate(free_p):
+        pd[i] = _Dual(pd[i], np.eye(ndirs)[:, k:k + 1])
+    # ... and one for the alphap term of the slitlet of each data point
+    alphap_s = np.asarray(alphap, dtype=float)[s - 1]
+    if len(free_alphap) > 0:
+        seed = np.zeros((ndirs, len(x)))
+        seed[-1] = 1.0
+        alphap_s = _Dual(alphap_s, seed)
+
+    # Derivatives of the rays with respect to the parameters
+    rays = list(_trace_to_grating(grating, pd, alphap_s, s, y, x))
+
+    # Where the iteration for the refractive index of the prisms ends
+    model, lambda1 = _disperse(grating, *[_val(r) for r in rays])
+    if lambda1 is not None:
+        rays[4] = lambda1
+
+    # Derivatives of the wavelengths with respect to the rays
+    seeded = [i for i, r in enumerate(rays) if isinstance(r, _Dual)]
+    if lambda1 is not None:
+        seeded.append(4)
+    if len(seeded) == 0:
+        return model, jac
+    ray_vals = [_val(r) for r in rays]
+    for k, i in enumerate(seeded):
+        ray_vals[i] = _Dual(ray_vals[i], np.eye(len(seeded))[:, k:k + 1])
+    dlam = np.broadcast_to(_disperse(grating, *ray_vals, iterate=False)[0].der, (len(seeded), len(x)))
+    if lambda1 is not None:
+        # at the fixed point lambda = F(rays, lambda): dlambda = dF / (1 - dF/dlambda)
+        dlam = dlam[:-1] / (1 - dlam[-1])
+
+    # Chain rule
+    der = np.zeros((ndirs, len(x)))
+    for k, i in enumerate(seeded[:len(dlam)]):
+        der += dlam[k] * rays[i].der
+    jac[:, free_p] = der[:len(free_p)].T
+    for j in free_alphap:
+        args = (s - 1) == j
+        jac[args, nparams + j] = der[-1, args]
+    return model, jac
+
+
+def _prism_normals(Afront, Aback):
+    # We construct the vectors normal to the outwards faces
+    # of the two prisms
+    norm_front = _norm3([_tan(Afront), 0.0, -1.0])
+    norm_back = _norm3([-_tan(Aback), 0.0, -1.0])
+    return norm_front, norm_back
+
+
+def _trace_to_grating(grating, p, alphap_s, s, y, x):
+    # The first part of fitfunc, for plain or _Dual parameters: the direction
+    # (xc, yc, zc) with respect to the focus, in the coordinate system aligned
+    # with the grating, of the light landing at each data point, and its input
+    # angle alpha, with the other quantities that the dispersion depends on
+    # (see _disperse), given the alphap term of each data point.
 
     # Flip x for the blue gratings
     if grating in ['u7000', 'b7000', 'b3000']:
@@ -362,10 +605,6 @@ def fitfunc(grating, p, alphap, s, y, x):
     # Extract parameters (and ignore any extras we might be given)
     (d0, input_alpha, phi, xoc, yoc, r1, r2, r3, fcamera, theta_x, theta_y, xdc, ydc, lambda0, Afront, Aback, rx, ry) = p[:nparams]
 
-    # Calculate these now for later use
-    sinphi = math.sin(phi / 2)
-    cosphi = math.cos(phi / 2)
-
     # Angstroms per line
     a0 = 1.0e7 / d0
 
@@ -377,19 +616,19 @@ def fitfunc(grating, p, alphap, s, y, x):
     yd = pix2mm * y
 
     # The centre of radial distortion in mm
-    xoc *= pix2mm
-    yoc *= pix2mm
+    xoc = xoc * pix2mm
+    yoc = yoc * pix2mm
 
     # Account for radial distortion in x
-    r = np.sqrt((xd - xoc)**2 + (yd - yoc)**2)
-    xu = xd + (xd - xoc) * (r1 * r**2 + r2 * r**4 + r3 * r**6)
+    rsq = (xd - xoc)**2 + (yd - yoc)**2
+    xu = xd + (xd - xoc) * (r1 * rsq + r2 * rsq**2 + r3 * rsq**3)
     yu = yd
 
     # The position in x on the detector where beta0 lands for the central slitlet
-    xdc *= pix2mm
+    xdc = xdc * pix2mm
 
     # The position in y on the detector where gamma=0 lands
-    ydc *= pix2mm
+    ydc = ydc * pix2mm
 
     # Distance in x and y from the position on the detector where
     # beta=beta0 FOR THE CENTRAL SLITLET, and where gamma=0
@@ -400,21 +639,23 @@ def fitfunc(grating, p, alphap, s, y, x):
     z0 = rx * x0**2 + ry * y0**2
 
     # Set up for the rotation of the detector
-    sx = math.sin(theta_x)
-    cx = math.cos(theta_x)
-    sy = math.sin(theta_y)
-    cy = math.cos(theta_y)
+    sx = _sin(theta_x)
+    cx = _cos(theta_x)
+    sy = _sin(theta_y)
+    cy = _cos(theta_y)
 
-    # Rotation by theta_y then theta_x
-    rot_matrix = np.matrix([[cx, sx * sy, sx * cy], [0, cy, -sy], [-sx, cx * sy, cx * cy]])
-    rot_coords = (np.matrix([x0, y0, z0]).T * rot_matrix).getA()
+    # Rotation by theta_y then theta_x, i.e. the row vector (x0, y0, z0) times
+    # [[cx, sx * sy, sx * cy], [0, cy, -sy], [-sx, cx * sy, cx * cy]]
+    rot_x = x0 * cx - z0 * sx
+    rot_y = x0 * (sx * sy) + y0 * cy + z0 * (cx * sy)
+    rot_z = x0 * (sx * cy) - y0 * sy + z0 * (cx * cy)
 
     # Our coordinate system now has z in the direction of the incoming ray where beta=beta0
     # and gamma=0, and x and y in the plane that is orthogonal to that ray where x is in the
     # dispersal direction and y is in the off-axis direction.
 
     # Now translate so that the origin is at the focus
-    rot_coords[:, 2] += fcamera
+    rot_z = rot_z + fcamera
 
     # Now rotate again by gamma=0, then beta0 to bring us to the coordinate system that is aligned
     # with the grating.  Firste we need to work out what beta0 is though.
@@ -424,89 +665,121 @@ def fitfunc(grating, p, alphap, s, y, x):
         # beta0 is the angle of refraction for alpha0 (and remember that it lands
         # on the detector at x=xdc in the central slitlet)
         alpha0 = input_alpha
-        tmpsin = np.clip((lambda0 / a0) - math.sin(alpha0 + phi / 2), -1.0, 1.0)
-        beta0 = -(math.asin(tmpsin) + phi / 2)
+        tmpsin = _clip((lambda0 / a0) - _sin(alpha0 + phi / 2), -1.0, 1.0)
+        beta0 = -(_arcsin(tmpsin) + phi / 2)
     else:
-        # We construct the vectors normal to the outwards faces
-        # of the two prisms
-        norm_front = np.array([math.tan(Afront), 0, -1])
-        norm_front /= np.linalg.norm(norm_front)
-
-        norm_back = np.array([-math.tan(Aback), 0, -1])
-        norm_back /= np.linalg.norm(norm_back)
-
-        # Central wavelength squared
-        l02 = (lambda0 / 1e4)**2
+        norm_front, norm_back = _prism_normals(Afront, Aback)
 
         # Refractive index of prisms at central wavelength
-        n0 = math.sqrt(1 + (A1 * l02 / (l02 - B1)) + (A2 * l02 / (l02 - B2)) + (A3 * l02 / (l02 - B3)))
+        n0 = _sqrt(_sellmeier_n2(lambda0))
 
         # The angle of incidence for the central slitlet
         prism_in_alpha0 = input_alpha
 
         # A unit vector in the direction of the incoming light for the central slitlet.
-        prism_in_light0 = np.array([math.tan(prism_in_alpha0), 0.0, 1])
-        prism_in_light0 /= np.linalg.norm(prism_in_light0)
+        prism_in_light0 = _norm3([_tan(prism_in_alpha0), 0.0, 1.0])
 
         # Light exiting the front prism onto the grating
         # for the central wavelength of the central slitlet
-        grating_in_light0 = snell(nAir, n0, norm_front, prism_in_light0)
+        grating_in_light0 = _snell3(nAir, n0, norm_front, prism_in_light0)
 
         # The angle of incidence on the grating
-        grating_in_alpha0 = math.atan(grating_in_light0[0] / grating_in_light0[2])
+        grating_in_alpha0 = _arctan(grating_in_light0[0] / grating_in_light0[2])
 
         # The angle of diffraction for the central wavelength of the central slitlet.
         # We calculate it using the grating equation
-        tmpsin = np.clip((lambda0 / a0) - math.sin(grating_in_alpha0 + phi / 2), -1.0, 1.0)
-        grating_out_beta0 = math.asin(tmpsin) + phi / 2
+        tmpsin = _clip((lambda0 / a0) - _sin(grating_in_alpha0 + phi / 2), -1.0, 1.0)
+        grating_out_beta0 = _arcsin(tmpsin) + phi / 2
 
         # Turn the angle into a unit vector in the direction of the light exiting the grating
-        grating_out_light0 = np.array([-math.tan(grating_out_beta0), 0.0, 1])
-        grating_out_light0 /= np.linalg.norm(grating_out_light0)
+        grating_out_light0 = _norm3([-_tan(grating_out_beta0), 0.0, 1.0])
 
         # Now calculate the unit vector in the direction of the light exiting the back prism.
-        prism_out_light0 = snell(n0, nAir, norm_back, grating_out_light0)
+        prism_out_light0 = _snell3(n0, nAir, norm_back, grating_out_light0)
 
         # The angle of diffraction as it exits the back prism.
-        prism_out_beta0 = math.atan(prism_out_light0[0] / prism_out_light0[2])
+        prism_out_beta0 = _arctan(prism_out_light0[0] / prism_out_light0[2])
         beta0 = prism_out_beta0
 
     # Set up for the rotation
-    sb = math.sin(beta0)
-    cb = math.cos(beta0)
-
-    # We use gamma=0.  Fitting for non-zero gamma0 proved to be pointless.
-    sg = 0.0
-    cg = 1.0
-
-    # Rotation by gamma=0, then beta0
-    rot_matrix = np.matrix([[cb, sb * sg, sb * cg], [0, cg, -sg], [-sb, cb * sg, cb * cg]])
-    rot_coords = (rot_coords * rot_matrix).getA()
+    sb = _sin(beta0)
+    cb = _cos(beta0)
 
+    # Rotation by gamma=0, then beta0, i.e. times
+    # [[cb, 0, sb], [0, 1, 0], [-sb, 0, cb]]
     # These are our coordinates wrt to the focus.  This means we can read beta and gamma
     # straight out of these through simple geometry.
-    xc = rot_coords[:, 0]
-    yc = rot_coords[:, 1]
-    zc = rot_coords[:, 2]
-
-    cx2 = xc**2 + zc**2
-    cx = np.sqrt(cx2)
-    cy = np.sqrt(cx2 + yc**2)
+    xc = rot_x * cb - rot_z * sb
+    yc = rot_y
+    zc = rot_x * sb + rot_z * cb
 
     # Offset to alpha as a result of the staircase effect
     staircase_offset = (s - 13) * math.atan((15e-3 * 2) / 261)
 
+    # Input angle
+    alpha = input_alpha + staircase_offset + alphap_s
+
+    if grating[1:] == '7000':
+        return xc, yc, zc, alpha, None, a0, phi, None, None
+
+    # A basic guess at lambda
+    lambda1 = x0 / pix2mm + lambda0
+    return xc, yc, zc, alpha, lambda1, a0, phi, Afront, Aback
+
+
+def _prism_angles(lam, norm_front, norm_back, prism_in_light, prism_out_light):
+    # Angles of incidence and diffraction on the grating, at wavelength lam,
+    # of the light through the prisms
+
+    # Calculate refractive index for prisms
+    n2 = _sellmeier_n2(lam)
+
+    # The refractive index calculation can go wrong when lambda gets way out of range.
+    # This only happens for solutions that are not actually sensible, but that's what
+    # you get in the middle of using mpfit.  We avoid NaNs by just pretending the problem
+    # doesn't exist and putting a default value in for n.
+    n2 = _where(_val(n2) <= 0, nAir**2, n2)
+    n = _sqrt(n2)
+
+    # Unit vectors in the direction of light entering the grating
+    grating_in_light = _snell3(nAir, n, norm_front, prism_in_light)
+    cx = _sqrt(grating_in_light[0]**2 + grating_in_light[2]**2)
+    sinalpha = grating_in_light[0] / cx
+    cosalpha = grating_in_light[2] / cx
+
+    # The angle at which light exits the grating (calculated backwards from where it exits the back prism)
+    grating_out_light = [-v for v in _snell3(nAir, n, [-v for v in norm_back], [-v for v in prism_out_light])]
+
+    # Our best estimate at the angle of diffraction
+    cx = _sqrt(grating_out_light[0]**2 + grating_out_light[2]**2)
+    sinbeta = -grating_out_light[0] / cx
+    cosbeta = grating_out_light[2] / cx
+    return sinalpha, cosalpha, sinbeta, cosbeta
+
+
+def _disperse(grating, xc, yc, zc, alpha, lambda1, a0, phi, Afront, Aback, iterate=True):
+    # The second part of fitfunc: the wavelength of the light in direction
+    # (xc, yc, zc), with input angle alpha, from the grating equation. For the
+    # 3000 gratings, the refractive index of the prisms is iterated from the
+    # guess at wavelength lambda1 (or just evaluated at lambda1 if not iterate).
+    # Returns the wavelength and the last lambda1 (None for 7000 gratings).
+
+    # Calculate these now for later use
+    sinphi = _sin(phi / 2)
+    cosphi = _cos(phi / 2)
+
+    cx2 = xc**2 + zc**2
+    cx = _sqrt(cx2)
+    cy = _sqrt(cx2 + yc**2)
+
     # Off axis angle
     cosgamma = cx / cy
 
     # Do we need to worry about the prisms?
     if grating[1:] == '7000':
         # No, it's a 7000 grating
-
-        # Input angle
-        alpha = input_alpha + staircase_offset + alphap[s - 1]
-        sinalpha = np.sin(alpha)
-        cosalpha = np.cos(alpha)
+        sinalpha = _sin(alpha)
+        cosalpha = _cos(alpha)
 
         # Angle of refraction
         sinbeta = xc / cx
@@ -514,58 +787,25 @@ def fitfunc(grating, p, alphap, s, y, x):
 
     else:
         # It's a 3000 grating.  There's some more work to do.
-
-        # A vector of all ones that has the right size
-        ones = np.ones_like(s)
-
-        # A basic guess at lambda
-        lambda1 = x0 / pix2mm + lambda0
-
-        # An estimate of the refractive index
-        l12 = (lambda1 / 1e4)**2
-        n12 = 1 + (A1 * l12 / (l12 - B1)) + (A2 * l12 / (l12 - B2)) + (A3 * l12 / (l12 - B3))
-
-        # The refractive index calculation can go wrong when lambda gets way out of range.
-        # This only happens for solutions that are not actually sensible, but that's what
-        # you get in the middle of using mpfit.  We avoid NaNs by just pretending the problem
-        # doesn't exist and putting a default value in for n.
-        badargs = (n12 <= 0)
-        n12[badargs] = nAir**2
-        n1 = np.sqrt(n12)
-
-        # The angles of incidence for all the other slitlets
-        prism_in_alpha = input_alpha + staircase_offset + alphap[s - 1]
-        tan_prism_in_alpha = np.tan(prism_in_alpha)
+        norm_front, norm_back = _prism_normals(Afront, Aback)
 
         # Unit vectors in the direction of the incoming light for all slitlets.
-        prism_in_light = np.column_stack((tan_prism_in_alpha, yc / zc, ones))
-        prism_in_light = norm_vector(prism_in_light)
-
-        # Light exiting the front prism onto the grating for all slitlets
-        grating_in_light = snell(nAir, n1, norm_front, prism_in_light)
-
-        # The angle of incidence on the grating
-        cx = np.sqrt(grating_in_light[:, 0]**2 + grating_in_light[:, 2]**2)
-        sinalpha = grating_in_light[:, 0] / cx
-        cosalpha = grating_in_light[:, 2] / cx
+        prism_in_light = _norm3([_tan(alpha), yc / zc, 1.0])
 
         # Construct a unit vector in the direction of light exiting the back prism
-        prism_out_light = np.column_stack((-rot_coords[:, 0], rot_coords[:, 1], rot_coords[:, 2]))
-        prism_out_light = norm_vector(prism_out_light)
+        prism_out_light = _norm3([-xc, yc, zc])
 
         # Now that we have vectors for all the light exiting the back prism, we can work
         # backwards to find out where this light exited the grating.
         # This gives us the angle of diffraction from the grating.
-        grating_out_light = -snell(nAir, n1, -norm_back, -prism_out_light)
-        cx = np.sqrt(grating_out_light[:, 0]**2 + grating_out_light[:, 2]**2)
-        sinbeta = -grating_out_light[:, 0] / cx
-        cosbeta = grating_out_light[:, 2] / cx
+        sinalpha, cosalpha, sinbeta, cosbeta = _prism_angles(
+            lambda1, norm_front, norm_back, prism_in_light, prism_out_light)
 
         # Now we take an iterative approach.  We need to know lambda in order to calculate the
         # refractive index of the prisms.  But we need to calculate the refraction through the
         # prisms in order to calculate lambda.  Our initial estimates are good enough, and the
         # calculations converge quickly.
-        finished = False
+        finished = not iterate
         count = 0
         maxCount = 7
         while (not finished) and (count < maxCount):
@@ -575,42 +815,19 @@ def fitfunc(grating, p, alphap, s, y, x):
             sin_alpha_p_phi_on_2 = sinalpha * cosphi + cosalpha * sinphi
             sin_beta_m_phi_on_2 = sinbeta * cosphi - cosbeta * sinphi
             lambda1 = a0 * (sin_alpha_p_phi_on_2 + sin_beta_m_phi_on_2) * cosgamma
-            max_change = np.max(np.abs(lambda1 - lambdaold))
+            max_change = np.max(np.abs(_val(lambda1) - _val(lambdaold)))
 
             # If the solution has converged to better than 1 Angstrom then this is our
             # last iteration
             if (max_change < 1):
                 finished = True
 
-            # Calculate refractive index for prisms
-            l2 = (lambda1 / 1e4)**2
-            n2 = 1 + (A1 * l2 / (l2 - B1)) + (A2 * l2 / (l2 - B2)) + (A3 * l2 / (l2 - B3))
-
-            # The refractive index calculation can go wrong when lambda gets way out of range.
-            # This only happens for solutions that are not actually sensible, but that's what
-            # you get in the middle of using mpfit.  We avoid NaNs by just pretending the problem
-            # doesn't exist and putting a default value in for n.
-            badargs = (n2 <= 0)
-            n2[badargs] = nAir**2
-            n = np.sqrt(n2)
-
-            # Unit vectors in the direction of light entering the grating
-            grating_in_light = snell(nAir, n, norm_front, prism_in_light)
-            cx = np.sqrt(grating_in_light[:, 0]**2 + grating_in_light[:, 2]**2)
-            sinalpha = grating_in_light[:, 0] / cx
-            cosalpha = grating_in_light[:, 2] / cx
-
-            # The angle at which light exits the grating (calculated backwards from where it exits the back prism)
-            grating_out_light = -snell(nAir, n, -norm_back, -prism_out_light)
-
-            # Our best estimate at the angle of diffraction
-            cx = np.sqrt(grating_out_light[:, 0]**2 + grating_out_light[:, 2]**2)
-            sinbeta = -grating_out_light[:, 0] / cx
-            cosbeta = grating_out_light[:, 2] / cx
+            sinalpha, cosalpha, sinbeta, cosbeta = _prism_angles(
+                lambda1, norm_front, norm_back, prism_in_light, prism_out_light)
 
     sin_alpha_p_phi_on_2 = sinalpha * cosphi + cosalpha * sinphi
     sin_beta_m_phi_on_2 = sinbeta * cosphi - cosbeta * sinphi
-    return a0 * (sin_alpha_p_phi_on_2 + sin_beta_m_phi_on_2) * cosgamma
+    return a0 * (sin_alpha_p_phi_on_2 + sin_beta_m_phi_on_2) * cosgamma, lambda1
 
 
 def errfunc(grating, p, alphap, s, y, x, a):
@@ -1,8 +1,10 @@
 from __future__ import division, print_function
 from astropy.coordinates import SkyCoord
 from astropy.io import fits as pyfits
+from astropy.stats import sigma_clip
 import astropy.units as u
 import gc
+import hashlib
 from matplotlib import colormaps as cm, colors
 import matplotlib.gridspec as gridspec
 import matplotlib.pyplot as plt
@@ -13,15 +15,19 @@ import re
 import scipy.interpolate as interp
 import scipy.ndimage as ndimage
 import scipy.signal as signal
+import scipy.sparse as sparse
+import scipy.spatial as spatial
+import shutil
 import sys
 
 # Pipeline imports
-from pywifes.multiprocessing_utils import get_task, map_tasks
+from pywifes.multiprocessing_utils import get_task, map_tasks, map_tasks_threaded
 from pywifes.wifes_metadata import __version__, metadata_dir
-from pywifes.wifes_imtrans import transform_data, detransform_data
+from pywifes.wifes_imtrans import get_rectifier
 from pywifes.wifes_wsol import fit_wsol_poly, evaluate_wsol_poly
 from pywifes.wifes_adr import ha_degrees, dec_dms2dd, adr_x_y
-from pywifes.wifes_utils import arguments, fits_scale_from_bitpix, is_halfframe, is_taros, nan_helper
+from pywifes.wifes_utils import arguments, fits_scale_from_bitpix, get_file_hash, get_file_names, is_halfframe, \
+    is_taros, nan_helper, unpack_files, write_fits
 from pywifes.mpfit import mpfit
 
 # ------------------------------------------------------------------------
@@ -107,6 +113,9 @@ def cut_fits_to_half_frame(inimg_path, outimg_prefix="cut_", to_taros=False):
 
         outimg_path = os.path.join(dir_name, outimg_prefix + file_name)
         print("Writing the cut data to the new FITS file:", outimg_path)
+        # Never write through a link to a staged raw frame
+        if os.path.islink(outimg_path):
+            os.remove(outimg_path)
 
         # Write the cut data to the new FITS file
         cut_hdu.writeto(outimg_path, overwrite=True)
@@ -143,6 +152,11 @@ def calib_to_half_frame(obs_metadata, temp_data_dir, to_taros=False):
     calib_types = ["domeflat", "twiflat", "wire", "arc", "bias", "dark"]
     prefix = "cut_"
 
+    # Decompress any calibrations staged in compressed form
+    unpack_files(temp_data_dir,
+                 [fn for calib_type in calib_types for fn in obs_metadata[calib_type]]
+                 + (obs_metadata["std"][0]["sci"] if obs_metadata["std"] else []))
+
     for calib_type in calib_types:
         file_list = obs_metadata[calib_type]
         for index, file_name in enumerate(file_list):
@@ -226,15 +240,37 @@ def blockwise_mean_3D(A, S):
     return A.reshape(m, S[0], n, S[1], r, S[2]).mean((1, 3, 5))
 
 
+# ------------------------------------------------------------------------
+def _read_scaled_rows(hdu, rows):
+    """
+    Read `rows` of an image HDU opened with `do_not_scale_image_data=True`,
+    applying BSCALE/BZERO to just those rows so memory-mapped inputs are
+    never scaled in full.
+    """
+    data = numpy.asarray(hdu.data[rows], dtype="d")
+    bscale = hdu.header.get("BSCALE", 1.0)
+    bzero = hdu.header.get("BZERO", 0.0)
+    if bscale != 1.0:
+        data *= bscale
+    if bzero != 0.0:
+        data += bzero
+    return data
+
+
 # ------------------------------------------------------------------------
 def imcombine(inimg_list, outimg, method="median", nonzero_thresh=100., scale=None,
               data_hdu=0, kwstring=None, commstring=None, outvarimg=None, sregion=None,
               plot=False, plot_dir='.', save_prefix='imcombine_inputs',
-              interactive_plot=False, debug=False,
+              interactive_plot=False, clip_sigma=3.0, clip_iters=5, nlow=1, nhigh=1,
+              max_memory_mb=1024., debug=False,
               ):
     """
     Combine multiple images into a single image using a specified method.
 
+    Each input is memory-mapped once and the stack is combined in strips of
+    rows sized to fit within `max_memory_mb`, so the peak memory use does not
+    grow with the number of inputs.
+
     Parameters
     ----------
     inimg_list : list
@@ -242,7 +278,13 @@ def imcombine(inimg_list, outimg, method="median", nonzero_thresh=100., scale=No
     outimg : str
         The path to the output image.
     method : str, optional
-        The method 'median', 'sum', or 'mean' to be used for combining the images. Default is 'median'.
+        The method 'median', 'sum', 'mean', 'clipped_mean', 'minmax' or
+        'weighted_mean' to be used for combining the images. 'clipped_mean' is
+        the mean after iterative sigma-clipping about the median, 'minmax' is
+        the mean after rejecting the `nlow` lowest and `nhigh` highest values
+        of each pixel (or the median, for pixels with no more than `nlow` +
+        `nhigh` valid values), and 'weighted_mean' weights each (scaled) input by its
+        inverse pixel-to-pixel noise variance. Default is 'median'.
     scale : str, optional
         The scaling method to be used, 'median', 'median_nonzero', 'exptime' or None. Default is None.
     data_hdu : int, optional
@@ -254,7 +296,8 @@ def imcombine(inimg_list, outimg, method="median", nonzero_thresh=100., scale=No
         Header keyword comment to add to output.
         Default: None.
     outvarimg : str, optional
-        Filename of variance image to output (if defined).
+        Filename of variance image to output (if defined). This is the variance
+        of the input values retained for each pixel (weighted, for 'weighted_mean').
         Default: None.
     sregion : list, optional
         List defining image x-axis region in which to compute scaling (if a scaling method is defined).
@@ -272,6 +315,22 @@ def imcombine(inimg_list, outimg, method="median", nonzero_thresh=100., scale=No
     interactive_plot : bool, optional
         Whether to interrupt processing to provide interactive plot to user.
         Default: False.
+    clip_sigma : float, optional
+        Clipping threshold (in standard deviations) for 'clipped_mean'.
+        Default: 3.0.
+    clip_iters : int, optional
+        Maximum number of clipping iterations for 'clipped_mean'.
+        Default: 5.
+    nlow : int, optional
+        Number of lowest values rejected per pixel for 'minmax'.
+        Default: 1.
+    nhigh : int, optional
+        Number of highest values rejected per pixel for 'minmax'.
+        Default: 1.
+    max_memory_mb : float, optional
+        Approximate memory budget (in MB) for the stack of input rows being
+        combined at once.
+        Default: 1024.
     debug : bool, optional
         Whether to report the parameters used in this function call.
         Default: False.
@@ -281,136 +340,184 @@ def imcombine(inimg_list, outimg, method="median", nonzero_thresh=100., scale=No
     """
     if debug:
         print(arguments())
+    if method not in ["median", "sum", "mean", "clipped_mean", "minmax", "weighted_mean"]:
+        raise ValueError("combine method not yet supported")
     inimg_list.sort()
-    # read in data from inimg_list[0] to get image size
+    # output takes its headers from the first input
     f = pyfits.open(inimg_list[0])
     outfits = pyfits.HDUList(f)
-    orig_data = f[data_hdu].data
     bin_x, bin_y = [int(b) for b in f[data_hdu].header["CCDSUM"].split()]
 
     nimg = len(inimg_list)
     midrow_shift = 80 // bin_y if is_taros(inimg_list[0]) and is_halfframe(inimg_list[0]) else 0
+    # memory-map every input once, reading raw values so only the rows in use are scaled
+    in_hdus = [pyfits.open(fn, memmap=True, do_not_scale_image_data=True)
+               for fn in inimg_list]
     try:
+        in_data = [h[data_hdu] for h in in_hdus]
+        ny, nx = in_data[0].data.shape
+        midrow_idx = ny // 2 - midrow_shift
         scale_factor = numpy.ones(nimg)
         if scale is not None:
             # Do a loop over the images to determine scale factors
             if scale == "midrow_ratio":
-                midrow = orig_data[orig_data.shape[0] // 2 - midrow_shift, :]
+                midrow = _read_scaled_rows(in_data[0], midrow_idx)
             for i in range(nimg):
-                f = pyfits.open(inimg_list[i])
-                new_data = f[data_hdu].data
                 if sregion is None:
                     sreg_min = 0
-                    sreg_max = new_data.shape[1]
+                    sreg_max = nx
                 else:
                     sreg_min, sreg_max = [int(s) for s in sregion]
-                if scale == "median":
-                    scale_factor[i] = numpy.nanmedian(new_data[:, sreg_min:sreg_max], )
-                elif scale == "median_nonzero":
-                    nonzero_inds = numpy.nonzero(new_data[:, sreg_min:sreg_max] > nonzero_thresh)
-                    scale_factor[i] = numpy.nanmedian(new_data[:, sreg_min:sreg_max][nonzero_inds])
-                elif scale == "exptime":
-                    scale_factor[i] = f[data_hdu].header["EXPTIME"]
-                elif re.match("percentile", scale):
-                    perc = float(scale.split("percentile")[1])
-                    scale_factor[i] = numpy.nanpercentile(new_data[:, sreg_min:sreg_max], perc)
-                elif scale == "midrow_ratio":
+                if scale == "midrow_ratio":
                     if i == 0:
                         scale_factor[i] = 1.0
                     else:
-                        scale_factor[i] = numpy.nanmedian(new_data[new_data.shape[0] // 2 - midrow_shift, :] / midrow)
+                        scale_factor[i] = numpy.nanmedian(_read_scaled_rows(in_data[i], midrow_idx) / midrow)
+                elif scale == "exptime":
+                    scale_factor[i] = in_data[i].header["EXPTIME"]
                 else:
-                    raise ValueError("scaling method not yet supported")
+                    new_data = _read_scaled_rows(in_data[i], slice(None))[:, sreg_min:sreg_max]
+                    if scale == "median":
+                        scale_factor[i] = numpy.nanmedian(new_data)
+                    elif scale == "median_nonzero":
+                        nonzero_inds = numpy.nonzero(new_data > nonzero_thresh)
+                        scale_factor[i] = numpy.nanmedian(new_data[nonzero_inds])
+                    elif re.match("percentile", scale):
+                        perc = float(scale.split("percentile")[1])
+                        scale_factor[i] = numpy.nanpercentile(new_data, perc)
+                    else:
+                        raise ValueError("scaling method not yet supported")
+                    del new_data
                 if debug:
                     print(f"Scaling down image {inimg_list[i]} by {scale_factor[i]}")
-        ny, nx = numpy.shape(orig_data)
-        # chunk in x-axis if more than equivalent of 5 unbinned full-frame images
-        chunks = int(numpy.ceil(nimg / (5. * bin_x * 4112. / ny)))
-        coadd_data = numpy.zeros_like(orig_data)
-        if outvarimg is not None:
-            var_arr = numpy.zeros_like(orig_data)
-        else:
-            var_arr = None
-        # gather data for all
+
+        # gather header data for all
         exptime_list = []
         airmass_list = []
-        for ch in range(chunks):
-            xmin = ch * nx // chunks
-            xmax = min((ch + 1) * nx // chunks, nx)
+        for i in range(nimg):
+            hdr = in_data[i].header
+            exptime_list.append(hdr["EXPTIME"])
+            if hdr["IMAGETYP"].upper() in ["ARC", "BIAS", "FLAT", "SKYFLAT", "WIRE", "ZERO"]:
+                airmass_list.append(1.0)
+            else:
+                try:
+                    airmass_list.append(hdr["AIRMASS"])
+                except Exception as air_err:
+                    print(
+                        f"Failed to get airmass for {hdr['IMAGETYP'].upper()} image {inimg_list[i]}: {air_err}"
+                    )
+                    airmass_list.append(1.0)
+
+        if method == "weighted_mean":
+            # inverse variance of the pixel-to-pixel noise of each scaled input,
+            # estimated robustly from x-differences on a sample of rows
+            sample_rows = numpy.unique(numpy.linspace(0, ny - 1, min(ny, 64)).astype(int))
+            weights = numpy.zeros(nimg)
+            for i in range(nimg):
+                diff = numpy.diff(_read_scaled_rows(in_data[i], sample_rows) / scale_factor[i], axis=1)
+                mad = numpy.nanmedian(numpy.abs(diff - numpy.nanmedian(diff)))
+                noise_var = (1.4826 * mad) ** 2 / 2.0
+                weights[i] = 1.0 / noise_var if noise_var > 0 else 0.0
+            if not numpy.any(weights > 0):
+                weights[:] = 1.0
             if debug:
-                print(f"Chunk {ch+1}: xrange=[{xmin}:{xmax}]")
-            coadd_arr = numpy.zeros([ny, xmax - xmin, nimg], dtype="d")
+                print(f"Relative weights: {weights / numpy.amax(weights)}")
+
+        # rows per strip, allowing for the temporary copies made while combining
+        strip_rows = int(max_memory_mb * 2**20 // (4 * 8 * nimg * nx))
+        strip_rows = min(max(strip_rows, 1), ny)
+        if debug:
+            print(f"Combining in strips of {strip_rows} rows")
+        coadd_data = numpy.zeros([ny, nx], dtype="d")
+        if outvarimg is not None:
+            var_arr = numpy.zeros([ny, nx], dtype="d")
+        else:
+            var_arr = None
+        if plot or interactive_plot:
+            plot_rows = numpy.zeros([nimg, nx], dtype="d")
+        for ymin in range(0, ny, strip_rows):
+            ymax = min(ymin + strip_rows, ny)
+            coadd_arr = numpy.zeros([nimg, ymax - ymin, nx], dtype="d")
             for i in range(nimg):
-                f = pyfits.open(inimg_list[i])
-                new_data = f[data_hdu].data[:, xmin:xmax]
-                if ch == 0:
-                    exptime_list.append(f[data_hdu].header["EXPTIME"])
-                    if f[data_hdu].header["IMAGETYP"].upper() in ["ARC", "BIAS", "FLAT", "SKYFLAT", "WIRE", "ZERO"]:
-                        airmass_list.append(1.0)
-                    else:
-                        try:
-                            airmass_list.append(f[data_hdu].header["AIRMASS"])
-                        except Exception as air_err:
-                            print(
-                                f"Failed to get airmass for {f[data_hdu].header['IMAGETYP'].upper()} image {inimg_list[i]}: {air_err}"
-                            )
-                            airmass_list.append(1.0)
-                f.close()
-                coadd_arr[:, :, i] = new_data / scale_factor[i]
-                gc.collect()
-            if plot or interactive_plot:
-                offset = 0.05
-                fig = plt.figure()
-                ax1 = fig.add_subplot(2, 1, 1)
-                ax2 = fig.add_subplot(2, 1, 2)
-                for i in range(coadd_arr.shape[2]):
-                    ax1.plot(coadd_arr[ny // 2 - midrow_shift, :, i] + offset * i)
-                    ax2.plot(coadd_arr[ny // 2 - midrow_shift, :, i])
-                ax2.set_xlabel("pixel")
-                ax1.set_ylabel(f"Counts with {offset}*i offsets")
-                ax2.set_ylabel("Counts as scaled")
-                ax1.set_title(f"{nimg} inputs ({scale}-scaled) for\n{os.path.basename(outimg)} ({method}-combined)")
-                if interactive_plot:
-                    plt.show()
-                else:
-                    ax1.set_xlim(0, coadd_arr.shape[1] // 4)
-                    ax1.set_ylim(numpy.nanpercentile(coadd_arr[ny // 2 - midrow_shift, 0:coadd_arr.shape[1] // 4, :], 1),
-                                 numpy.nanpercentile(coadd_arr[ny // 2 - midrow_shift, 0:coadd_arr.shape[1] // 4, :] + offset * nimg, 99))
-                    ax2.set_xlim(int(0.75 * coadd_arr.shape[1]), coadd_arr.shape[1])
-                    ax2.set_ylim(numpy.nanpercentile(coadd_arr[ny // 2 - midrow_shift, int(0.75 * coadd_arr.shape[1]):coadd_arr.shape[1], :], 1),
-                                 numpy.nanpercentile(coadd_arr[ny // 2 - midrow_shift, int(0.75 * coadd_arr.shape[1]):coadd_arr.shape[1], :], 99))
-                    plt.tight_layout()
-                    if chunks > 1:
-                        plot_name = f"{save_prefix}_chunk{ch+1}.png"
-                    else:
-                        plot_name = f"{save_prefix}.png"
-                    plot_path = os.path.join(plot_dir, plot_name)
-                    plt.savefig(plot_path, dpi=300)
-                    plt.close()
+                coadd_arr[i] = _read_scaled_rows(in_data[i], slice(ymin, ymax)) / scale_factor[i]
+            if (plot or interactive_plot) and ymin <= midrow_idx < ymax:
+                plot_rows[:] = coadd_arr[:, midrow_idx - ymin, :]
 
             # now combine
             if method == "median":
-                coadd_data[:, xmin:xmax] = numpy.nanmedian(coadd_arr, axis=2)
+                coadd_data[ymin:ymax] = numpy.nanmedian(coadd_arr, axis=0)
             elif method == "sum":
-                coadd_data[:, xmin:xmax] = numpy.nansum(coadd_arr, axis=2)
+                coadd_data[ymin:ymax] = numpy.nansum(coadd_arr, axis=0)
             elif method == "mean":
-                coadd_data[:, xmin:xmax] = numpy.nanmean(coadd_arr, axis=2)
-            else:
-                raise ValueError("combine method not yet supported")
+                coadd_data[ymin:ymax] = numpy.nanmean(coadd_arr, axis=0)
+            elif method == "clipped_mean":
+                coadd_arr = sigma_clip(coadd_arr, sigma=clip_sigma, maxiters=clip_iters,
+                                       axis=0, masked=False, copy=False)
+                coadd_data[ymin:ymax] = numpy.nanmean(coadd_arr, axis=0)
+            elif method == "minmax":
+                # NaNs sort to the end, so the valid values of each pixel come first
+                coadd_arr.sort(axis=0)
+                nvalid = numpy.sum(numpy.isfinite(coadd_arr), axis=0)
+                # pixels with too few valid values to reject nlow + nhigh of them
+                # keep them all and take their median instead
+                few = nvalid <= nlow + nhigh
+                if numpy.any(few):
+                    few_median = numpy.nanmedian(coadd_arr[:, few], axis=0)
+                rank = numpy.arange(nimg)[:, None, None]
+                coadd_arr[((rank < nlow) | (rank >= nvalid - nhigh)) & ~few] = numpy.nan
+                coadd_data[ymin:ymax] = numpy.nanmean(coadd_arr, axis=0)
+                if numpy.any(few):
+                    coadd_data[ymin:ymax][few] = few_median
+            elif method == "weighted_mean":
+                pix_weights = weights[:, None, None] * numpy.isfinite(coadd_arr)
+                weight_sum = numpy.sum(pix_weights, axis=0)
+                weight_sum[weight_sum == 0] = numpy.nan
+                wmean = numpy.nansum(coadd_arr * pix_weights, axis=0) / weight_sum
+                coadd_data[ymin:ymax] = wmean
             # Create the variance image, if requested
             if outvarimg is not None:
-                var_arr[:, xmin:xmax] = numpy.nanvar(coadd_arr, axis=2, dtype="float64")
+                if method == "weighted_mean":
+                    var_arr[ymin:ymax] = numpy.nansum(pix_weights * (coadd_arr - wmean) ** 2, axis=0) / weight_sum
+                else:
+                    var_arr[ymin:ymax] = numpy.nanvar(coadd_arr, axis=0, dtype="float64")
+
+        if plot or interactive_plot:
+            offset = 0.05
+            fig = plt.figure()
+            ax1 = fig.add_subplot(2, 1, 1)
+            ax2 = fig.add_subplot(2, 1, 2)
+            for i in range(nimg):
+                ax1.plot(plot_rows[i] + offset * i)
+                ax2.plot(plot_rows[i])
+            ax2.set_xlabel("pixel")
+            ax1.set_ylabel(f"Counts with {offset}*i offsets")
+            ax2.set_ylabel("Counts as scaled")
+            ax1.set_title(f"{nimg} inputs ({scale}-scaled) for\n{os.path.basename(outimg)} ({method}-combined)")
+            if interactive_plot:
+                plt.show()
+            else:
+                ax1.set_xlim(0, nx // 4)
+                ax1.set_ylim(numpy.nanpercentile(plot_rows[:, 0:nx // 4], 1),
+                             numpy.nanpercentile(plot_rows[:, 0:nx // 4].T + offset * nimg, 99))
+                ax2.set_xlim(int(0.75 * nx), nx)
+                ax2.set_ylim(numpy.nanpercentile(plot_rows[:, int(0.75 * nx):nx], 1),
+                             numpy.nanpercentile(plot_rows[:, int(0.75 * nx):nx], 99))
+                plt.tight_layout()
+                plot_path = os.path.join(plot_dir, f"{save_prefix}.png")
+                plt.savefig(plot_path, dpi=300)
+                plt.close()
 
     except Exception as e:
         print(f"An error occurred in imcombine: {str(e)}")
         raise
+    finally:
+        last_hdr = in_hdus[-1][data_hdu].header
+        for h in in_hdus:
+            h.close()
     outfits[data_hdu].data = coadd_data.astype("float32", casting="same_kind")
     outfits[data_hdu].scale("float32")
     # fix ephemeris data if images are co-added!!!
     if method == "sum" and scale is None:
-        f2 = pyfits.open(inimg_list[-1])
-        last_hdr = f2[data_hdu].header
-        f2.close()
         # HAEND, ZDEND, EXPTIME
         outfits[data_hdu].header.set("EXPTIME", numpy.sum(exptime_list))
         outfits[data_hdu].header.set("LSTEND", last_hdr["LSTEND"])
@@ -429,21 +536,66 @@ def imcombine(inimg_list, outimg, method="median", nonzero_thresh=100., scale=No
         outfits[data_hdu].scale("float64")
         outfits.writeto(outvarimg, overwrite=True)
     f.close()
-    gc.collect()
     return
 
 
+# ------------------------------------------------------------------------
+def _combine_mef_extension(in_data_list, exptime_list, hdu_type, scale, method):
+    """
+    Combine one SCI, VAR or DQ extension of the inputs to imcombine_mef.
+    """
+    nimg = len(in_data_list)
+    ny, nx = numpy.shape(in_data_list[0])
+    coadd_arr = numpy.zeros([ny, nx, nimg], dtype="d")
+    # gather data for all
+    for i in range(nimg):
+        new_data = in_data_list[i]
+        if hdu_type == 'dq':
+            scale_factor = 1
+        else:
+            if scale is None:
+                scale_factor = 1.0
+            elif scale == "per_slice_median":
+                scale_factor = numpy.nanmedian(new_data)
+            elif scale == "exptime":
+                scale_factor = exptime_list[i]
+            else:
+                raise ValueError(f"scaling method '{scale}' not yet supported")
+        coadd_arr[:, :, i] = new_data / scale_factor
+    # now combine
+    if hdu_type == 'dq':
+        return numpy.nansum(coadd_arr, axis=2)
+    # For variances, the median is not formally correct, but perhaps not too bad
+    if method == "median":
+        coadd_data = numpy.nanmedian(coadd_arr, axis=2)
+    elif method == "sum":
+        # Propagate any NaNs in the inputs into a NaN output
+        coadd_data = numpy.sum(coadd_arr, axis=2)
+    elif method == "nansafesum":
+        # NaN-safe sum using the mean of the finite pixels and the number of inputs.
+        # Only sensible to use if sources are very well aligned between exposures and
+        # have consistent count levels (by scaling or otherwise)
+        coadd_data = numpy.nanmean(coadd_arr, axis=2) * nimg
+    else:
+        raise ValueError(f"combine method '{method}' not yet supported")
+    return coadd_data
+
+
 # ------------------------------------------------------------------------
 def imcombine_mef(
     inimg_list,
     outimg,
     scale=None,
     method="median",
+    max_threads=-1,
     debug=False,
 ):
     """
     Combine multiple images into a single image using a specified method.
 
+    Each input is opened once (memory-mapped) and the extensions are combined
+    in parallel on a pool of threads.
+
     Parameters
     ----------
     inimg_list : list
@@ -457,6 +609,10 @@ def imcombine_mef(
         The method to be used for combining the images. Options are 'median', 'sum',
         'nansafesum'.
         Default: 'median'.
+    max_threads : int, optional
+        Maximum number of threads used to combine extensions (-1 uses all
+        available cores).
+        Default: -1.
     debug : bool, optional
         Whether to report the parameters used in this function call.
         Default: False.
@@ -483,85 +639,58 @@ def imcombine_mef(
     dq_hdu_list = list(range(2 * nslits + 1, 3 * nslits + 1))
     n_ext = len(f)
 
-    for data_hdu, hdu_type in list(zip(data_hdu_list, ('data' for _ in data_hdu_list))) \
-            + list(zip(var_hdu_list, ('var' for _ in var_hdu_list))) \
-            + list(zip(dq_hdu_list, ('dq' for _ in dq_hdu_list))):
-        orig_data = f[data_hdu].data
-        ny, nx = numpy.shape(orig_data)
-        coadd_arr = numpy.zeros([ny, nx, nimg], dtype="d")
-        # gather data for all
-        for i in range(nimg):
-            f2 = pyfits.open(inimg_list[i])
-            new_data = f2[data_hdu].data
-            exptime = f2[data_hdu].header["EXPTIME"]
-            f2.close()
-            if hdu_type == 'dq':
-                scale_factor = 1
-            else:
-                if scale is None:
-                    scale_factor = 1.0
-                elif scale == "per_slice_median":
-                    scale_factor = numpy.nanmedian(new_data)
-                elif scale == "exptime":
-                    scale_factor = exptime
-                else:
-                    raise ValueError(f"scaling method '{scale}' not yet supported")
-            coadd_arr[:, :, i] = new_data / scale_factor
-            gc.collect()
-        # now combine
+    # open every input once; the (memory-mapped) arrays are gathered here so
+    # that the worker threads never touch the shared file handles
+    in_hdus = [pyfits.open(fn, memmap=True) for fn in inimg_list]
+    ext_list = list(zip(data_hdu_list, ('data' for _ in data_hdu_list))) \
+        + list(zip(var_hdu_list, ('var' for _ in var_hdu_list))) \
+        + list(zip(dq_hdu_list, ('dq' for _ in dq_hdu_list)))
+    tasks = []
+    for data_hdu, hdu_type in ext_list:
+        tasks.append(get_task(
+            _combine_mef_extension,
+            [h[data_hdu].data for h in in_hdus],
+            [h[data_hdu].header["EXPTIME"] for h in in_hdus],
+            hdu_type,
+            scale,
+            method,
+        ))
+    # keep the VAR precision of the inputs (float64, or float32 intermediates)
+    var_dtype = in_hdus[0][var_hdu_list[0]].data.dtype
+    try:
+        results = map_tasks_threaded(tasks, max_threads=max_threads)
+    finally:
+        primary_hdrs = [h[0].header for h in in_hdus]
+        for h in in_hdus:
+            h.close()
+
+    for (data_hdu, hdu_type), coadd_data in zip(ext_list, results):
         if hdu_type == 'data':
-            if method == "median":
-                coadd_data = numpy.nanmedian(coadd_arr, axis=2)
-            elif method == "sum":
-                # Propagate any NaNs in the inputs into a NaN output
-                coadd_data = numpy.sum(coadd_arr, axis=2)
-            elif method == "nansafesum":
-                # NaN-safe sum using the mean of the finite pixels and the number of inputs.
-                # Only sensible to use if sources are very well aligned between exposures and
-                # have consistent count levels (by scaling or otherwise)
-                coadd_data = numpy.nanmean(coadd_arr, axis=2) * nimg
-            else:
-                raise ValueError(f"combine method '{method}' not yet supported")
             outfits[data_hdu].data = coadd_data.astype("float32", casting="same_kind")
             outfits[data_hdu].scale("float32")
         elif hdu_type == 'var':
-            if method == "median":
-                # Not formally correct, but perhaps not too bad
-                coadd_data = numpy.nanmedian(coadd_arr, axis=2)
-            elif method == "sum":
-                # Propagate any NaNs in the inputs into a NaN output
-                coadd_data = numpy.sum(coadd_arr, axis=2)
-            elif method == "nansafesum":
-                # NaN-safe sum using the mean of the finite pixels and the number of inputs.
-                # Only sensible to use if sources are very well aligned between exposures and
-                # have consistent count levels (by scaling or otherwise)
-                coadd_data = numpy.nanmean(coadd_arr, axis=2) * nimg
-            else:
-                raise ValueError(f"combine method '{method}' not yet supported")
-            outfits[data_hdu].data = coadd_data.astype("float64", casting="same_kind")
-            outfits[data_hdu].scale("float64")
+            outfits[data_hdu].data = coadd_data.astype(var_dtype, casting="same_kind")
+            outfits[data_hdu].scale(var_dtype.name)
         elif hdu_type == 'dq':
-            coadd_data = numpy.nansum(coadd_arr, axis=2)
             # trim data beyond range
             coadd_data[coadd_data > 32767] = 32767
             coadd_data[coadd_data < -32768] = -32768
             outfits[data_hdu].data = coadd_data.astype("int16", casting="unsafe")
             outfits[data_hdu].scale("int16")
-        gc.collect()
     # fix ephemeris data if images are co-added!!!
     if method == "sum" and scale is None:
         mjdobs_list = []
         airmass_list = []
         exptime_list = []
         for i in range(nimg):
-            f2 = pyfits.getheader(inimg_list[i], ext=0)
+            f2 = primary_hdrs[i]
             if "AIRMASS" in f2:
                 airmass_list.append(f2["AIRMASS"])
             if "EXPTIME" in f2:
                 exptime_list.append(f2["EXPTIME"])
             if "MJD-OBS" in f2:
                 mjdobs_list.append(f2["MJD-OBS"])
-        last_hdr = pyfits.getheader(inimg_list[numpy.argsort(mjdobs_list)[-1]], ext=0)
+        last_hdr = primary_hdrs[numpy.argsort(mjdobs_list)[-1]]
         # Update HAEND, ZDEND, EXPTIME in each extension
         for i in range(n_ext):
             outfits[i].header.set("EXPTIME", numpy.sum(exptime_list))
@@ -608,6 +737,9 @@ def imarith_mef(inimg1, operator, inimg2, outimg):
     """
     Performs arithmetic operations between two multi-extension images.
 
+    The inputs are memory-mapped, and the VAR extensions keep the precision of
+    the first input (float64, or float32 intermediates).
+
     Parameters
     ----------
     inimg1 : str
@@ -636,8 +768,8 @@ def imarith_mef(inimg1, operator, inimg2, outimg):
     dq_hdu_list = range(2 * nslits + 1, 3 * nslits + 1)
 
     # read in data from the two images, set up the output hdu
-    f1 = pyfits.open(inimg1)
-    f2 = pyfits.open(inimg2)
+    f1 = pyfits.open(inimg1, memmap=True)
+    f2 = pyfits.open(inimg2, memmap=True)
     outfits = pyfits.HDUList(f1)
 
     # PART 1 - data HDUs
@@ -655,9 +787,7 @@ def imarith_mef(inimg1, operator, inimg2, outimg):
             op_data = data1 / data2
         else:
             raise ValueError
-        outfits[data_hdu].data = op_data.astype("float32", casting="same_kind")
-        outfits[data_hdu].scale("float32")
-        gc.collect()
+        outfits[data_hdu].data = op_data.astype("float32", casting="same_kind", copy=False)
 
     # PART 2 - var HDUs
     # NOTE: var_hdu_list must correspond directly with data_hdu_list!!
@@ -669,6 +799,7 @@ def imarith_mef(inimg1, operator, inimg2, outimg):
             data2 = f2[data_hdu].data
         except Exception:
             continue
+        var_dtype = var1.dtype
         # do the desired operation
         if (operator == "+") or (operator == "-"):
             op_var = var1 + var2
@@ -678,9 +809,7 @@ def imarith_mef(inimg1, operator, inimg2, outimg):
             op_var = var1 / (data2**2) + var2 * ((data1 / (data2**2)) ** 2)
         else:
             raise ValueError
-        outfits[var_hdu].data = op_var.astype("float64", casting="same_kind")
-        outfits[var_hdu].scale("float64")
-        gc.collect()
+        outfits[var_hdu].data = op_var.astype(var_dtype, casting="same_kind", copy=False)
 
     # PART 3 - dq HDUs
     for dq_hdu in dq_hdu_list:
@@ -694,9 +823,7 @@ def imarith_mef(inimg1, operator, inimg2, outimg):
         # trim data beyond range
         op_dq[op_dq > 32767] = 32767
         op_dq[op_dq < -32768] = -32768
-        outfits[dq_hdu].data = op_dq.astype("int16", casting="unsafe")
-        outfits[dq_hdu].scale("int16")
-        gc.collect()
+        outfits[dq_hdu].data = op_dq.astype("int16", casting="unsafe", copy=False)
 
     # (5) write to outfile!
     outfits[0].header.set("PYWIFES", __version__, "PyWiFeS version")
@@ -735,6 +862,11 @@ def scaled_imarith_mef(inimg1, operator, inimg2, outimg, scale=None,
     -------
     None
         This function does not return any value. It writes the combined image to the output file.
+
+    Notes
+    -----
+    The inputs are memory-mapped, and the VAR extensions keep the precision of
+    the first input (float64, or float32 intermediates).
     """
     if arg_scaled not in ["first", "second"]:
         raise ValueError(f"Unknown arg_scaled value '{arg_scaled}'. Must be 'first' or 'second'.")
@@ -751,8 +883,8 @@ def scaled_imarith_mef(inimg1, operator, inimg2, outimg, scale=None,
     var_hdu_list = range(nslits + 1, 2 * nslits + 1)
     dq_hdu_list = range(2 * nslits + 1, 3 * nslits + 1)
     # read in data from the two images, set up the output hdu
-    f1 = pyfits.open(inimg1)
-    f2 = pyfits.open(inimg2)
+    f1 = pyfits.open(inimg1, memmap=True)
+    f2 = pyfits.open(inimg2, memmap=True)
     outfits = pyfits.HDUList(f1)
     # calculate the scale factor!
     if isinstance(scale, (float, int)):
@@ -783,14 +915,13 @@ def scaled_imarith_mef(inimg1, operator, inimg2, outimg, scale=None,
             op_data = data1 / data2
         else:
             raise ValueError
-        # trim data beyond range
-        outfits[data_hdu].data = op_data.astype("float32", casting="same_kind")
-        outfits[data_hdu].scale("float32")
+        outfits[data_hdu].data = op_data.astype("float32", casting="same_kind", copy=False)
     # PART 2 - var HDUs
     # NOTE: var_hdu_list must correspond directly with data_hdu_list!!
     for i in range(len(var_hdu_list)):
         var_hdu = var_hdu_list[i]
         data_hdu = data_hdu_list[i]
+        var_dtype = f1[var_hdu].data.dtype
         if arg_scaled == "first":
             var1 = f1[var_hdu].data / (scale_factor**2)
             var2 = f2[var_hdu].data
@@ -810,8 +941,7 @@ def scaled_imarith_mef(inimg1, operator, inimg2, outimg, scale=None,
             op_var = var1 / (data2**2) + var2 * ((data1 / (data2**2)) ** 2)
         else:
             raise ValueError
-        outfits[var_hdu].data = op_var.astype("float64", casting="same_kind")
-        outfits[var_hdu].scale("float64")
+        outfits[var_hdu].data = op_var.astype(var_dtype, casting="same_kind", copy=False)
     # PART 3 - dq HDUs
     for dq_hdu in dq_hdu_list:
         dq1 = f1[dq_hdu].data
@@ -821,8 +951,7 @@ def scaled_imarith_mef(inimg1, operator, inimg2, outimg, scale=None,
         # trim data beyond range
         op_dq[op_dq > 32767] = 32767
         op_dq[op_dq < -32768] = -32768
-        outfits[dq_hdu].data = op_dq.astype("int16", casting="unsafe")
-        outfits[dq_hdu].scale("int16")
+        outfits[dq_hdu].data = op_dq.astype("int16", casting="unsafe", copy=False)
     # (5) write to outfile!
     outfits[0].header.set("PYWIFES", __version__, "PyWiFeS version")
     if scale is not None:
@@ -1033,6 +1162,8 @@ def imcopy(inimg, outimg):
     """
     Copy one image to a new filename.
 
+    The file is copied byte for byte, without reading it into memory.
+
     Parameters
     ----------
     inimg : str
@@ -1044,10 +1175,7 @@ def imcopy(inimg, outimg):
     -------
     None
     """
-    f = pyfits.open(inimg)
-    outfits = pyfits.HDUList(f)
-    outfits.writeto(outimg, overwrite=True)
-    f.close()
+    shutil.copyfile(inimg, outimg)
     return
 
 
@@ -1413,6 +1541,7 @@ def subtract_overscan(
     omaskfile=None,
     omask_threshold=500.0,
     match_binning=None,
+    header_overrides=None,
     interactive_plot=False,
     verbose=False,
     debug=False,
@@ -1444,6 +1573,9 @@ def subtract_overscan(
         Threshold above which to mask pixels from overscan fit. Threshold is per-row mean ADU relative to row with lowest mean. Default is 500.
     match_binning : str, optional
         If not None, will expand/contract binning to the specified 'x y' format.
+    header_overrides : dict, optional
+        Dictionary of {keyword: value} corrections to the input header (e.g. from
+        `data_classifier.get_header_overrides`) to write to the output. Default is None.
     interactive_plot : bool, optional
         Whether to interrupt processing to provide interactive plot to user. Default is False.
     verbose : bool
@@ -1630,6 +1762,9 @@ def subtract_overscan(
     else:
         outfits[data_hdu].header.set('PYWOVERM', False, "PyWiFeS: used overscan mask")
     outfits[data_hdu].header.set('PYWOSUB', numpy.mean(avg_oscan), "PyWiFeS: mean overscan subtracted")
+    if header_overrides is not None:
+        for key, val in header_overrides.items():
+            outfits[data_hdu].header.set(key, val)
     outfits[data_hdu].data = subbed_data.astype("float32", casting="same_kind")
     outfits[data_hdu].scale("float32")
     # (5) write to outfile!
@@ -3056,7 +3191,7 @@ def interslice_cleanup(
 
 def wifes_slitlet_mef(
     inimg, outimg, data_hdu=0, bin_x=None, bin_y=None, slitlet_def_file=None,
-    nan_method="interp", repl_val=0.0, debug=False,
+    nan_method="interp", repl_val=0.0, var_dtype="float64", debug=False,
 ):
     """
     Create multi-extension FITS file from a single input image.
@@ -3082,6 +3217,9 @@ def wifes_slitlet_mef(
         "replace" (replace with constant value). Default is "interp".
     repl_val : float, optional
         Constant to replace NaN values with if "method" = "replace". Default is 0.0.
+    var_dtype : str, optional
+        Data type of the VAR extensions: "float64", or "float32" to halve their size
+        in the intermediate files. Later steps keep this precision. Default is "float64".
     debug : bool, optional
         Whether to report the parameters used in this function call. Default is False.
 
@@ -3236,11 +3374,10 @@ def wifes_slitlet_mef(
         var_data = var_img[mod_defs[2]:mod_defs[3], mod_defs[0]:mod_defs[1]]
         # create fits hdu
         hdu_name = "VAR%d" % i
-        new_hdu = pyfits.ImageHDU(var_data.astype("float64", casting="same_kind"), old_hdr, name=hdu_name)
+        new_hdu = pyfits.ImageHDU(var_data.astype(var_dtype, casting="same_kind"), old_hdr, name=hdu_name)
         new_hdu.header.set("DETSEC", dim_str)
         new_hdu.header.set("DATASEC", dim_str)
         new_hdu.header.set("TRIMSEC", dim_str)
-        new_hdu.scale('float64')
         outfits.append(new_hdu)
         gc.collect()
     # DATA QUALITY EXTENSIONS
@@ -3301,6 +3438,7 @@ def wifes_slitlet_mef_ns(
     slitlet_def_file=None,
     nan_method="interp",
     repl_val=0.0,
+    var_dtype="float64",
     debug=False,
 ):
     """
@@ -3330,6 +3468,10 @@ def wifes_slitlet_mef_ns(
     repl_val : float, optional
         If 'nan_method'='replace', replace bad (NaN) pixels with the specified value.
         Default: 0.0.
+    var_dtype : str, optional
+        Data type of the VAR extensions: 'float64', or 'float32' to halve their size
+        in the intermediate files. Later steps keep this precision.
+        Default: "float64".
     debug : bool, optional
         Whether to report the parameters used in this function call.
         Default: False.
@@ -3527,14 +3669,13 @@ def wifes_slitlet_mef_ns(
         obj_var[-ykill:, :] *= 0.0
         # create fits hdu for object variance
         hdu_name = "VAR%d" % (i + 1)
-        obj_hdu = pyfits.ImageHDU(obj_var.astype("float64", casting="same_kind"), old_hdr, name=hdu_name)
+        obj_hdu = pyfits.ImageHDU(obj_var.astype(var_dtype, casting="same_kind"), old_hdr, name=hdu_name)
         obj_hdu.header.set("DETSEC", obj_dim_str)
         obj_hdu.header.set("DATASEC", obj_dim_str)
         obj_hdu.header.set("TRIMSEC", obj_dim_str)
         # fix the exposure time!!
         exptime_true = float(old_hdr["EXPTIME"])
         obj_hdu.header.set("EXPTIME", exptime_true, comment="Total NS exposure time")
-        obj_hdu.scale("float64")
         outfits_obj.append(obj_hdu)
         # ------------------
         # get the sky data
@@ -3560,14 +3701,13 @@ def wifes_slitlet_mef_ns(
         sky_var[-ykill:, :] *= 0.0
         # create fits hdu for sky variance
         hdu_name = "VAR%d" % (i + 1)
-        sky_hdu = pyfits.ImageHDU(sky_var.astype("float64", casting="same_kind"), old_hdr, name=hdu_name)
+        sky_hdu = pyfits.ImageHDU(sky_var.astype(var_dtype, casting="same_kind"), old_hdr, name=hdu_name)
         sky_hdu.header.set("DETSEC", sky_dim_str)
         sky_hdu.header.set("DATASEC", sky_dim_str)
         sky_hdu.header.set("TRIMSEC", sky_dim_str)
         # fix the exposure time!!
         exptime_true = float(old_hdr["EXPTIME"])
         sky_hdu.header.set("EXPTIME", exptime_true, comment="Total NS exposure time")
-        sky_hdu.scale("float64")
         outfits_sky.append(sky_hdu)
         gc.collect()
     # ------------------------------------
@@ -3728,18 +3868,16 @@ def wifes_response_pixel(inimg, outimg, wsol_fn=None, debug=False):
         orig_data = f[curr_hdu].data
         # rectify data!
         if wsol_fn is not None:
-            f3 = pyfits.open(wsol_fn)
-            wave = f3[curr_hdu].data
-            f3.close()
+            rectifier = get_rectifier(wsol_fn, curr_hdu)
             print("Transforming data for Slitlet %d" % (curr_hdu + first))
-            rect_data = transform_data(orig_data, wave)
+            rect_data = rectifier.transform(orig_data)
             curr_ff_rowwise_ave = numpy.nanmedian(rect_data, axis=0)
             curr_ff_illum = numpy.nanmedian(rect_data / curr_ff_rowwise_ave, axis=1)
             curr_model = (
                 (numpy.ones(numpy.shape(rect_data)) * curr_ff_rowwise_ave)
                 * curr_ff_illum.T[:, numpy.newaxis]
             )
-            orig_model = detransform_data(curr_model, orig_data, wave)
+            orig_model = rectifier.detransform(curr_model)
             normed_data = orig_data / orig_model
         else:
             curr_ff_rowwise_ave = numpy.nanmedian(orig_data, axis=0)
@@ -3829,10 +3967,7 @@ def wifes_response_poly(
 
     midslice_data = f[mid_slit_idx].data
     if wsol_fn is not None:
-        f3 = pyfits.open(wsol_fn)
-        wave = f3[mid_slit_idx].data
-        f3.close()
-        rect_data, lam_array = transform_data(midslice_data, wave, return_lambda=True)
+        rect_data, lam_array = get_rectifier(wsol_fn, mid_slit_idx).transform(midslice_data, return_lambda=True)
     else:
         rect_data = midslice_data
         lam_array = numpy.arange(len(rect_data[0, :]), dtype="d")
@@ -3868,15 +4003,13 @@ def wifes_response_poly(
         orig_data = f[curr_hdu].data
         # rectify data!
         if wsol_fn is not None:
-            f3 = pyfits.open(wsol_fn)
-            wave = f3[curr_hdu].data
-            f3.close()
+            rectifier = get_rectifier(wsol_fn, curr_hdu)
             print("Transforming data for Slitlet %d" % (first + i))
-            rect_data, lam_array = transform_data(orig_data, wave, return_lambda=True)
+            rect_data, lam_array = rectifier.transform(orig_data, return_lambda=True)
             curr_norm_array = 10.0 ** (numpy.polyval(smooth_poly, lam_array))
-            curr_norm_array_noxform = detransform_data(numpy.tile(curr_norm_array, (orig_data.shape[1], 1)), orig_data, wave)
+            curr_norm_array_noxform = rectifier.detransform(numpy.tile(curr_norm_array, (orig_data.shape[0], 1)))
             init_normed_data = rect_data / curr_norm_array
-            normed_data = detransform_data(init_normed_data, orig_data, wave)
+            normed_data = rectifier.detransform(init_normed_data)
             if i == mid_slit_idx:
                 with open(shape_fn, 'w') as of:
                     for smooth_row in range(lam_array.shape[0]):
@@ -3898,8 +4031,8 @@ def wifes_response_poly(
         outfits[curr_hdu].scale("float32")
         if zero_var:
             var_hdu = curr_hdu + nslits
-            outfits[var_hdu].data = (0.0 * outfits[var_hdu].data).astype("float64", casting="same_kind")
-            outfits[var_hdu].scale("float64")
+            # keep the VAR precision of the input
+            outfits[var_hdu].data = 0.0 * outfits[var_hdu].data
         # need to fit this for each slitlet
     outfits[0].header.set("PYWIFES", __version__, "PyWiFeS version")
     outfits[0].header.set("PYWRESIN", "dome only", "PyWiFeS: flatfield inputs")
@@ -4033,12 +4166,8 @@ def wifes_2dim_response(
     midslice_data = f1[mid_slit_idx].data
 
     if wsol_fn is not None:
-        f3 = pyfits.open(wsol_fn)
-        wave = f3[mid_slit_idx].data
-        f3.close()
-
-        rect_data, mid_lam_array = transform_data(
-            midslice_data, wave, return_lambda=True
+        rect_data, mid_lam_array = get_rectifier(wsol_fn, mid_slit_idx).transform(
+            midslice_data, return_lambda=True
         )
     else:
         rect_data = midslice_data
@@ -4090,10 +4219,7 @@ def wifes_2dim_response(
     midslice_data = f2[mid_slit_idx].data
 
     if wsol_fn is not None:
-        f3 = pyfits.open(wsol_fn)
-        wave = f3[mid_slit_idx].data
-        f3.close()
-        rect_data = transform_data(midslice_data, wave)
+        rect_data = get_rectifier(wsol_fn, mid_slit_idx).transform(midslice_data)
     else:
         rect_data = midslice_data
     # fit polynomial to median data
@@ -4117,20 +4243,16 @@ def wifes_2dim_response(
 
         # rectify data!
         if wsol_fn is not None:
-            f3 = pyfits.open(wsol_fn)
-            wave = f3[curr_hdu].data
-            f3.close()
+            rectifier = get_rectifier(wsol_fn, curr_hdu)
+            wave = rectifier.wave
 
             # convert the *x* pixels to lambda
-            dw = numpy.abs(wave[:, 1:] - wave[:, :-1])
-            full_dw = numpy.zeros(numpy.shape(wave))
-            full_dw[:, 1:] = dw
-            full_dw[:, 0] = dw[:, 0]
+            full_dw = rectifier.full_dw
             print("Transforming data for Slitlet %d" % (i + first))
 
             # SPECTRAL FLAT
-            rect_spec_data, lam_array = transform_data(
-                orig_spec_data, wave, return_lambda=True
+            rect_spec_data, lam_array = rectifier.transform(
+                orig_spec_data, return_lambda=True
             )
 
             curr_norm_array = 10.0 ** (numpy.polyval(smooth_poly, lam_array))
@@ -4157,7 +4279,7 @@ def wifes_2dim_response(
             next_normed_data[:, force_idx] = 1.
 
             # SPATIAL FLAT
-            rect_spat_data = transform_data(orig_spat_data, wave, return_lambda=False)
+            rect_spat_data = rectifier.transform(orig_spat_data, return_lambda=False)
             # alt_dw = lam_array[1] - lam_array[0]
             alt_flat_spec = spat_interp(lam_array)
             alt_flat_spec[alt_flat_spec <= 0] = numpy.nan
@@ -4189,7 +4311,7 @@ def wifes_2dim_response(
             spat_flat = numpy.nanmedian(spat_ratio[:, xstart:xstop], axis=1)
             # transform back
             final_normed_data = next_normed_data * spat_flat.T[:, numpy.newaxis]
-            normed_data = detransform_data(final_normed_data, orig_spec_data, wave)
+            normed_data = rectifier.detransform(final_normed_data)
             normed_data[numpy.nonzero(normed_data < resp_min)] = resp_min
         else:
             lam_array = numpy.arange(len(orig_spec_data[0, :]), dtype="d")
@@ -4214,8 +4336,8 @@ def wifes_2dim_response(
         illum[:, i] = numpy.nanmedian(normed_data, axis=1)
         if zero_var:
             var_hdu = curr_hdu + nslits
-            outfits[var_hdu].data = (0.0 * outfits[var_hdu].data).astype("float64", casting="same_kind")
-            outfits[var_hdu].scale("float64")
+            # keep the VAR precision of the input
+            outfits[var_hdu].data = 0.0 * outfits[var_hdu].data
         # need to fit this for each slitlet
 
     outfits[0].header.set("PYWIFES", __version__, "PyWiFeS version")
@@ -4440,13 +4562,12 @@ def wifes_SG_response(
 
         # rectify twilight data to take consistent wavelength regions
         if wsol_fn is not None:
-            f3 = pyfits.open(wsol_fn)
-            wave = f3[curr_hdu].data
-            f3.close()
+            rectifier = get_rectifier(wsol_fn, curr_hdu)
+            wave = rectifier.wave
 
             # SPATIAL FLAT
             if spatial_inimg is not None:
-                rect_spat_data, lam_array = transform_data(orig_spat_data, wave, return_lambda=True)
+                rect_spat_data, lam_array = rectifier.transform(orig_spat_data, return_lambda=True)
                 # define limits in untransformed coordinates
                 lam_min = numpy.amin((wave[:, 1500 // bin_x], wave[:, 2000 // bin_x]), axis=0)
                 lam_max = numpy.amax((wave[:, 1500 // bin_x], wave[:, 2000 // bin_x]), axis=0)
@@ -4485,8 +4606,8 @@ def wifes_SG_response(
         outfits[curr_hdu].scale("float32")
         if zero_var:
             var_hdu = curr_hdu + nslits
-            outfits[var_hdu].data = (0.0 * outfits[var_hdu].data).astype("float64", casting="same_kind")
-            outfits[var_hdu].scale("float64")
+            # keep the VAR precision of the input
+            outfits[var_hdu].data = 0.0 * outfits[var_hdu].data
 
     outfits[0].header.set("PYWIFES", __version__, "PyWiFeS version")
     if spatial_inimg is not None:
@@ -4788,15 +4909,139 @@ def derive_wifes_wire_solution(
     return
 
 
-def _scale_grid_data(
-    points, values, xi, method="linear", fill_value=0, scale_factor=1.0
-):
-    return (
-        numpy.abs(scale_factor)
-        * interp.griddata(
-            points, values, xi, method=method, fill_value=fill_value
-        ).T
+def _build_resampling_operator(points, xi):
+    """
+    Build the operators that resample values known at scattered input points onto
+    a set of output points.
+
+    The Delaunay triangulation of the input points is computed only once and turned
+    into a sparse matrix of barycentric weights (equivalent to linear interpolation
+    with scipy.interpolate.griddata), together with the index of the input point
+    nearest to each output point (equivalent to nearest-neighbour interpolation).
+
+    Parameters
+    ----------
+    points : tuple of numpy.ndarray
+        Flattened coordinates of the input data points.
+    xi : tuple of numpy.ndarray
+        Coordinates of the output points.
+
+    Returns
+    -------
+    weights : scipy.sparse.csr_matrix
+        Linear interpolation weights with shape (number of output points, number of
+        input points). Output points outside the convex hull of the input points
+        have empty rows.
+    nearest : numpy.ndarray
+        Index of the nearest input point for each output point.
+    """
+    in_points = numpy.column_stack(points)
+    out_points = numpy.column_stack([numpy.ravel(x) for x in xi])
+    tri = spatial.Delaunay(in_points)
+    simplex = tri.find_simplex(out_points)
+    inside = simplex >= 0
+    trans = tri.transform[simplex[inside]]
+    bary = numpy.einsum("ijk,ik->ij", trans[:, :2, :], out_points[inside] - trans[:, 2, :])
+    bary = numpy.column_stack([bary, 1.0 - numpy.sum(bary, axis=1)])
+    indptr = numpy.zeros(out_points.shape[0] + 1, dtype=numpy.int64)
+    indptr[1:] = numpy.cumsum(3 * inside)
+    weights = sparse.csr_matrix(
+        (bary.ravel(), tri.simplices[simplex[inside]].ravel(), indptr),
+        shape=(out_points.shape[0], in_points.shape[0]),
     )
+    nearest = spatial.cKDTree(in_points).query(out_points)[1]
+    return weights, nearest
+
+
+def _apply_resampling_operator(operator, flux, var, dq, out_shape, scale_factor=1.0):
+    """
+    Resample flux, variance and DQ values with an operator from
+    _build_resampling_operator.
+
+    Flux is linearly interpolated, variance is propagated with the squared weights,
+    and DQ takes the value of the nearest input point.
+
+    Parameters
+    ----------
+    operator : tuple
+        The (weights, nearest) pair returned by _build_resampling_operator.
+    flux, var, dq : numpy.ndarray
+        Flattened values at the input points.
+    out_shape : tuple
+        Shape of the output coordinate arrays.
+    scale_factor : float, optional
+        Multiplicative scaling of the flux (and its square for the variance).
+        Default is 1.0.
+
+    Returns
+    -------
+    tuple of numpy.ndarray
+        The resampled flux, variance and DQ, each transposed from out_shape.
+    """
+    weights, nearest = operator
+    out_flux = numpy.abs(scale_factor) * (weights @ flux).reshape(out_shape).T
+    out_var = scale_factor**2 * (weights.power(2) @ var).reshape(out_shape).T
+    out_dq = dq[nearest].reshape(out_shape).T
+    return out_flux, out_var, out_dq
+
+
+def _shift_along_slitlets(cube, shift, kind="linear", fill_value=0.0):
+    """
+    Shift every wavelength plane of a cube along the slitlet (x) axis by a
+    wavelength-dependent amount, interpolating all planes at once.
+
+    The first and last slitlets are repeated once beyond each edge before
+    interpolating, and output positions beyond those padded edges take the
+    fill value.
+
+    Parameters
+    ----------
+    cube : numpy.ndarray
+        Data with shape (nx, ny, nlam).
+    shift : numpy.ndarray
+        Shift (in slitlet units) to apply at each wavelength, with shape (nlam,).
+    kind : str, optional
+        Interpolation type, either "linear" or "nearest". Default is "linear".
+    fill_value : float, optional
+        Value for output positions beyond the padded edges. Default is 0.0.
+
+    Returns
+    -------
+    numpy.ndarray
+        The shifted cube, with the same shape as the input.
+    """
+    nx, ny, nlam = cube.shape
+    padded = numpy.concatenate([cube[:1], cube, cube[-1:]], axis=0)
+    # Position of each output slitlet in the padded input, per wavelength
+    pos = numpy.arange(nx, dtype="d")[:, None] + 1.0 + numpy.asarray(shift, dtype="d")[None, :]
+    valid = (pos >= 0.0) & (pos <= nx + 1.0)
+    pos = numpy.clip(pos, 0.0, nx + 1.0)
+    iy = numpy.arange(ny)[None, :, None]
+    ilam = numpy.arange(nlam)[None, None, :]
+    if kind == "nearest":
+        # Ties go to the lower slitlet, as for interp1d
+        idx = numpy.ceil(pos - 0.5).astype(int)
+        out = padded[idx[:, None, :], iy, ilam]
+    else:
+        lo = numpy.minimum(numpy.floor(pos).astype(int), nx)
+        frac = (pos - lo)[:, None, :]
+        out = padded[lo[:, None, :], iy, ilam]
+        out = out + (padded[lo[:, None, :] + 1, iy, ilam] - out) * frac
+    return numpy.where(valid[:, None, :], out, fill_value)
+
+
+def _prune_operator_cache(cache_dir, max_entries):
+    """
+    Remove the least recently used resampling operators from a cache directory,
+    keeping at most max_entries.
+    """
+    cached = [os.path.join(cache_dir, fn) for fn in get_file_names(cache_dir, "*.pkl")]
+    cached.sort(key=os.path.getmtime, reverse=True)
+    for fn in cached[max(max_entries, 0):]:
+        try:
+            os.remove(fn)
+        except FileNotFoundError:
+            pass
 
 
 # -------------------------------------------------------------
@@ -4821,6 +5066,8 @@ def generate_wifes_cube(
     multithread=False,
     max_processes=-1,
     print_progress=False,
+    operator_cache_dir=None,
+    operator_cache_size=4,
     debug=False,
 ):
     """
@@ -4872,6 +5119,15 @@ def generate_wifes_cube(
         Default is -1.
     print_progress : bool, optional
         Write interpolation progress to screen/log. Default is False.
+    operator_cache_dir : str, optional
+        Directory in which to store the resampling operators, keyed by the contents
+        of the wavelength and wire solutions and the cube geometry, so later frames
+        with the same geometry can skip the triangulation. When adr is True, the
+        y refraction is part of the operators, so the key also holds the pointing
+        and observing conditions. If None, operators are not cached. Default is None.
+    operator_cache_size : int, optional
+        Largest number of operator sets kept in operator_cache_dir; the least
+        recently used are removed. Default is 4.
     debug : bool, optional
         Whether to report the parameters used in this function call. Default is False.
 
@@ -5061,8 +5317,41 @@ def generate_wifes_cube(
     var_data_cube_tmp = numpy.ones([nx, ny, nlam])
     dq_data_cube_tmp = numpy.ones([nx, ny, nlam])
 
+    # ---------------------------
+    # Look for resampling operators saved by a previous frame with the same geometry
+    cached_operators = None
+    new_operators = []
+    cache_fn = None
+    if operator_cache_dir is not None:
+        cache_key = [
+            get_file_hash(wsol_fn),
+            get_file_hash(wire_fn) if wire_fn and os.path.isfile(wire_fn) else "N/A",
+            wmin_set, wmax_set, dw_set, wavelength_ref, wave_native, subsample,
+            bin_x, bin_y, ny_orig, offset_orig, nslits, ndy_orig, ndx_orig,
+            # the y refraction is part of the operators
+            (secz, ha, dec, lat, telpa, sso_temp, sso_pres, sso_wvp) if adr else None,
+        ]
+        cache_fn = os.path.join(
+            operator_cache_dir,
+            hashlib.sha256(repr(cache_key).encode()).hexdigest() + ".pkl",
+        )
+        if os.path.isfile(cache_fn):
+            try:
+                with open(cache_fn, "rb") as f:
+                    cached_operators = pickle.load(f)
+                if len(cached_operators) != nx:
+                    raise ValueError(f"expected {nx} operators, found {len(cached_operators)}")
+                # mark as recently used
+                os.utime(cache_fn)
+                if verbose:
+                    print(f" Using cached resampling operators {os.path.basename(cache_fn)}")
+            except Exception as e:
+                print(f"Could not use cached resampling operators {cache_fn}: {e}")
+                cached_operators = None
+
     if multithread:
         tasks = []
+        slit_data = []
 
     # First interpolation : Wavelength + y (=wire & ADR)
     if verbose:
@@ -5100,180 +5389,113 @@ def generate_wifes_cube(
         full_dw[:, 1:] = dw
         full_dw[:, 0] = dw[:, 0]
         for ii in range(int(numpy.ceil(i * subsample)), int(numpy.ceil((i + 1) * subsample))):
-            # and *y* to real y
-            curr_wire = wire_trans[ii, :]
-            all_ypos = full_y - curr_wire - wire_offset
-
             # from the y-lambda-flux data, interpolate the flux
             # for the desired output y-lambda grid
-            wave_flat = wave.flatten()
-            all_ypos_flat = all_ypos.flatten()
             curr_flux_flat = (curr_flux / full_dw).flatten()
             curr_var_flat = (curr_var / full_dw**2).flatten()
             curr_dq_flat = curr_dq.flatten()
-            # Calculate the ADR corrections (this is slow)
-            if adr:
-                adr_corr = adr_x_y(
-                    wave_flat, secz=secz, objha=ha, objdec=dec, tellat=lat, teltemp=sso_temp, telpres=sso_pres, telwvp=sso_wvp, telpa=telpa, ref_wl=5600.
-                )
-                adr_y = adr_corr[1] * 0.5 * float(bin_y)
-                all_ypos_flat -= adr_y
 
-            if multithread:
-                # Create tasks to calculate flux, var, and dq.
-                flux_task = get_task(
-                    _scale_grid_data,
-                    (wave_flat, all_ypos_flat),
-                    curr_flux_flat,
-                    (out_lambda_full, out_y_full),
-                    method="linear",
-                    scale_factor=disp_ave,
-                )
-
-                var_task = get_task(
-                    _scale_grid_data,
-                    (wave_flat, all_ypos_flat),
-                    curr_var_flat,
-                    (out_lambda_full, out_y_full),
-                    method="linear",
-                    scale_factor=disp_ave**2,
-                )
-
-                dq_task = get_task(
-                    _scale_grid_data,
-                    (wave_flat, all_ypos_flat),
-                    curr_dq_flat,
-                    (out_lambda_full, out_y_full),
-                    method="nearest",
-                    fill_value=1.0,
-                    scale_factor=1.0,
-                )
-
-                tasks.append(flux_task)
-                tasks.append(var_task)
-                tasks.append(dq_task)
-
-            else:  # not multithread
-                # Does the interpolation (this is equally slow ...)
-                flux_data_cube_tmp[ii, :, :] = _scale_grid_data(
-                    (wave_flat, all_ypos_flat),
-                    curr_flux_flat,
-                    (out_lambda_full, out_y_full),
-                    method="linear",
-                    scale_factor=disp_ave,
-                )
-
-                var_data_cube_tmp[ii, :, :] = _scale_grid_data(
+            if cached_operators is not None:
+                operator = cached_operators[ii]
+            else:
+                # and *y* to real y
+                curr_wire = wire_trans[ii, :]
+                all_ypos = full_y - curr_wire - wire_offset
+                wave_flat = wave.flatten()
+                all_ypos_flat = all_ypos.flatten()
+                # Calculate the ADR corrections (this is slow)
+                if adr:
+                    adr_corr = adr_x_y(
+                        wave_flat, secz=secz, objha=ha, objdec=dec, tellat=lat, teltemp=sso_temp, telpres=sso_pres, telwvp=sso_wvp, telpa=telpa, ref_wl=5600.
+                    )
+                    adr_y = adr_corr[1] * 0.5 * float(bin_y)
+                    all_ypos_flat -= adr_y
+
+                if multithread:
+                    # Build the resampling operators in parallel, apply them afterwards
+                    tasks.append(get_task(
+                        _build_resampling_operator,
+                        (wave_flat, all_ypos_flat),
+                        (out_lambda_full, out_y_full),
+                    ))
+                    slit_data.append((curr_flux_flat, curr_var_flat, curr_dq_flat))
+                    continue
+
+                # Triangulate once, then resample flux, var, and dq
+                operator = _build_resampling_operator(
                     (wave_flat, all_ypos_flat),
-                    curr_var_flat,
                     (out_lambda_full, out_y_full),
-                    method="linear",
-                    scale_factor=disp_ave**2,
                 )
+                if cache_fn is not None:
+                    new_operators.append(operator)
+
+            (
+                flux_data_cube_tmp[ii, :, :],
+                var_data_cube_tmp[ii, :, :],
+                dq_data_cube_tmp[ii, :, :],
+            ) = _apply_resampling_operator(
+                operator,
+                curr_flux_flat,
+                curr_var_flat,
+                curr_dq_flat,
+                out_lambda_full.shape,
+                scale_factor=disp_ave,
+            )
 
-                dq_data_cube_tmp[ii, :, :] = _scale_grid_data(
-                    (wave_flat, all_ypos_flat),
-                    curr_dq_flat,
-                    (out_lambda_full, out_y_full),
-                    method="nearest",
-                    fill_value=1.0,
-                    scale_factor=1.0,
-                )
+            if print_progress:
+                sys.stdout.flush()
+                sys.stdout.write("\r\r %d" % (ii / (numpy.ceil(nslits * subsample)) * 100.0) + "%")
+                sys.stdout.flush()
+                if ii == int(numpy.ceil(nslits * subsample)) - 1:
+                    sys.stdout.write("\n")
+    if multithread and cached_operators is None:
+        new_operators = map_tasks(tasks, max_processes=max_processes)
+        for ii, (operator, (curr_flux_flat, curr_var_flat, curr_dq_flat)) in enumerate(zip(new_operators, slit_data)):
+            (
+                flux_data_cube_tmp[ii, :, :],
+                var_data_cube_tmp[ii, :, :],
+                dq_data_cube_tmp[ii, :, :],
+            ) = _apply_resampling_operator(
+                operator,
+                curr_flux_flat,
+                curr_var_flat,
+                curr_dq_flat,
+                out_lambda_full.shape,
+                scale_factor=disp_ave,
+            )
 
-                if print_progress:
-                    sys.stdout.flush()
-                    sys.stdout.write("\r\r %d" % (ii / (numpy.ceil(nslits * subsample)) * 100.0) + "%")
-                    sys.stdout.flush()
-                    if ii == int(numpy.ceil(nslits * subsample)) - 1:
-                        sys.stdout.write("\n")
-    if multithread:
-        results = map_tasks(tasks, max_processes=max_processes)
-        for i in range(int(numpy.ceil(nslits * subsample))):
-            flux_data_cube_tmp[i, :, :] = results[3 * i]
-            var_data_cube_tmp[i, :, :] = results[3 * i + 1]
-            dq_data_cube_tmp[i, :, :] = results[3 * i + 2]
+    if cache_fn is not None and cached_operators is None:
+        # Write to a temporary file first, so other processes never read a partial cache
+        os.makedirs(operator_cache_dir, exist_ok=True)
+        tmp_cache_fn = f"{cache_fn}.{os.getpid()}.tmp"
+        with open(tmp_cache_fn, "wb") as f:
+            pickle.dump(new_operators, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_cache_fn, cache_fn)
+        _prune_operator_cache(operator_cache_dir, operator_cache_size)
 
     f4.close()
 
     # Second interpolation : x (=ADR)
     if adr:
-        # To avoid interpolation issues at the edges,
-        # add two extra values on either side (repeating each of the endpoints).
-        in_x = numpy.arange(-1, int(numpy.ceil(nslits * subsample)) + 1, 1, dtype="d")
-        out_x = numpy.arange(int(numpy.ceil(nslits * subsample)), dtype="d")
         if verbose:
             print(" -> Step 2: interpolating along x (1D interp.)")
-        for i in range(0, nlam):
-            # Adopting same default parameters as above
-            adr_corr = adr_x_y(
-                numpy.array([out_lambda[i]]),
-                secz=secz,
-                objha=ha,
-                objdec=dec,
-                tellat=lat,
-                teltemp=sso_temp,
-                telpres=sso_pres,
-                telwvp=sso_wvp,
-                telpa=telpa,
-                ref_wl=5600.
-            )
-            adr_x = adr_corr[0]
-            for j in range(0, ny):
-                # here is the actual appending of endpoint data
-                this_flux = numpy.append(
-                    numpy.append(
-                        flux_data_cube_tmp[0, j, i], flux_data_cube_tmp[:nx, j, i]
-                    ),
-                    flux_data_cube_tmp[nx - 1, j, i],
-                )
-                this_var = numpy.append(
-                    numpy.append(
-                        var_data_cube_tmp[0, j, i], var_data_cube_tmp[:nx, j, i]
-                    ),
-                    var_data_cube_tmp[nx - 1, j, i],
-                )
-                this_dq = numpy.append(
-                    numpy.append(
-                        dq_data_cube_tmp[0, j, i], dq_data_cube_tmp[:nx, j, i]
-                    ),
-                    dq_data_cube_tmp[nx - 1, j, i],
-                )
-
-                # do interpolation
-                # print("Interp shapes: ", in_x.shape, adr_x.shape, this_flux.shape, out_x.shape, flux_data_cube_tmp.shape)
-                # Interp shapes for subsample=3:  (41,) (1,) (41,) (39,) (39, 114, 3506)
-                f = interp.interp1d(
-                    in_x - adr_x,
-                    this_flux,
-                    kind="linear",
-                    fill_value=0.0,
-                    bounds_error=False,
-                )
-                g = interp.interp1d(
-                    in_x - adr_x,
-                    this_var,
-                    kind="linear",
-                    fill_value=0.0,
-                    bounds_error=False,
-                )
-                h = interp.interp1d(
-                    in_x - adr_x,
-                    this_dq,
-                    kind="nearest",
-                    fill_value=3,
-                    bounds_error=False,
-                )
-
-                flux_data_cube_tmp[:, j, i] = f(out_x)
-                var_data_cube_tmp[:, j, i] = g(out_x)
-                dq_data_cube_tmp[:, j, i] = h(out_x)
-
-            if print_progress:
-                if i > 0:
-                    sys.stdout.flush()
-                sys.stdout.write("\r\r %d" % (i / (nlam - 1.0) * 100.0) + "%")
-                if i == nlam - 1:
-                    sys.stdout.write("\n")
+        # Refraction is evaluated once on the output wavelength grid, then all
+        # wavelength planes are shifted together.
+        adr_x = adr_x_y(
+            out_lambda,
+            secz=secz,
+            objha=ha,
+            objdec=dec,
+            tellat=lat,
+            teltemp=sso_temp,
+            telpres=sso_pres,
+            telwvp=sso_wvp,
+            telpa=telpa,
+            ref_wl=5600.
+        )[0]
+        flux_data_cube_tmp = _shift_along_slitlets(flux_data_cube_tmp, adr_x, kind="linear", fill_value=0.0)
+        var_data_cube_tmp = _shift_along_slitlets(var_data_cube_tmp, adr_x, kind="linear", fill_value=0.0)
+        dq_data_cube_tmp = _shift_along_slitlets(dq_data_cube_tmp, adr_x, kind="nearest", fill_value=3)
 
     # All done, at last ! Now, let's save it all ...
     if subsample > 1:
@@ -5325,8 +5547,7 @@ def generate_wifes_cube(
     if wave_native:
         outfits[0].header.set("PYWWNONL", True, "PyWiFeS: non-linear wavelengths axis")
         outfits.append(pyfits.ImageHDU(data=out_lambda, header=outfits[1].header, name="WAVELENGTH"))
-    outfits.writeto(outimg, overwrite=True)
-    f3.close()
+    write_fits(outfits, outimg, close=[f3])
     return
 
 
@@ -5616,6 +5837,5 @@ def generate_wifes_3dcube(inimg, outimg, halfframe=False, taros=False, nan_bad_p
             and "J" in outfits[0].header["EQUINOX"]:
         outfits[0].header["EQUINOX"] = (float(outfits[0].header["EQUINOX"].replace("J", "")),
                                         "Equinox of coordinates")
-    outfits.writeto(outimg, overwrite=True)
-    f.close()
+    write_fits(outfits, outimg, close=[f])
     return
@@ -1,10 +1,10 @@
 from astropy.io import fits as pyfits
 import os
 import gc
-from pywifes.lacosmic import lacos_wifes
+from pywifes.lacosmic import lacos_wifes, lacos_wifes_frames
 from pywifes.wifes_utils import (
     get_sci_obs_list, get_sky_obs_list, get_std_obs_list,
-    is_nodshuffle, is_subnodshuffle, wifes_recipe
+    is_nodshuffle, is_subnodshuffle, prefetch, wifes_recipe
 )
 
 
@@ -19,6 +19,7 @@ def _run_cosmic_rays(
     curr_suffix,
     multithread=False,
     max_processes=-1,
+    multiframe=False,
 ):
     """
     Clean cosmic rays on all science and standard frames.
@@ -40,6 +41,10 @@ def _run_cosmic_rays(
         Maximum number of processes to use for multithreading (-1 uses all
         available processes).
         Default: -1.
+    multiframe : bool, optional
+        With multithread, clean the slitlets of all frames on one persistent
+        pool of processes, rather than one frame at a time.
+        Default: False.
 
     Returns
     -------
@@ -49,56 +54,51 @@ def _run_cosmic_rays(
     sci_obs_list = get_sci_obs_list(metadata)
     sky_obs_list = get_sky_obs_list(metadata)
     std_obs_list = get_std_obs_list(metadata)
-    for fn in sci_obs_list + sky_obs_list:
-        in_fn = os.path.join(gargs['out_dir_arm'], "%s.p%s.fits" % (fn, prev_suffix))
-        out_fn = os.path.join(gargs['out_dir_arm'], "%s.p%s.fits" % (fn, curr_suffix))
-        if gargs['skip_done'] and os.path.isfile(out_fn) \
-                and os.path.getmtime(in_fn) < os.path.getmtime(out_fn):
-            continue
-        print(f"Cleaning cosmics in {os.path.basename(in_fn)}")
+    in_fn_list = []
+    out_fn_list = []
+    label_list = []
+    for label, obs_list in [("", sci_obs_list + sky_obs_list),
+                            ("standard star ", std_obs_list)]:
+        for fn in obs_list:
+            in_fn = os.path.join(gargs['out_dir_arm'], "%s.p%s.fits" % (fn, prev_suffix))
+            out_fn = os.path.join(gargs['out_dir_arm'], "%s.p%s.fits" % (fn, curr_suffix))
+            if gargs['skip_done'] and os.path.isfile(out_fn) \
+                    and os.path.getmtime(in_fn) < os.path.getmtime(out_fn):
+                continue
+            in_fn_list.append(in_fn)
+            out_fn_list.append(out_fn)
+            label_list.append(label)
+            if is_nodshuffle(in_fn) or is_subnodshuffle(in_fn):
+                # Also process extracted sky slitlets.
+                in_fn_list.append(os.path.join(gargs['out_dir_arm'], "%s.s%s.fits" % (fn, prev_suffix)))
+                out_fn_list.append(os.path.join(gargs['out_dir_arm'], "%s.s%s.fits" % (fn, curr_suffix)))
+                label_list.append(label)
+
+    rdnoise_list = []
+    for in_fn in in_fn_list:
         in_hdr = pyfits.getheader(in_fn)
-        rdnoise = 5.0 if 'RDNOISE' not in in_hdr else in_hdr['RDNOISE']
-        lacos_wifes(
-            in_fn,
-            out_fn,
-            rdnoise=rdnoise,
-            wsol_fn=gargs['wsol_out_fn'],
-            niter=3,
-            sig_clip=10.0,
-            obj_lim=10.0,
-            sig_frac=0.2,
-            is_multithread=multithread,
-            max_processes=max_processes,
-        )
-        if is_nodshuffle(in_fn) or is_subnodshuffle(in_fn):
-            # Also process extracted sky slitlets.
-            in_fn = os.path.join(gargs['out_dir_arm'], "%s.s%s.fits" % (fn, prev_suffix))
-            out_fn = os.path.join(gargs['out_dir_arm'], "%s.s%s.fits" % (fn, curr_suffix))
-            print(f"Cleaning cosmics in {os.path.basename(in_fn)}")
-            in_hdr = pyfits.getheader(in_fn)
-            rdnoise = 5.0 if 'RDNOISE' not in in_hdr else in_hdr['RDNOISE']
-            lacos_wifes(
-                in_fn,
-                out_fn,
-                rdnoise=rdnoise,
-                wsol_fn=gargs['wsol_out_fn'],
+        rdnoise_list.append(5.0 if 'RDNOISE' not in in_hdr else in_hdr['RDNOISE'])
+
+    if multithread and multiframe:
+        if in_fn_list:
+            print(f"Cleaning cosmics in {len(in_fn_list)} frames")
+            lacos_wifes_frames(
+                in_fn_list,
+                out_fn_list,
+                rdnoises=rdnoise_list,
+                wsol_filepath=gargs['wsol_out_fn'],
                 niter=3,
                 sig_clip=10.0,
                 obj_lim=10.0,
                 sig_frac=0.2,
-                is_multithread=multithread,
                 max_processes=max_processes,
             )
-        gc.collect()
-    for fn in std_obs_list:
-        in_fn = os.path.join(gargs['out_dir_arm'], "%s.p%s.fits" % (fn, prev_suffix))
-        out_fn = os.path.join(gargs['out_dir_arm'], "%s.p%s.fits" % (fn, curr_suffix))
-        if gargs['skip_done'] and os.path.isfile(out_fn) \
-                and os.path.getmtime(in_fn) < os.path.getmtime(out_fn):
-            continue
-        print(f"Cleaning cosmics in standard star {os.path.basename(in_fn)}")
-        in_hdr = pyfits.getheader(in_fn)
-        rdnoise = 5.0 if 'RDNOISE' not in in_hdr else in_hdr['RDNOISE']
+        return
+
+    # read the next frame while this one is cleaned
+    for in_fn, out_fn, label, rdnoise in prefetch(zip(in_fn_list, out_fn_list, label_list, rdnoise_list),
+                                                  lambda frame: [frame[0]]):
+        print(f"Cleaning cosmics in {label}{os.path.basename(in_fn)}")
         lacos_wifes(
             in_fn,
             out_fn,
@@ -111,24 +111,5 @@ def _run_cosmic_rays(
             is_multithread=multithread,
             max_processes=max_processes,
         )
-        if is_nodshuffle(in_fn) or is_subnodshuffle(in_fn):
-            # Also process extracted sky slitlets.
-            in_fn = os.path.join(gargs['out_dir_arm'], "%s.s%s.fits" % (fn, prev_suffix))
-            out_fn = os.path.join(gargs['out_dir_arm'], "%s.s%s.fits" % (fn, curr_suffix))
-            print(f"Cleaning cosmics in standard star {os.path.basename(in_fn)}")
-            in_hdr = pyfits.getheader(in_fn)
-            rdnoise = 5.0 if 'RDNOISE' not in in_hdr else in_hdr['RDNOISE']
-            lacos_wifes(
-                in_fn,
-                out_fn,
-                rdnoise=rdnoise,
-                wsol_fn=gargs['wsol_out_fn'],
-                niter=3,
-                sig_clip=10.0,
-                obj_lim=10.0,
-                sig_frac=0.2,
-                is_multithread=multithread,
-                max_processes=max_processes,
-            )
         gc.collect()
     return
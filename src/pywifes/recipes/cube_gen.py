@@ -3,14 +3,16 @@ import os
 import datetime
 import pickle
 from pywifes import pywifes
-from pywifes.wifes_utils import get_associated_calib, get_primary_sci_obs_list, get_primary_std_obs_list, wifes_recipe
+from pywifes.wifes_utils import (
+    get_associated_calib, get_primary_sci_obs_list, get_primary_std_obs_list, prefetch, wifes_recipe
+)
 
 
 # ------------------------------------------------------
 # Data Cube Generation
 # ------------------------------------------------------
 @wifes_recipe
-def _run_cube_gen(metadata, gargs, prev_suffix, curr_suffix, **args):
+def _run_cube_gen(metadata, gargs, prev_suffix, curr_suffix, cache_operators=False, **args):
     '''
     Generate data cubes for science and standard frames.
 
@@ -25,6 +27,13 @@ def _run_cube_gen(metadata, gargs, prev_suffix, curr_suffix, **args):
         Previous suffix used in the file names (input).
     curr_suffix : str
         Current suffix to be used in the file names (output).
+    cache_operators : bool, optional
+        Whether to save the resampling operators to disk, so that later frames
+        (or reruns) with the same wavelength and wire solutions and cube geometry
+        skip the triangulation. With 'adr' set, the operators also depend on the
+        pointing, and only the 'operator_cache_size' (default 4) most recently
+        used are kept.
+        Default: False.
 
     Optional Function Arguments
     ---------------------------
@@ -84,7 +93,24 @@ def _run_cube_gen(metadata, gargs, prev_suffix, curr_suffix, **args):
     '''
     sci_obs_list = get_primary_sci_obs_list(metadata)
     std_obs_list = get_primary_std_obs_list(metadata)
-    for fn in sci_obs_list + std_obs_list:
+    if cache_operators:
+        operator_cache_dir = os.path.join(gargs['out_dir_arm'], "cube_operators")
+    else:
+        operator_cache_dir = None
+
+    def _cube_inputs(fn):
+        # the frame, with its wire and wavelength solutions
+        in_fn = os.path.join(gargs['out_dir_arm'], "%s.p%s.fits" % (fn, prev_suffix))
+        local_wires = get_associated_calib(metadata, fn, "wire")
+        local_arcs = get_associated_calib(metadata, fn, "arc")
+        return [in_fn] \
+            + ([os.path.join(gargs['out_dir_arm'], "%s.wire.fits" % (local_wires[0]))] if local_wires
+               else [gargs['wire_out_fn']]) \
+            + ([os.path.join(gargs['out_dir_arm'], f"{arc}.wsol.fits") for arc in local_arcs[:2]] if local_arcs
+               else [gargs['wsol_out_fn']])
+
+    # read the next frame and its solutions while this cube is generated
+    for fn in prefetch(sci_obs_list + std_obs_list, _cube_inputs):
         in_fn = os.path.join(gargs['out_dir_arm'], "%s.p%s.fits" % (fn, prev_suffix))
         out_fn = os.path.join(gargs['out_dir_arm'], "%s.p%s.fits" % (fn, curr_suffix))
         # decide whether to use global or local wsol and wire files
@@ -193,6 +219,7 @@ def _run_cube_gen(metadata, gargs, prev_suffix, curr_suffix, **args):
             out_fn,
             wire_fn=wire_fn,
             wsol_fn=wsol_fn,
+            operator_cache_dir=operator_cache_dir,
             **args
         )
     return
@@ -1,7 +1,7 @@
 import os
 from pywifes import wifes_calib
 from pywifes.wifes_utils import (
-    get_primary_sci_obs_list, get_primary_std_obs_list, wifes_recipe
+    get_primary_sci_obs_list, get_primary_std_obs_list, prefetch, wifes_recipe
 )
 
 
@@ -51,7 +51,9 @@ def _run_flux_calib(metadata, gargs, prev_suffix, curr_suffix, mode="pywifes", *
                                      os.path.basename(gargs['calib_fn']))
     else:
         this_calib_fn = gargs['calib_fn']
-    for fn in sci_obs_list + std_obs_list:
+    # read the next cube while this one is calibrated
+    for fn in prefetch(sci_obs_list + std_obs_list,
+                       lambda fn: [os.path.join(gargs['out_dir_arm'], f"{fn}.p{prev_suffix}.fits")]):
         in_fn = os.path.join(gargs['out_dir_arm'], f"{fn}.p{prev_suffix}.fits")
         out_fn = os.path.join(gargs['out_dir_arm'], f"{fn}.p{curr_suffix}.fits")
         if gargs['skip_done'] and os.path.isfile(out_fn) \
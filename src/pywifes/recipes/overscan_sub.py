@@ -1,7 +1,7 @@
 import astropy.io.fits as fits
 import os
 from pywifes import pywifes
-from pywifes.wifes_utils import get_full_obs_list, get_sci_obs_list, get_std_obs_list, wifes_recipe
+from pywifes.wifes_utils import get_full_obs_list, get_sci_obs_list, get_std_obs_list, unpack_files, wifes_recipe
 
 
 # ------------------------------------------------------------------------
@@ -74,10 +74,17 @@ def _run_overscan_sub(metadata, gargs, prev_suffix, curr_suffix, poly_high_oscan
     to avoid using the epoch-based values.
     """
     full_obs_list = get_full_obs_list(metadata)
+    sci_list = get_sci_obs_list(metadata)
+    std_list = get_std_obs_list(metadata)
+
+    # Decompress any frames staged in compressed form that are needed here
+    todo_list = [fn for fn in full_obs_list
+                 if not (gargs['skip_done']
+                         and os.path.isfile(os.path.join(gargs['out_dir_arm'], "%s.p%s.fits" % (fn, curr_suffix))))]
+    unpack_files(gargs['data_dir'], sci_list + std_list + todo_list + metadata["domeflat"][:1])
 
     # Check if any 1x2-binned standards need a different binning to match the science data
     match_binning = None
-    sci_list = get_sci_obs_list(metadata)
     sci_binning = []
     for fn in sci_list:
         this_head = fits.getheader(os.path.join(gargs['data_dir'], "%s.fits" % fn))
@@ -85,7 +92,6 @@ def _run_overscan_sub(metadata, gargs, prev_suffix, curr_suffix, poly_high_oscan
     sci_binning = set(sci_binning)
     if len(sci_binning) > 1:
         raise ValueError(f"Must process different science binning modes separately! Found: {sci_binning}")
-    std_list = get_std_obs_list(metadata)
     std_binning = []
     for fn in std_list:
         this_head = fits.getheader(os.path.join(gargs['data_dir'], "%s.fits" % fn))
@@ -119,6 +125,10 @@ def _run_overscan_sub(metadata, gargs, prev_suffix, curr_suffix, poly_high_oscan
         if fn in std_list:
             this_binning = match_binning
 
+        # Header corrections are recorded under the raw name, before any half-frame cut
+        raw_fn = fn[len("cut_"):] if fn.startswith("cut_") else fn
+
         # Subtract overscan
-        pywifes.subtract_overscan(in_fn, out_fn, data_hdu=gargs['my_data_hdu'], omaskfile=oscanmask, match_binning=this_binning, **args)
+        pywifes.subtract_overscan(in_fn, out_fn, data_hdu=gargs['my_data_hdu'], omaskfile=oscanmask, match_binning=this_binning,
+                                  header_overrides=gargs.get('header_overrides', {}).get(raw_fn), **args)
     return
@@ -2,7 +2,7 @@ import os
 from pywifes import pywifes
 from pywifes.wifes_utils import (
     get_primary_sci_obs_list, get_primary_std_obs_list, is_halfframe, is_taros,
-    wifes_recipe
+    unpack_files, wifes_recipe
 )
 
 
@@ -48,6 +48,7 @@ def _run_save_3dcube(metadata, gargs, prev_suffix, curr_suffix, **args):
     else:
         # no files to process
         return
+    unpack_files(gargs['data_dir'], (sci_obs_list + std_obs_list)[:1])
 
     halfframe = is_halfframe(sci_filename)
     taros = is_taros(sci_filename)
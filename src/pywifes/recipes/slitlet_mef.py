@@ -22,10 +22,12 @@ def _run_slitlet_mef_indiv(fn, gargs, prev_suffix, curr_suffix, slitlet_fn):
         sky_fn = os.path.join(gargs['out_dir_arm'], '%s.s%s.fits' % (fn, curr_suffix))
         pywifes.wifes_slitlet_mef_ns(in_fn, out_fn, sky_fn,
                                      data_hdu=gargs['my_data_hdu'],
-                                     slitlet_def_file=slitlet_fn)
+                                     slitlet_def_file=slitlet_fn,
+                                     var_dtype=gargs['var_dtype'])
     else:
         pywifes.wifes_slitlet_mef(in_fn, out_fn, data_hdu=gargs['my_data_hdu'],
-                                  slitlet_def_file=slitlet_fn)
+                                  slitlet_def_file=slitlet_fn,
+                                  var_dtype=gargs['var_dtype'])
     gc.collect()
 
 
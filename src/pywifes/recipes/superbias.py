@@ -7,7 +7,8 @@ from pywifes.wifes_utils import get_associated_calib, get_sci_obs_list, get_std_
 # Generate super-bias
 # ------------------------------------------------------
 @wifes_recipe
-def _run_superbias(metadata, gargs, prev_suffix, curr_suffix, method="row_med", **args):
+def _run_superbias(metadata, gargs, prev_suffix, curr_suffix, method="row_med",
+                   combine_method="median", max_memory_mb=1024., **args):
     """
     Generate superbias for the entire dataset and for each science frame.
     Fit a smart surface to the bias or take the median of each row.
@@ -27,6 +28,14 @@ def _run_superbias(metadata, gargs, prev_suffix, curr_suffix, method="row_med",
         take the median of each row.
         Options: 'row_med', 'fit'.
         Default: 'row_med'.
+    combine_method: str, optional
+        Method used to combine the individual bias frames.
+        Options: 'median', 'mean', 'clipped_mean', 'minmax', 'weighted_mean'.
+        Default: 'median'.
+    max_memory_mb: float, optional
+        Approximate memory budget (in MB) for the rows of the bias frames
+        combined at once.
+        Default: 1024.
 
     Optional Function Arguments
     ---------------------------
@@ -52,7 +61,8 @@ def _run_superbias(metadata, gargs, prev_suffix, curr_suffix, method="row_med",
             and os.path.getmtime(gargs['superbias_fn']) < os.path.getmtime(gargs['superbias_fit_fn'])):
         print("Calculating Global Superbias")
         pywifes.imcombine(bias_list, gargs['superbias_fn'], data_hdu=gargs['my_data_hdu'],
-                          kwstring="BIASN", commstring="bias")
+                          kwstring="BIASN", commstring="bias", method=combine_method,
+                          max_memory_mb=max_memory_mb)
         if method == "fit" or method == "row_med":
             pywifes.generate_wifes_bias_fit(
                 gargs['superbias_fn'],
@@ -92,7 +102,8 @@ def _run_superbias(metadata, gargs, prev_suffix, curr_suffix, method="row_med",
             ]
             pywifes.imcombine(
                 local_biases_filename, local_superbias, data_hdu=gargs['my_data_hdu'],
-                kwstring="LOCBN", commstring="local bias"
+                kwstring="LOCBN", commstring="local bias", method=combine_method,
+                max_memory_mb=max_memory_mb,
             )
             # step 2 - generate fit
             if method == "fit" or method == "row_med":
@@ -32,8 +32,23 @@ def _run_superflat(
     ---------------------------
     method : str
         The method to be used for combining the images.
-        Options: 'median', 'sum', 'mean'.
+        Options: 'median', 'sum', 'mean', 'clipped_mean', 'minmax', 'weighted_mean'.
         Default: 'median'.
+    clip_sigma : float
+        Clipping threshold (in standard deviations) for 'clipped_mean'.
+        Default: 3.0.
+    clip_iters : int
+        Maximum number of clipping iterations for 'clipped_mean'.
+        Default: 5.
+    nlow : int
+        Number of lowest values rejected per pixel for 'minmax'.
+        Default: 1.
+    nhigh : int
+        Number of highest values rejected per pixel for 'minmax'.
+        Default: 1.
+    max_memory_mb : float
+        Approximate memory budget (in MB) for the rows of the inputs combined at once.
+        Default: 1024.
     scale : str
         The scaling method to be used before combining. The 'median_nonzero' option
         scales by pixels above 'nonzero_thresh'. The 'percentileN' option scales by
@@ -115,6 +115,7 @@ def _run_superflat_mef(metadata, gargs, prev_suffix, curr_suffix, source, **args
         return
     print(f"Generating MEF {source} flat")
     pywifes.wifes_slitlet_mef(
-        in_fn, out_fn, data_hdu=gargs['my_data_hdu'], slitlet_def_file=slitlet_fn, **args
+        in_fn, out_fn, data_hdu=gargs['my_data_hdu'], slitlet_def_file=slitlet_fn,
+        var_dtype=gargs['var_dtype'], **args
     )
     return
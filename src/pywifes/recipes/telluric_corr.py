@@ -1,6 +1,6 @@
 import os
 
-from pywifes.wifes_utils import get_primary_sci_obs_list, get_primary_std_obs_list, wifes_recipe
+from pywifes.wifes_utils import get_primary_sci_obs_list, get_primary_std_obs_list, prefetch, wifes_recipe
 from pywifes import wifes_calib
 
 
@@ -51,7 +51,9 @@ def _run_telluric_corr(metadata, gargs, prev_suffix, curr_suffix, **args):
         this_tellcorr_fn = os.path.join(gargs['output_master_dir'], os.path.basename(gargs['tellcorr_fn']))
     else:
         this_tellcorr_fn = gargs['tellcorr_fn']
-    for fn in sci_obs_list + std_obs_list:
+    # read the next cube while this one is corrected
+    for fn in prefetch(sci_obs_list + std_obs_list,
+                       lambda fn: [os.path.join(gargs['out_dir_arm'], f"{fn}.p{prev_suffix}.fits")]):
         in_fn = os.path.join(gargs['out_dir_arm'], f"{fn}.p{prev_suffix}.fits")
         out_fn = os.path.join(gargs['out_dir_arm'], f"{fn}.p{curr_suffix}.fits")
         if gargs['skip_done'] and os.path.isfile(out_fn) \
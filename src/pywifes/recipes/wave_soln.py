@@ -74,6 +74,16 @@ def _run_wave_soln(metadata, gargs, prev_suffix, curr_suffix, **args):
             decimate : bool
                 Whether to perform initial fit with 10% of data.
                 Default: False.
+            warm_start : bool or str
+                Whether to start the master solution from a stored optical model
+                solution for the same grating: the path of a previous solution, or
+                True for the nearest calibration library entry. The local arc
+                solutions then start from the master solution.
+                Default: False.
+            warm_start_tol : float
+                Initial RMSE in Angstroms below which a warm-started fit skips the
+                staged fits of parameter groups.
+                Default: 0.5.
             multithread : bool
                 Whether to run step using "multiprocessing" module.
                 Default: true.
@@ -104,6 +114,13 @@ def _run_wave_soln(metadata, gargs, prev_suffix, curr_suffix, **args):
     -------
     None
     """
+    # Starting solutions for the optical model fits
+    warm_start = args.pop("warm_start", False)
+    local_args = dict(args)
+    if warm_start and args.get("method", "optical") == "optical":
+        args["warm_start"] = gargs['wsol_warm_start'] if warm_start is True else warm_start
+        local_args["warm_start"] = gargs['wsol_out_fn']
+
     # Global arc solution
     if os.path.isfile(gargs['super_arc_mef']):
         wsol_in_fn = gargs['super_arc_mef']
@@ -146,7 +163,7 @@ def _run_wave_soln(metadata, gargs, prev_suffix, curr_suffix, **args):
                     local_arc_fn,
                     local_wsol_out_fn,
                     plot_dir=gargs['plot_dir_arm'],
-                    **args
+                    **local_args
                 )
 
     return
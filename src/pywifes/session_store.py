@@ -0,0 +1,246 @@
+from astropy.io import fits as pyfits
+import os
+import re
+
+from pywifes.wifes_utils import get_file_names
+
+
+# Per-frame intermediate files (e.g. 'OBK-123456-WiFeS-Blue-UT20240101T000000.p05.fits'),
+# with the dataset name (prefix and suffix, e.g. 'p05') held in a session container
+DATASET_RE = re.compile(r"^(?P<frame>.+)\.(?P<dataset>[ps][0-9]+)\.fits$")
+
+
+class SessionStore:
+    """
+    Archive of the per-frame intermediate files of a reduction, in one FITS container
+    per frame ('<frame>.session.fits') instead of one file per processing step.
+
+    Each intermediate file becomes a named dataset in the container of its frame
+    (e.g. 'p05' for '<frame>.p05.fits'), with each of its HDUs (e.g. the SCI, VAR
+    and DQ extension of each slitlet) stored as a separate extension named
+    '<dataset>.<EXTNAME>', which can be read on its own.
+
+    Parameters
+    ----------
+    store_dir : str
+        Directory of the containers, created if it does not exist.
+    compress : bool, optional
+        Whether to store the image data with lossless tile compression.
+        Default: False.
+    """
+
+    def __init__(self, store_dir, compress=False):
+        self.store_dir = store_dir
+        self.compress = compress
+        os.makedirs(store_dir, exist_ok=True)
+
+    def _container(self, frame):
+        return os.path.join(self.store_dir, f"{frame}.session.fits")
+
+    def frames(self):
+        """
+        Names of the frames with a container in the store.
+        """
+        return [fn[:-len(".session.fits")] for fn in get_file_names(self.store_dir, "*.session.fits")]
+
+    def _dataset_mtimes(self, frame):
+        # Modification times of the original files of the datasets held for `frame`
+        container = self._container(frame)
+        if not os.path.isfile(container):
+            return {}
+        mtimes = {}
+        with pyfits.open(container) as f:
+            for hdu in f[1:]:
+                dataset = hdu.name.split(".")[0].lower()
+                if dataset not in mtimes:
+                    mtimes[dataset] = hdu.header.get("PYWSMTIM", None)
+        return mtimes
+
+    def datasets(self, frame):
+        """
+        Names of the datasets held for `frame`, in the order they were stored.
+        """
+        return list(self._dataset_mtimes(frame).keys())
+
+    def _pack_hdu(self, hdu, dataset, index, mtime):
+        extname = hdu.header.get("EXTNAME", "")
+        header = hdu.header.copy()
+        for key in ["SIMPLE", "EXTEND", "XTENSION", "PCOUNT", "GCOUNT"]:
+            header.remove(key, ignore_missing=True)
+        header["PYWSEXT"] = (extname, "PyWiFeS: original EXTNAME in session container")
+        if index == 0:
+            header["PYWSMTIM"] = (mtime, "PyWiFeS: original modification time")
+        name = f"{dataset}.{extname if extname else index}"
+        if self.compress and hdu.data is not None:
+            compression_type = "GZIP_2" if hdu.data.dtype.kind == "f" else "RICE_1"
+            return pyfits.CompImageHDU(hdu.data, header, name=name,
+                                       compression_type=compression_type, quantize_level=0.0)
+        return pyfits.ImageHDU(hdu.data, header, name=name)
+
+    def put(self, fits_path, remove=True):
+        """
+        Add a per-frame intermediate file to the container of its frame, replacing
+        any earlier copy of the same dataset unless it is unchanged.
+
+        Parameters
+        ----------
+        fits_path : str
+            Path of the file, named '<frame>.<dataset>.fits'.
+        remove : bool, optional
+            Whether to delete the file once stored.
+            Default: True.
+
+        Returns
+        -------
+        None
+        """
+        match = DATASET_RE.match(os.path.basename(fits_path))
+        if match is None:
+            raise ValueError(f"Not a per-frame intermediate file: {fits_path}")
+        frame, dataset = match.group("frame"), match.group("dataset")
+        mtime = os.path.getmtime(fits_path)
+        stored_mtimes = self._dataset_mtimes(frame)
+        if stored_mtimes.get(dataset, None) == mtime:
+            # unchanged since it was stored (or written back out by `unpack`)
+            if remove:
+                os.remove(fits_path)
+            return
+        with pyfits.open(fits_path, memmap=True) as f:
+            new_hdus = [self._pack_hdu(hdu, dataset, i, mtime) for i, hdu in enumerate(f)]
+            container = self._container(frame)
+            if dataset in stored_mtimes:
+                # rewrite the container without the earlier copy
+                temp_fn = f"{container}.tmp{os.getpid()}"
+                with pyfits.open(container, memmap=True) as c:
+                    kept = [hdu for hdu in c[1:] if hdu.name.split(".")[0].lower() != dataset]
+                    pyfits.HDUList([pyfits.PrimaryHDU()] + kept + new_hdus).writeto(temp_fn, overwrite=True)
+                os.replace(temp_fn, container)
+            elif os.path.isfile(container):
+                with pyfits.open(container, mode="append") as c:
+                    for hdu in new_hdus:
+                        c.append(hdu)
+            else:
+                pyfits.HDUList([pyfits.PrimaryHDU()] + new_hdus).writeto(container)
+        if remove:
+            os.remove(fits_path)
+
+    def read(self, frame, dataset, extname):
+        """
+        Read the data of one extension (e.g. 'SCI5') of a dataset.
+
+        Parameters
+        ----------
+        frame : str
+            Name of the frame.
+        dataset : str
+            Name of the dataset (e.g. 'p05').
+        extname : str
+            EXTNAME of the extension, or its index in the original file if it had none.
+
+        Returns
+        -------
+        numpy.ndarray or None
+            The data of the extension.
+        """
+        with pyfits.open(self._container(frame)) as f:
+            return f[f"{dataset}.{extname}".upper()].data
+
+    def export(self, frame, dataset, out_path):
+        """
+        Write a dataset back out as an ordinary FITS file, with the modification
+        time of the original file.
+
+        Parameters
+        ----------
+        frame : str
+            Name of the frame.
+        dataset : str
+            Name of the dataset (e.g. 'p05').
+        out_path : str
+            Path of the file to write.
+
+        Returns
+        -------
+        None
+        """
+        hdus = []
+        mtime = None
+        with pyfits.open(self._container(frame)) as f:
+            for hdu in f[1:]:
+                if hdu.name.split(".")[0].lower() != dataset:
+                    continue
+                header = hdu.header.copy()
+                extname = header.pop("PYWSEXT", "")
+                header.remove("EXTNAME", ignore_missing=True)
+                if not hdus:
+                    mtime = header.pop("PYWSMTIM", None)
+                    hdus.append(pyfits.PrimaryHDU(hdu.data, header))
+                else:
+                    hdus.append(pyfits.ImageHDU(hdu.data, header))
+                if extname:
+                    hdus[-1].header["EXTNAME"] = extname
+            if not hdus:
+                raise KeyError(f"No dataset {dataset} for frame {frame}")
+            pyfits.HDUList(hdus).writeto(out_path, overwrite=True)
+        if mtime is not None:
+            os.utime(out_path, (mtime, mtime))
+
+    def pack(self, data_dir, suffixes=None, remove=True):
+        """
+        Move (or copy) the per-frame intermediate files in `data_dir` into the store.
+
+        Parameters
+        ----------
+        data_dir : str
+            Directory of the files.
+        suffixes : list of str, optional
+            Only move the files of these processing step suffixes.
+            Default: None (all).
+        remove : bool, optional
+            Whether to delete the files once stored.
+            Default: True.
+
+        Returns
+        -------
+        int
+            Number of files stored.
+        """
+        # store the datasets of each frame in processing order
+        names = sorted(get_file_names(data_dir, "*.fits"))
+        count = 0
+        for fn in names:
+            match = DATASET_RE.match(fn)
+            if match is None or (suffixes is not None and match.group("dataset")[1:] not in suffixes):
+                continue
+            self.put(os.path.join(data_dir, fn), remove=remove)
+            count += 1
+        return count
+
+    def unpack(self, data_dir, datasets=None):
+        """
+        Write the stored datasets that are not already in `data_dir` out as ordinary
+        FITS files there.
+
+        Parameters
+        ----------
+        data_dir : str
+            Directory to write the files to.
+        datasets : list of str, optional
+            Only write out these datasets (e.g. ['p08']).
+            Default: None (all).
+
+        Returns
+        -------
+        int
+            Number of files written.
+        """
+        count = 0
+        for frame in self.frames():
+            for dataset in self.datasets(frame):
+                if datasets is not None and dataset not in datasets:
+                    continue
+                out_path = os.path.join(data_dir, f"{frame}.{dataset}.fits")
+                if not os.path.isfile(out_path):
+                    self.export(frame, dataset, out_path)
+                    count += 1
+        return count
@@ -0,0 +1,290 @@
+import copy
+import multiprocessing
+import multiprocessing.connection
+import sys
+import traceback
+
+from pywifes.multiprocessing_utils import _get_num_processes
+
+
+# Steps that act on each observation independently, with the calibration steps whose
+# products they read. Steps flagged 'calib' also process the calibration frames.
+# All other steps are treated as barriers: they run once, on the full metadata, after
+# every earlier step has finished for every observation.
+FRAME_STEPS = {
+    "bpm_repair": {"requires": [], "calib": True},
+    "bias_sub": {"requires": ["superbias"], "calib": True},
+    "slitlet_mef": {"requires": ["slitlet_profile"], "calib": True},
+    "cosmic_rays": {"requires": ["wave_soln"], "calib": False},
+    "sky_sub": {"requires": [], "calib": False},
+    "obs_coadd": {"requires": [], "calib": False},
+    "flatfield": {"requires": ["flat_response"], "calib": False},
+    "cube_gen": {"requires": ["wave_soln", "wire_soln"], "calib": False},
+    "flux_calib": {"requires": ["derive_calib"], "calib": False},
+    "telluric_corr": {"requires": ["derive_telluric"], "calib": False},
+    "save_3dcube": {"requires": [], "calib": False},
+}
+
+
+def split_metadata(metadata):
+    """
+    Split the metadata of one arm into independent units of work.
+
+    The first unit holds the calibration frames that are not associated with any
+    science or standard observation. Each further unit holds one or more science or
+    standard observations, merged whenever they share a frame (sky or local
+    calibration), so that no frame belongs to more than one unit.
+
+    Parameters
+    ----------
+    metadata : dict
+        Metadata containing information about the observations.
+
+    Returns
+    -------
+    list of dict
+        The metadata of each unit, in the same format as the input.
+    """
+    obs_list = [("sci", obs) for obs in metadata["sci"]] + [("std", obs) for obs in metadata["std"]]
+    obs_files = [set(fn for key, val in obs.items() if key not in ["stdtype", "name"] for fn in val)
+                 for _, obs in obs_list]
+
+    # merge observations sharing any frame
+    unit_of = list(range(len(obs_list)))
+
+    def _find(i):
+        while unit_of[i] != i:
+            i = unit_of[i]
+        return i
+
+    for i in range(len(obs_list)):
+        for j in range(i):
+            if obs_files[i] & obs_files[j]:
+                unit_of[_find(i)] = _find(j)
+
+    calib_keys = [key for key in metadata.keys() if key not in ["sci", "std"]]
+    claimed = set().union(*obs_files) if obs_files else set()
+    calib_unit = {key: [fn for fn in metadata[key] if fn not in claimed] for key in calib_keys}
+    calib_unit["sci"] = []
+    calib_unit["std"] = []
+
+    units = [calib_unit]
+    unit_index = {}
+    for i, (obs_type, obs) in enumerate(obs_list):
+        root = _find(i)
+        if root not in unit_index:
+            unit_index[root] = len(units)
+            new_unit = {key: [] for key in calib_keys}
+            new_unit["sci"] = []
+            new_unit["std"] = []
+            units.append(new_unit)
+        units[unit_index[root]][obs_type].append(copy.deepcopy(obs))
+    return units
+
+
+def merge_metadata(metadata, units):
+    """
+    Rebuild the metadata of the whole arm from the (possibly updated) units, keeping
+    the calibration lists of the original `metadata`.
+    """
+    merged = {key: val for key, val in metadata.items() if key not in ["sci", "std"]}
+    merged["sci"] = [obs for unit in units for obs in unit["sci"]]
+    merged["std"] = [obs for unit in units for obs in unit["std"]]
+    return merged
+
+
+def build_step_graph(steps, nunits):
+    """
+    Build the dependency graph of the reduction steps across the units of work.
+
+    Parameters
+    ----------
+    steps : list of dict
+        The steps to run, in order, each with 'step', 'suffix', 'prev_suffix' and
+        'args' entries.
+    nunits : int
+        Number of units of work returned by `split_metadata` (the first being the
+        calibration unit).
+
+    Returns
+    -------
+    list of dict
+        Nodes with 'step_index', 'unit' (None for barriers) and 'deps' (indices of the
+        nodes that must finish first), in an order that respects the dependencies.
+    """
+    nodes = []
+    barrier_nodes = {}
+    last_barrier = None
+    # last barrier that wrote frames with a new suffix (e.g. overscan_sub)
+    last_frame_barrier = None
+    last_unit_node = [None] * nunits
+    for step_index, step in enumerate(steps):
+        step_name = step["step"]
+        if step_name in FRAME_STEPS:
+            requires = FRAME_STEPS[step_name]["requires"]
+            first_unit = 0 if FRAME_STEPS[step_name]["calib"] else 1
+            for unit in range(first_unit, nunits):
+                deps = set(n for name in requires for n in barrier_nodes.get(name, []))
+                if last_frame_barrier is not None:
+                    deps.add(last_frame_barrier)
+                if last_unit_node[unit] is not None:
+                    deps.add(last_unit_node[unit])
+                elif last_barrier is not None:
+                    deps.add(last_barrier)
+                last_unit_node[unit] = len(nodes)
+                nodes.append({"step_index": step_index, "unit": unit, "deps": deps})
+        else:
+            # wait for everything that came before
+            deps = set(range(len(nodes)))
+            last_barrier = len(nodes)
+            if step["suffix"] is not None:
+                last_frame_barrier = len(nodes)
+            barrier_nodes.setdefault(step_name, []).append(len(nodes))
+            nodes.append({"step_index": step_index, "unit": None, "deps": deps})
+    return nodes
+
+
+def _run_node(func, metadata, gargs, prev_suffix, curr_suffix, args, conn):
+    """
+    Run one recipe in a child process, sending back the (possibly updated) metadata.
+    """
+    try:
+        func(metadata, gargs, prev_suffix=prev_suffix, curr_suffix=curr_suffix, **args)
+        conn.send((True, metadata))
+    except Exception:
+        traceback.print_exc()
+        conn.send((False, None))
+    finally:
+        conn.close()
+
+
+def run_step_graph(recipes, steps, metadata, gargs, max_processes=-1, progress_file=None,
+                   on_consumed=None, on_finished=None):
+    """
+    Run the reduction steps of one arm as a dependency graph on a pool of processes.
+
+    Steps in `FRAME_STEPS` are run separately for each unit of work (see
+    `split_metadata`) as soon as the calibration steps they require, and the
+    previous step of the same unit, have finished. Any other step is a barrier.
+    This lets science frames flow through the per-frame steps while later
+    calibrations are still being built.
+
+    The steps run in forked processes, so a step's 'func' may be any callable
+    (e.g. a closure wrapping a recipe), whatever the default start method.
+
+    Parameters
+    ----------
+    recipes : module
+        Module providing the 'run_<step>' recipe functions.
+    steps : list of dict
+        The steps to run, in order, each with 'step', 'suffix', 'prev_suffix' and
+        'args' entries, and optionally a 'func' entry to run in place of the recipe.
+    metadata : dict
+        Metadata containing information about the observations.
+    gargs : dict
+        A dictionary containing global arguments used by the processing steps.
+    max_processes : int, optional
+        Maximum number of steps running at once (-1 uses all available cores).
+        Default: -1.
+    progress_file : file, optional
+        Stream for one-line progress messages.
+        Default: None.
+    on_consumed : callable, optional
+        Called with each suffix once every step reading the frames with that suffix
+        has finished, e.g. to remove intermediate frames that are no longer needed.
+        Default: None.
+    on_finished : callable, optional
+        Called with each step (an entry of `steps`) once it has finished for every
+        unit, e.g. to write its frames through to disk.
+        Default: None.
+
+    Returns
+    -------
+    dict
+        The metadata after all steps, including any frames added by the recipes.
+    """
+    units = split_metadata(metadata)
+    nodes = build_step_graph(steps, len(units))
+    num_processes = _get_num_processes(max_processes)
+    mp_context = multiprocessing.get_context("fork")
+    # nodes reading the frames of each suffix
+    readers = {}
+    for n, node in enumerate(nodes):
+        prev_suffix = steps[node["step_index"]]["prev_suffix"]
+        if prev_suffix is not None:
+            readers.setdefault(prev_suffix, set()).add(n)
+    # nodes running each step
+    step_nodes = {}
+    for n, node in enumerate(nodes):
+        step_nodes.setdefault(node["step_index"], set()).add(n)
+
+    pending = list(range(len(nodes)))
+    running = {}
+    done = set()
+    failed = None
+    while pending or running:
+        # start every node whose dependencies are satisfied, in graph order
+        if failed is None:
+            for n in list(pending):
+                if len(running) >= num_processes:
+                    break
+                node = nodes[n]
+                if not node["deps"] <= done:
+                    continue
+                step = steps[node["step_index"]]
+                if node["unit"] is None:
+                    node_metadata = merge_metadata(metadata, units)
+                    label = "all"
+                else:
+                    node_metadata = units[node["unit"]]
+                    label = "calibrations" if node["unit"] == 0 else \
+                        ", ".join(obs["sci"][0] for obs in node_metadata["sci"] + node_metadata["std"])
+                if progress_file is not None:
+                    print(f"Running {gargs['arm']}/run_{step['step']} ({label})", file=progress_file)
+                print('======================')
+                print(f"{step['step']} ({label})")
+                print('======================')
+                sys.stdout.flush()
+                sys.stderr.flush()
+                parent_conn, child_conn = mp_context.Pipe(duplex=False)
+                proc = mp_context.Process(
+                    target=_run_node,
+                    args=(step.get("func", getattr(recipes, "run_" + step["step"])), node_metadata, gargs,
+                          step["prev_suffix"], step["suffix"], step["args"], child_conn),
+                )
+                proc.start()
+                child_conn.close()
+                running[n] = (proc, parent_conn)
+                pending.remove(n)
+        if not running:
+            break
+        # wait for the next node to finish
+        conns = [conn for _, conn in running.values()]
+        ready = multiprocessing.connection.wait(conns)
+        for n, (proc, conn) in list(running.items()):
+            if conn not in ready:
+                continue
+            try:
+                success, new_metadata = conn.recv()
+            except EOFError:
+                success, new_metadata = False, None
+            proc.join()
+            conn.close()
+            del running[n]
+            if success:
+                done.add(n)
+                if nodes[n]["unit"] is not None:
+                    units[nodes[n]["unit"]] = new_metadata
+                if on_finished is not None:
+                    for step_index in [idx for idx, idx_nodes in step_nodes.items() if idx_nodes <= done]:
+                        del step_nodes[step_index]
+                        on_finished(steps[step_index])
+                if on_consumed is not None:
+                    for suffix in [sfx for sfx, sfx_nodes in readers.items() if sfx_nodes <= done]:
+                        del readers[suffix]
+                        on_consumed(suffix)
+            elif failed is None:
+                failed = steps[nodes[n]["step_index"]]["step"]
+    if failed is not None:
+        raise RuntimeError(f"Step {failed} failed")
+    return merge_metadata(metadata, units)
@@ -122,14 +122,10 @@ def adr_x_y(wavelength_array,
     # get adr results
     eta = adr_eta(objha, tellat, objdec)
     obj_eta = eta - telpa
-    n_pix = len(wavelength_array)
-    adrx = numpy.zeros(n_pix, dtype='f')
-    adry = numpy.zeros(n_pix, dtype='f')
     # starting point
     r_set = adr_r(ref_wl, secz, telpres, teltemp, telwvp)
-    for i in range(n_pix):
-        delta_r = adr_r(wavelength_array[i],
-                        secz, telpres, teltemp, telwvp) - r_set
-        adry[i] = delta_r * numpy.cos(obj_eta)
-        adrx[i] = delta_r * numpy.sin(obj_eta)
+    delta_r = adr_r(numpy.asarray(wavelength_array),
+                    secz, telpres, teltemp, telwvp) - r_set
+    adry = (delta_r * numpy.cos(obj_eta)).astype('f')
+    adrx = (delta_r * numpy.sin(obj_eta)).astype('f')
     return [adrx, adry]
@@ -12,7 +12,7 @@ from pywifes import wifes_ephemeris
 from pywifes.pywifes import imcopy
 from pywifes.wifes_metadata import metadata_dir, __version__
 from pywifes.wifes_utils import (
-    arguments, hl_envelopes_idx, is_halfframe, is_nodshuffle, is_subnodshuffle, is_taros
+    arguments, hl_envelopes_idx, is_halfframe, is_nodshuffle, is_subnodshuffle, is_taros, write_fits
 )
 
 
@@ -69,7 +69,7 @@ for i in range(nstds):
         stdstar_type_array[i] = ["telluric"]
 
 
-def find_nearest_stdstar(inimg, data_hdu=0, stdtype="flux"):
+def find_nearest_stdstar(inimg, data_hdu=0, stdtype="flux", radec=None):
     """
     Find the standard star of the specified type that is closest on the sky to the
     input image.
@@ -77,6 +77,10 @@ def find_nearest_stdstar(inimg, data_hdu=0, stdtype="flux"):
     stdtype : str, optional
         Type of standard to find: "flux", "telluric", or "any".
         Default: "flux".
+    radec : str, optional
+        Sexagesimal "RA DEC" of the image, if already known (the image is then not
+        opened).
+        Default: None.
 
     Returns
     -------
@@ -87,9 +91,10 @@ def find_nearest_stdstar(inimg, data_hdu=0, stdtype="flux"):
     str
         - Calibration type(s) of the closest standard star
     """
-    f = pyfits.open(inimg)
-    radec = "%s %s" % (f[data_hdu].header["RA"], f[data_hdu].header["DEC"])
-    f.close()
+    if radec is None:
+        f = pyfits.open(inimg)
+        radec = "%s %s" % (f[data_hdu].header["RA"], f[data_hdu].header["DEC"])
+        f.close()
     ra, dec = wifes_ephemeris.sex2dd(radec)
     # crude-but-sufficient distance calculation
     angsep_array = (
@@ -1197,8 +1202,7 @@ def calibrate_wifes_cube(inimg, outimg, calib_fn, mode="pywifes", extinction_fn=
         outfits[0].header.set("PYWFCALX", extinction_fn.split("/")[-1],
                               "PyWiFeS: flux calibration extinction model")
     outfits[0].header.set("PYWFSTDF", std_file, "PyWiFeS: flux standard file")
-    outfits.writeto(outimg, overwrite=True)
-    f3.close()
+    write_fits(outfits, outimg, close=[f3])
     return
 
 
@@ -1703,6 +1707,5 @@ def apply_wifes_telluric(inimg, outimg, tellcorr_fn, airmass=None, shift_sky=Tru
     outfits[0].header.set("PYWTH2OP", H2O_power, "PyWiFeS: telluric H2O power")
     if shift_sky:
         outfits[0].header.set("PYWTSHFT", numpy.median(shift_list), "PyWiFeS: median lambda shift of telluric (pix)")
-    outfits.writeto(outimg, overwrite=True)
-    f3.close()
+    write_fits(outfits, outimg, close=[f3])
     return
@@ -1,6 +1,10 @@
 from __future__ import division, print_function
+from astropy.io import fits as pyfits
+import functools
 import numpy
+import os
 import scipy.interpolate
+import scipy.sparse
 
 
 # -----------------------------------------------------------------------------
@@ -29,6 +33,172 @@ def blkavg(arr, mx, my):
     return x1
 
 
+# -----------------------------------------------------------------------------
+def _linear_interp_weights(x, x_new):
+    """
+    Interpolation weights equivalent to scipy.interpolate.interp1d(x, y,
+    bounds_error=False, fill_value=0.0)(x_new) for any y, with x sorted in
+    increasing order.
+
+    Returns the indices of x_new within the range of x, and the indices into x and
+    weights of the lower and upper neighbours of those points.
+    """
+    hi = numpy.clip(numpy.searchsorted(x, x_new, side='left'), 1, len(x) - 1)
+    lo = hi - 1
+    frac = (x_new - x[lo]) / (x[hi] - x[lo])
+    inside = numpy.nonzero((x_new >= x[0]) * (x_new <= x[-1]))[0]
+    return inside, lo[inside], hi[inside], 1.0 - frac[inside], frac[inside]
+
+
+def _block_interp_matrix(row_weights, n_out, n_in):
+    """
+    Assemble per-row interpolation weights into a block-diagonal sparse matrix
+    acting on row-major flattened (nrows, n_in) arrays.
+    """
+    rows, cols, vals = [], [], []
+    for i, (inside, lo, hi, w_lo, w_hi) in enumerate(row_weights):
+        rows += [i * n_out + inside, i * n_out + inside]
+        cols += [i * n_in + lo, i * n_in + hi]
+        vals += [w_lo, w_hi]
+    nrows = len(row_weights)
+    return scipy.sparse.csr_matrix(
+        (numpy.concatenate(vals), (numpy.concatenate(rows), numpy.concatenate(cols))),
+        shape=(nrows * n_out, nrows * n_in))
+
+
+class Rectifier(object):
+    """
+    Precomputed operators that rectify a slitlet onto a uniform wavelength grid
+    (transform) and map rectified data back onto the detector pixels (detransform),
+    equivalent to transform_data and detransform_data for a fixed wavelength array.
+
+    The per-row linear interpolation matrices are stacked into block-diagonal sparse
+    matrices, so each transform is a single sparse matrix-vector product.
+
+    Parameters
+    ----------
+    wave : numpy.ndarray
+        Wavelength of each pixel of the slitlet, with shape (ny, nx).
+    out_lambda : numpy.ndarray, optional
+        Output wavelength grid for the forward transform. If None, a uniform grid
+        spanning the slitlet at its mean dispersion is used. Default is None.
+    """
+
+    def __init__(self, wave, out_lambda=None):
+        self.wave = wave
+        self.ny, self.nx = numpy.shape(wave)
+        # figure out wavelength coverage
+        wmin = numpy.min(numpy.min(wave, axis=1))
+        wmax = numpy.max(numpy.max(wave, axis=1))
+        dw = numpy.abs(wave[:, 1:] - wave[:, :-1])
+        self.full_dw = numpy.zeros(numpy.shape(wave))
+        self.full_dw[:, 1:] = dw
+        self.full_dw[:, 0] = dw[:, 0]
+        # uniform wavelength array used for the detransform
+        self.native_wdisp = numpy.mean(dw)
+        if self.native_wdisp < 0:
+            self.native_lambda = numpy.arange(wmin, wmax - self.native_wdisp,
+                                              -self.native_wdisp)[::-1]
+        else:
+            self.native_lambda = numpy.arange(wmin, wmax + self.native_wdisp,
+                                              self.native_wdisp)
+        if out_lambda is None:
+            self.out_lambda = self.native_lambda
+            self.wdisp = self.native_wdisp
+        else:
+            # NOTE: BREAKS IF YOU HAVE NON-REGULAR WAVELENGTH SPACING
+            self.out_lambda = out_lambda
+            self.wdisp = out_lambda[1] - out_lambda[0]
+        self._forward = None
+        self._inverse = None
+
+    @property
+    def forward(self):
+        """
+        Sparse matrix mapping flattened detector pixels to the output grid.
+        """
+        if self._forward is None:
+            weights = []
+            for i in range(self.ny):
+                sort_order = self.wave[i, :].argsort()
+                inside, lo, hi, w_lo, w_hi = _linear_interp_weights(
+                    self.wave[i, sort_order], self.out_lambda)
+                # map the sorted pixels back to their detector columns
+                weights.append((inside, sort_order[lo], sort_order[hi], w_lo, w_hi))
+            self._forward = _block_interp_matrix(weights, len(self.out_lambda), self.nx)
+        return self._forward
+
+    @property
+    def inverse(self):
+        """
+        Sparse matrix mapping the flattened uniform grid back to detector pixels.
+        """
+        if self._inverse is None:
+            weights = [_linear_interp_weights(self.native_lambda, self.wave[i, :])
+                       for i in range(self.ny)]
+            self._inverse = _block_interp_matrix(weights, self.nx, len(self.native_lambda))
+        return self._inverse
+
+    def transform(self, data, return_lambda=False):
+        """
+        Rectify data onto the output wavelength grid, as transform_data.
+        """
+        scaled_data = data / self.full_dw
+        interp_data = (self.forward @ scaled_data.ravel()).reshape(
+            self.ny, len(self.out_lambda)) * self.wdisp
+        interp_data[numpy.nonzero(numpy.isnan(interp_data))] = 0.0
+        if return_lambda:
+            return interp_data, self.out_lambda
+        else:
+            return interp_data
+
+    def detransform(self, new_data):
+        """
+        Map rectified data back onto the detector pixels, as detransform_data.
+        """
+        new_data = numpy.asarray(new_data)[:self.ny]
+        scaled_interp_data = (self.inverse @ numpy.ravel(new_data)).reshape(
+            self.ny, self.nx)
+        interp_data = scaled_interp_data * (self.full_dw / self.native_wdisp)
+        interp_data[numpy.nonzero(interp_data != interp_data)] = 0.0
+        return interp_data
+
+
+# Number of slitlet Rectifiers kept in memory: all slitlets of two wavelength
+# solutions (e.g. the two arcs bracketing a frame)
+RECTIFIER_CACHE_SIZE = 50
+
+
+@functools.lru_cache(maxsize=RECTIFIER_CACHE_SIZE)
+def _cached_rectifier(wsol_fn, mtime, size, ext):
+    # keyed by the file's modification time and size, so a rewritten file is reloaded
+    return Rectifier(pyfits.getdata(wsol_fn, ext=ext))
+
+
+def get_rectifier(wsol_fn, ext):
+    """
+    Return the Rectifier for one extension of a wavelength solution file.
+
+    Rectifiers are built on first use and the most recently used ones are kept
+    (up to RECTIFIER_CACHE_SIZE), so repeated calls (across slitlets, iterations
+    and frames) reuse the same operators until the file changes.
+
+    Parameters
+    ----------
+    wsol_fn : str
+        Path to the wavelength solution.
+    ext : int
+        Extension of the wavelength solution (slitlet number).
+
+    Returns
+    -------
+    Rectifier
+        The rectification operators for that slitlet.
+    """
+    return _cached_rectifier(os.path.abspath(wsol_fn), os.path.getmtime(wsol_fn),
+                             os.path.getsize(wsol_fn), ext)
+
+
 # -----------------------------------------------------------------------------
 def transform_data(data, wave,
                    return_lambda=False,
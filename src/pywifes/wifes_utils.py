@@ -1,4 +1,5 @@
 from astropy.io import fits as pyfits
+from concurrent.futures import ThreadPoolExecutor
 from inspect import getargvalues, stack
 import numpy
 import re
@@ -7,6 +8,10 @@ import os
 import shutil
 import pyjson5
 import datetime
+import functools
+import hashlib
+
+from pywifes.multiprocessing_utils import get_task, map_tasks, run_tasks_singlethreaded, submit_tasks
 
 
 def arguments():
@@ -199,20 +204,157 @@ def nan_helper(y):
 # Decorator to print name and execution time of each recipe step
 # -----------------------------------------------------------------------
 def wifes_recipe(func):
-    def wrapper(*args, **kwargs):
+    @functools.wraps(func)
+    def wrapper(metadata, gargs, *args, **kwargs):
         start_time = datetime.datetime.now()
         print("Start of WiFeS Recipe {}.".format(func.__name__))
-        result = func(*args, **kwargs)
+        # let the recipe queue its output writes (see write_fits), and wait for
+        # them all before the step ends
+        saved = (_write_behind["max_pending"], _write_behind["recipe_pid"])
+        _write_behind["max_pending"] = gargs.get('write_behind', 0)
+        _write_behind["recipe_pid"] = os.getpid()
+        try:
+            result = func(metadata, gargs, *args, **kwargs)
+        finally:
+            try:
+                flush_writes()
+            finally:
+                _write_behind["max_pending"], _write_behind["recipe_pid"] = saved
         duration = datetime.datetime.now() - start_time
         print("End of WiFeS Recipe {}: took {} seconds.".format(func.__name__, duration.total_seconds()))
         return result
     return wrapper
 
 
+# Write-behind queue of the current process: the number of writes a recipe may have
+# outstanding, the process running the recipe, and the writer thread and its writes
+_write_behind = {"max_pending": 0, "recipe_pid": None, "pid": None, "executor": None, "pending": []}
+
+
+def _write_fits_now(hdulist, out_fn, close):
+    # write under a temporary name, so that the file only appears once complete
+    temp_fn = f"{out_fn}.part{os.getpid()}"
+    try:
+        hdulist.writeto(temp_fn, overwrite=True)
+        os.replace(temp_fn, out_fn)
+    finally:
+        for f in close:
+            f.close()
+        if os.path.exists(temp_fn):
+            os.remove(temp_fn)
+
+
+def write_fits(hdulist, out_fn, close=None):
+    """
+    Write a FITS file under a temporary name, renamed into place once complete.
+
+    Within a recipe run with the 'write_behind' global argument set to N > 0, the
+    write is queued on a background thread and this returns at once, so that the
+    recipe can go on to the next frame; it only waits when N writes are already
+    outstanding. All queued writes are finished before the recipe returns (see
+    `flush_writes`). Writes from processes started by the recipe are not queued.
+
+    Parameters
+    ----------
+    hdulist : astropy.io.fits.HDUList
+        The HDUs to write, which must not be modified afterwards.
+    out_fn : str
+        The path of the output file.
+    close : list of astropy.io.fits.HDUList, optional
+        Files to close once the data have been written (e.g. the input file that
+        `hdulist` was built from, whose unmodified extensions may not be read yet).
+        Default: None.
+
+    Returns
+    -------
+    None
+    """
+    close = [] if close is None else close
+    max_pending = _write_behind["max_pending"]
+    if max_pending <= 0 or _write_behind["recipe_pid"] != os.getpid():
+        _write_fits_now(hdulist, out_fn, close)
+        return
+    if _write_behind["pid"] != os.getpid():
+        # a forked process cannot use the writer thread of its parent
+        _write_behind.update(pid=os.getpid(), executor=ThreadPoolExecutor(max_workers=1), pending=[])
+    pending = _write_behind["pending"]
+    while len(pending) >= max_pending:
+        pending.pop(0).result()
+    pending.append(_write_behind["executor"].submit(_write_fits_now, hdulist, out_fn, close))
+
+
+def flush_writes():
+    """
+    Wait for all writes queued by `write_fits` in this process, raising any error.
+    """
+    if _write_behind["pid"] != os.getpid():
+        return
+    pending = _write_behind["pending"]
+    while pending:
+        pending.pop(0).result()
+
+
 # ------------------------------------------------------------------------
 # Function definition
 # ------------------------------------------------------------------------
 
+def _read_file(filename, blocksize=2**23):
+    # Read a file through, so that it is held in the operating system's file cache
+    try:
+        with open(filename, "rb") as f:
+            while f.read(blocksize):
+                pass
+    except OSError:
+        pass
+
+
+def prefetch(items, get_filenames, ahead=1):
+    """
+    Iterate over `items`, reading the files of the next `ahead` items on a background
+    thread while each item is processed, so that they are already in the operating
+    system's file cache when they are opened.
+
+    Parameters
+    ----------
+    items : iterable
+        The items (e.g. observation names) to iterate over.
+    get_filenames : function
+        Function returning the paths of the files read for an item. Missing files
+        are ignored, and each file is only read once.
+    ahead : int, optional
+        Number of items to read ahead (0 reads nothing).
+        Default: 1.
+
+    Yields
+    ------
+    object
+        Each item of `items`, in order.
+    """
+    items = list(items)
+    if ahead <= 0:
+        yield from items
+        return
+    seen = set()
+
+    def _submit(executor, item):
+        for filename in get_filenames(item):
+            if filename not in seen:
+                seen.add(filename)
+                executor.submit(_read_file, filename)
+
+    executor = ThreadPoolExecutor(max_workers=1)
+    try:
+        # the first item is needed at once, so it is not read ahead
+        for item in items[:1]:
+            seen.update(get_filenames(item))
+        for i, item in enumerate(items):
+            for next_item in items[i + 1:i + 1 + ahead]:
+                _submit(executor, next_item)
+            yield item
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
 def move_files(src_dir_path, destination_dir_path, filenames):
     """
     Move files from the source directory to the destination directory.
@@ -241,9 +383,41 @@ def move_files(src_dir_path, destination_dir_path, filenames):
         print(f"Error moving files: {e}")
 
 
-def copy_files(src_dir_path, destination_dir_path, filenames):
+def _decompress_file(src_file, dest_file):
+    # Write the image of an fpack- or gzip-compressed raw frame as a plain FITS file,
+    # via a temporary name so that a partly written file is never picked up.
+    temph = pyfits.open(src_file)
+    ext = 1 if re.search("\\.fz$", src_file) else 0
+    temp_file = f"{dest_file}.part{os.getpid()}"
+    pyfits.writeto(temp_file, data=temph[ext].data, header=temph[ext].header,
+                   output_verify="fix", overwrite=True)
+    temph.close()
+    os.replace(temp_file, dest_file)
+
+
+def _copy_file(src_file, dest_file):
+    # Copy one raw frame, decompressing it if needed, unless already up to date.
+    try:
+        # Handle common file compression for raw data
+        if re.search("\\.(fz|gz)$", src_file):
+            dest_file = re.sub("\\.(fz|gz)$", "", dest_file)
+            if os.path.isfile(dest_file) \
+                    and os.path.getmtime(src_file) < os.path.getmtime(dest_file):
+                return
+            _decompress_file(src_file, dest_file)
+        else:
+            if os.path.isfile(dest_file) \
+                    and os.path.getmtime(src_file) < os.path.getmtime(dest_file):
+                return
+            shutil.copy(src_file, dest_file)
+    except Exception as e:
+        print(f"Error copying file {src_file}: {e}")
+
+
+def copy_files(src_dir_path, destination_dir_path, filenames, max_processes=1, wait=True):
     """
-    Copy files from the source directory to the destination directory.
+    Copy files from the source directory to the destination directory, decompressing
+    any '.fz' or '.gz' files.
 
     Parameters
     ----------
@@ -253,42 +427,106 @@ def copy_files(src_dir_path, destination_dir_path, filenames):
         The path to the destination directory.
     filenames : list
         A list of filenames to be copied.
+    max_processes : int, optional
+        Maximum number of processes copying and decompressing files at once (-1 uses
+        all available cores).
+        Default: 1.
+    wait : bool, optional
+        Whether to wait for the copies to finish. If False, the files are copied on a
+        pool of processes in the background, and a function is returned that waits for
+        them to finish.
+        Default: True.
+
+    Returns
+    -------
+    None or function
+        If `wait` is False, the function to call to wait for the copies to finish.
+    """
+    tasks = [get_task(_copy_file, os.path.join(src_dir_path, file),
+                      os.path.join(destination_dir_path, file))
+             for file in filenames]
+    if wait and max_processes == 1:
+        run_tasks_singlethreaded(tasks)
+        return None
+    wait_for_copies = submit_tasks(tasks, max_processes=max_processes)
+    if wait:
+        wait_for_copies()
+        return None
+    return wait_for_copies
+
+
+def link_files(src_dir_path, destination_dir_path, filenames, hardlink=False):
+    """
+    Stage files from the source directory in the destination directory without
+    copying them, by symbolic (or hard) links.
+
+    Compressed ('.fz' or '.gz') files are linked under their own names, and only
+    decompressed when first needed, by `unpack_files`.
+
+    Parameters
+    ----------
+    src_dir_path : str
+        The path to the source directory.
+    destination_dir_path : str
+        The path to the destination directory.
+    filenames : list
+        A list of filenames to be linked.
+    hardlink : bool, optional
+        Whether to make hard links (which requires both directories to be on the
+        same filesystem) rather than symbolic links.
+        Default: False.
 
     Raises
     ------
     Exception
-        If there is an error while copying the files.
+        If there is an error while linking the files.
     """
     try:
         for file in filenames:
-            src_file = os.path.join(src_dir_path, file)
+            src_file = os.path.abspath(os.path.join(src_dir_path, file))
             dest_file = os.path.join(destination_dir_path, file)
-            # Handle common file compression for raw data
-            if re.search("\\.fz$", src_file):
-                dest_file = dest_file.rstrip(".fz")
-                if os.path.isfile(dest_file) \
-                        and os.path.getmtime(src_file) < os.path.getmtime(dest_file):
-                    continue
-                temph = pyfits.open(src_file)
-                pyfits.writeto(dest_file, data=temph[1].data, header=temph[1].header,
-                               output_verify="fix", overwrite=True)
-                temph.close()
-            elif re.search("\\.gz$", src_file):
-                dest_file = dest_file.rstrip(".gz")
-                if os.path.isfile(dest_file) \
-                        and os.path.getmtime(src_file) < os.path.getmtime(dest_file):
-                    continue
-                temph = pyfits.open(src_file)
-                pyfits.writeto(dest_file, data=temph[0].data, header=temph[0].header,
-                               output_verify="fix", overwrite=True)
-                temph.close()
+            if os.path.lexists(dest_file):
+                os.remove(dest_file)
+            if hardlink:
+                os.link(src_file, dest_file)
             else:
-                if os.path.isfile(dest_file) \
-                        and os.path.getmtime(src_file) < os.path.getmtime(dest_file):
-                    continue
-                shutil.copy(src_file, dest_file)
+                os.symlink(src_file, dest_file)
     except Exception as e:
-        print(f"Error copying files: {e}")
+        print(f"Error linking files: {e}")
+
+
+def unpack_files(data_dir, obs_list, max_processes=-1):
+    """
+    Decompress, in parallel, any of the listed frames that were staged by
+    `link_files` in compressed form only. Frames already present as plain FITS files
+    are left untouched.
+
+    Parameters
+    ----------
+    data_dir : str
+        The staging directory.
+    obs_list : list
+        The frames needed, as filenames without the '.fits' extension.
+    max_processes : int, optional
+        Maximum number of processes to use (-1 uses all available cores).
+        Default: -1.
+
+    Returns
+    -------
+    None
+    """
+    tasks = []
+    for fn in set(obs_list):
+        dest_file = os.path.join(data_dir, f"{fn}.fits")
+        if os.path.isfile(dest_file):
+            continue
+        for ext in [".fz", ".gz"]:
+            if os.path.isfile(dest_file + ext):
+                tasks.append(get_task(_decompress_file, dest_file + ext, dest_file))
+                break
+    if tasks:
+        print(f"Decompressing {len(tasks)} raw frames")
+        map_tasks(tasks, max_processes=max_processes)
 
 
 def get_file_names(src_dir_path, glob_pattern):
@@ -317,6 +555,30 @@ def get_file_names(src_dir_path, glob_pattern):
     return names
 
 
+def get_file_hash(filename, blocksize=2**20):
+    """
+    Compute the SHA-256 hash of a file's contents.
+
+    Parameters
+    ----------
+    filename : str
+        The path to the file.
+    blocksize : int, optional
+        Number of bytes to read at a time.
+        Default: 1 MiB.
+
+    Returns
+    -------
+    str
+        The hexadecimal digest of the file contents.
+    """
+    file_hash = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(blocksize), b""):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
 def load_config_file(filename):
     """
     Load a configuration file in JSON5 format.
@@ -11,6 +11,7 @@ import pickle
 import re
 import scipy.interpolate
 import scipy.optimize as op
+import warnings
 
 from pywifes import optical_model as om
 from pywifes import quality_plots as qp
@@ -195,7 +196,7 @@ def _mpfit_gauss_line(packaged_args):
     fa = {"x": xfit, "y": yfit}
     parinfo = [
         {
-            "value": yfit[xfit == guess_center],
+            "value": yfit[xfit == guess_center][0],
             "fixed": 0,
             "limited": [1, 0],
             "limits": [0.0, 0.0],
@@ -261,155 +262,336 @@ def _get_loggauss_arc_fit(subbed_arc_data, peak_centers, width_guess):
     return numpy.array(fitted_centers)
 
 
-def _set_fitted_centers(line_center_pairs, fitted_centers):
-    for line_center_pair in line_center_pairs:
-        line_ind = line_center_pair[0]
-        fitted_center = line_center_pair[1]
-        fitted_centers[line_ind] = float(fitted_center)
-    return fitted_centers
+def _batch_gauss_fit(xfit, yfit, mask, p0, lower, upper, max_iter=200, xtol=1e-10):
+    """
+    Fit a Gaussian (see gauss_line) to each of many line windows at once, with a
+    vectorised Levenberg-Marquardt whose steps are clipped to the parameter bounds.
+
+    Parameters
+    ----------
+    xfit, yfit : numpy.ndarray
+        Pixel positions and fluxes of the windows, shape (nlines, npix), padded
+        beyond the end of the shorter windows.
+    mask : numpy.ndarray
+        Boolean array of the same shape, True for the pixels within each window.
+    p0 : numpy.ndarray
+        Initial amplitude, center and width of each line, shape (nlines, 3).
+    lower, upper : numpy.ndarray
+        Bounds of the parameters (may be infinite), same shape as p0.
+    max_iter : int, optional
+        Maximum number of iterations.
+        Default: 200.
+    xtol : float, optional
+        Relative change of the parameters below which a fit has converged.
+        Default: 1e-10.
+
+    Returns
+    -------
+    numpy.ndarray
+        Fitted amplitude, center and width of each line, shape (nlines, 3).
+    """
+    p = numpy.clip(p0, lower, upper)
+    weight = mask.astype("d")
+    damping = numpy.full(len(p), 1e-3)
+    eye = numpy.eye(3)
+
+    def chi2(params, inds):
+        resid = (yfit[inds] - gauss_line(params.T[:, :, None], xfit[inds])) * weight[inds]
+        return numpy.sum(resid**2, axis=1)
+
+    curr_chi2 = chi2(p, slice(None))
+    active = numpy.ones(len(p), dtype=bool)
+    for _ in range(max_iter):
+        inds = numpy.nonzero(active)[0]
+        if len(inds) == 0:
+            break
+        pa = p[inds]
+        xa = xfit[inds]
+        amp, ctr, wid = (pa[:, i:i + 1] for i in range(3))
+        dx = xa - ctr
+        expo = numpy.exp(-(dx**2) / (2 * wid**2)) * weight[inds]
+        model = amp * expo
+        jac = numpy.stack(
+            [expo, model * dx / wid**2, model * dx**2 / wid**3], axis=2
+        )
+        resid = (yfit[inds] - model) * weight[inds]
+        jtj = numpy.einsum("nki,nkj->nij", jac, jac)
+        jtr = numpy.einsum("nki,nk->ni", jac, resid)
+        # Marquardt scaling of the damping, guarded against degenerate parameters
+        diag = numpy.maximum(numpy.diagonal(jtj, axis1=1, axis2=2), 1e-30)
+        step = numpy.linalg.solve(
+            jtj + damping[inds, None, None] * diag[:, :, None] * eye,
+            jtr[:, :, None],
+        )[:, :, 0]
+        new_p = pa + step
+        # the sign of the width is degenerate
+        new_p[:, 2] = numpy.abs(new_p[:, 2])
+        new_p = numpy.clip(new_p, lower[inds], upper[inds])
+        new_chi2 = chi2(new_p, inds)
+        better = new_chi2 <= curr_chi2[inds]
+        small = numpy.all(
+            numpy.abs(new_p - pa) <= xtol * (numpy.abs(pa) + xtol), axis=1
+        )
+        p[inds[better]] = new_p[better]
+        curr_chi2[inds[better]] = new_chi2[better]
+        damping[inds] = numpy.where(
+            better, damping[inds] * 0.1, damping[inds] * 10.0
+        )
+        # stop the converged fits, and those that cannot improve any further
+        active[inds[(better & small) | (damping[inds] > 1e10)]] = False
+    return p
 
 
 def _get_gauss_arc_fit(
-    fit_function, subbed_arc_data, peak_centers, width_guess, multithread=True
+    find_method, subbed_arc_data, peak_centers, width_guess, line_rows=None
 ):
-    N = len(subbed_arc_data)
-    x = numpy.arange(N, dtype="d")
-    y = subbed_arc_data
-    num_arcs = len(peak_centers)
+    """
+    Fit the centers of arc lines with Gaussians.
 
-    jobs = []
-    fitted_centers = numpy.zeros_like(peak_centers, dtype=float)
-    for i in range(num_arcs):
-        curr_ctr_guess = peak_centers[i]
-        ifit_lo = int(curr_ctr_guess - 5 * width_guess)
-        ifit_hi = int(curr_ctr_guess + 5 * width_guess)
-        xfit = x[ifit_lo:ifit_hi]
-        yfit = y[ifit_lo:ifit_hi]
+    The window of +/-5 `width_guess` around each guessed center is stacked into
+    one padded array. For 'mpfit', all windows are fit at once by
+    _batch_gauss_fit, with the bounds and rejection rules of _mpfit_gauss_line.
+    For any other `find_method`, each window is fit by _lsq_gauss_line, as the
+    unbounded scipy fit can settle on a different minimum than the batched one.
 
-        if len(yfit) > 0 and numpy.count_nonzero(yfit > 0.2 * yfit.max()) > 0:
-            jobs.append((i, curr_ctr_guess, width_guess, xfit, yfit))
-        else:
-            fitted_centers[i] = float("nan")
-
-    if len(jobs) > 0:
-        if multithread:
-            # NOTE: The number of cores available to this process may be lower. See #36
-            num_cpus = os.cpu_count()
-            with multiprocessing.Pool(processes=num_cpus) as mypool:
-                chunksize = math.ceil(len(jobs) / num_cpus)
-                # line_center_pairs is lazily evaluated and must be read within the pool's scope.
-                line_center_pairs = mypool.imap_unordered(
-                    fit_function, jobs, chunksize=chunksize
-                )
-                fitted_centers = _set_fitted_centers(line_center_pairs, fitted_centers)
-        else:
-            line_center_pairs = [fit_function(job) for job in jobs]
-            fitted_centers = _set_fitted_centers(line_center_pairs, fitted_centers)
+    Parameters
+    ----------
+    find_method : str
+        'mpfit' or 'least_squares'.
+    subbed_arc_data : numpy.ndarray
+        A row of arc data, or the rows of a whole slitlet.
+    peak_centers : array_like
+        Guessed (pixel) centers of the lines.
+    width_guess : float
+        Guessed width of the lines.
+    line_rows : array_like, optional
+        Row of `subbed_arc_data` of each line, if it is 2D.
+        Default: None.
+
+    Returns
+    -------
+    numpy.ndarray
+        Fitted centers, NaN for the rejected lines.
+    """
+    arc_rows = numpy.atleast_2d(subbed_arc_data)
+    N = arc_rows.shape[1]
+    peak_centers = numpy.asarray(peak_centers, dtype=float)
+    num_arcs = len(peak_centers)
+    fitted_centers = numpy.full(num_arcs, float("nan"))
+    if num_arcs == 0:
+        return fitted_centers
+    if line_rows is None:
+        line_rows = numpy.zeros(num_arcs, dtype=int)
+    line_rows = numpy.asarray(line_rows, dtype=int)
+
+    # the same windows as slicing x[int(ctr - 5 * width):int(ctr + 5 * width)]
+    ifit_lo = (peak_centers - 5 * width_guess).astype(int)
+    ifit_hi = (peak_centers + 5 * width_guess).astype(int)
+    start = numpy.where(ifit_lo < 0, numpy.maximum(ifit_lo + N, 0), numpy.minimum(ifit_lo, N))
+    stop = numpy.where(ifit_hi < 0, numpy.maximum(ifit_hi + N, 0), numpy.minimum(ifit_hi, N))
+    npix = max(int(numpy.max(stop - start)), 1)
+    pix = start[:, None] + numpy.arange(npix)
+    mask = pix < stop[:, None]
+    pix = numpy.minimum(pix, N - 1)
+    xfit = pix.astype("d")
+    yfit = numpy.where(mask, arc_rows[line_rows[:, None], pix], 0.0)
+
+    # skip the empty windows, and those with no pixel above 20% of their peak
+    ymax = numpy.max(numpy.where(mask, yfit, -numpy.inf), axis=1)
+    fit_inds = numpy.nonzero(ymax > 0)[0]
+    if len(fit_inds) == 0:
+        return fitted_centers
+    xfit, yfit, mask = xfit[fit_inds], yfit[fit_inds], mask[fit_inds]
+    ctrs = peak_centers[fit_inds]
+    nfit = len(fit_inds)
 
+    if find_method == "mpfit":
+        init_amp = arc_rows[line_rows[fit_inds], numpy.clip(ctrs.astype(int), 0, N - 1)]
+        p0 = numpy.stack(
+            [init_amp, ctrs, numpy.full(nfit, width_guess / 2.0)], axis=1
+        )
+        lower = numpy.stack(
+            [numpy.zeros(nfit), ctrs - width_guess, numpy.full(nfit, width_guess / 20.0)],
+            axis=1,
+        )
+        upper = numpy.stack(
+            [numpy.full(nfit, numpy.inf), ctrs + width_guess, numpy.full(nfit, width_guess)],
+            axis=1,
+        )
+        p1 = _batch_gauss_fit(xfit, yfit, mask, p0, lower, upper)
+        # Hum ... line too wide = problem
+        bad = p1[:, 2] >= width_guess
+        fitted_centers[fit_inds] = numpy.where(bad, float("nan"), p1[:, 1])
+    else:
+        for j, i in enumerate(fit_inds):
+            fitted_centers[i] = _lsq_gauss_line(
+                (i, ctrs[j], width_guess, xfit[j][mask[j]], yfit[j][mask[j]])
+            )[1]
     return fitted_centers
 
 
 def _get_arc_fit(
-    subbed_arc_data, peak_centers, width_guess, find_method="mpfit", multithread=True
+    subbed_arc_data, peak_centers, width_guess, find_method="mpfit", line_rows=None
 ):
 
     if find_method == "loggauss":
         return _get_loggauss_arc_fit(subbed_arc_data, peak_centers, width_guess)
 
-    fit_function = _mpfit_gauss_line if find_method == "mpfit" else _lsq_gauss_line
     return _get_gauss_arc_fit(
-        fit_function, subbed_arc_data, peak_centers, width_guess, multithread
+        find_method, subbed_arc_data, peak_centers, width_guess, line_rows=line_rows
     )
 
 
-def quick_arcline_fit(
+def _find_arcline_candidates(
     arc_data,
     find_method="loggauss",
     flux_threshold=100.0,
     deriv_threshold=40.0,
-    width_guess=2.0,
     flux_saturation=50000.0,
     prev_centers=None,
-    multithread=False,
 ):
-    N = len(arc_data)
-    arc_deriv = arc_data[1:] - arc_data[:-1]
-    p1_data = numpy.zeros(N, dtype="d")
-    p1_data[:-1] = arc_data[1:]
-    m1_data = numpy.zeros(N, dtype="d")
-    m1_data[1:] = arc_data[:-1]
-    p1_deriv = numpy.zeros(N, dtype="d")
-    p1_deriv[:-1] = arc_deriv
-    m1_deriv = numpy.zeros(N, dtype="d")
-    m1_deriv[1:] = arc_deriv
-    p2_deriv = numpy.zeros(N, dtype="d")
-    p2_deriv[:-2] = arc_deriv[1:]
-    m2_deriv = numpy.zeros(N, dtype="d")
-    m2_deriv[2:] = arc_deriv[:-1]
-    init_inds = numpy.nonzero(
-        (arc_data <= flux_saturation)
-        * (arc_data >= flux_threshold)
-        * (m1_data >= flux_threshold)
-        * (p1_data >= flux_threshold)
-        * ((m1_deriv >= deriv_threshold) + (m2_deriv >= deriv_threshold))
-        * ((p1_deriv <= -1.0 * deriv_threshold) + (p2_deriv <= -1.0 * deriv_threshold))
-    )[0]
-    # excise adjacent indices
-    ind_diffs = init_inds[1:] - init_inds[:-1]
-    full_diffs = numpy.zeros(len(init_inds))
-    full_diffs[1:] = ind_diffs
-    full_diffs[0] = full_diffs[1]  # if 1st was adjacent to 0th, also remove 0th
-    potential_line_inds = init_inds[numpy.nonzero(full_diffs != 1)[0]]
+    """
+    Find the candidate arc line peaks in a row of arc data, or in all the rows
+    of a slitlet at once.
+
+    Parameters
+    ----------
+    arc_data : numpy.ndarray
+        A row of arc data, or the rows of a slitlet.
+    find_method : str, optional
+        Line fitting method. For 'mpfit' and 'least_squares', the candidates
+        are matched to `prev_centers`.
+        Default: 'loggauss'.
+    flux_threshold : float, optional
+        Minimum flux of a peak and its neighbours.
+        Default: 100.
+    deriv_threshold : float, optional
+        Minimum flux derivative on either side of a peak.
+        Default: 40.
+    flux_saturation : float, optional
+        Maximum flux of a peak.
+        Default: 50000.
+    prev_centers : array_like, optional
+        Line centers already fitted in another (e.g. the middle) row.
+        Default: None.
+
+    Returns
+    -------
+    tuple of numpy.ndarray
+        Row and pixel index of each candidate peak, sorted by row then pixel.
+    """
+    arc_rows = numpy.atleast_2d(arc_data)
+    nrows, N = arc_rows.shape
+    arc_deriv = arc_rows[:, 1:] - arc_rows[:, :-1]
+    p1_data = numpy.zeros((nrows, N), dtype="d")
+    p1_data[:, :-1] = arc_rows[:, 1:]
+    m1_data = numpy.zeros((nrows, N), dtype="d")
+    m1_data[:, 1:] = arc_rows[:, :-1]
+    p1_deriv = numpy.zeros((nrows, N), dtype="d")
+    p1_deriv[:, :-1] = arc_deriv
+    m1_deriv = numpy.zeros((nrows, N), dtype="d")
+    m1_deriv[:, 1:] = arc_deriv
+    p2_deriv = numpy.zeros((nrows, N), dtype="d")
+    p2_deriv[:, :-2] = arc_deriv[:, 1:]
+    m2_deriv = numpy.zeros((nrows, N), dtype="d")
+    m2_deriv[:, 2:] = arc_deriv[:, :-1]
+    peaks = (
+        (arc_rows <= flux_saturation)
+        & (arc_rows >= flux_threshold)
+        & (m1_data >= flux_threshold)
+        & (p1_data >= flux_threshold)
+        & ((m1_deriv >= deriv_threshold) | (m2_deriv >= deriv_threshold))
+        & ((p1_deriv <= -1.0 * deriv_threshold) | (p2_deriv <= -1.0 * deriv_threshold))
+    )
+    # excise adjacent indices, i.e. those right after another candidate ...
+    prev_adjacent = numpy.zeros_like(peaks)
+    prev_adjacent[:, 1:] = peaks[:, :-1]
+    line_rows, line_inds = numpy.nonzero(peaks & ~prev_adjacent)
+    # ... and the 1st of a row if the 2nd was adjacent to it
+    first = numpy.ones(len(line_rows), dtype=bool)
+    first[1:] = line_rows[1:] != line_rows[:-1]
+    next_adjacent = peaks[line_rows, numpy.minimum(line_inds + 1, N - 1)] & (line_inds < N - 1)
+    keep = ~(first & next_adjacent)
+    line_rows = line_rows[keep]
+    line_inds = line_inds[keep]
 
     # Ok, so roughly the same lines will be selected in each row.
     # 30-50% are rubbsih ... so, if we do it once, we could avoid to do it
     # again and again ...
-    # Use Xcorrelation to do that ...
     if (
         find_method == "mpfit" or find_method == "least_squares"
     ) and prev_centers is not None:
-        # Find the shift between this set of lines and the previous ones
-        prev_lines = numpy.zeros(N)
-        curr_lines = numpy.zeros(N)
-        for j in prev_centers:
-            prev_lines[int(j)] = 1.0
-        for j in potential_line_inds:
-            curr_lines[int(j)] = 1.0
-
-        corr_out = numpy.correlate(prev_lines, curr_lines, mode="full")
-        shift = (numpy.where(corr_out == numpy.max(corr_out))[0] - N)[0] + 1
-        # Given the best shift, just select the lines that we could fit with mpfit previously !
-        checked_ones = []
-        for j in potential_line_inds:
-            if (1 <= j + shift < len(prev_lines) - 1) and (
-                (prev_lines[j + shift] + curr_lines[j] == 2.0)
-                or (prev_lines[j + shift + 1] + curr_lines[j] == 2.0)
-                or (prev_lines[j + shift - 1] + curr_lines[j] == 2.0)
-            ):
-                # these two lines should be in to get 'all' the good lines
-                # in practice, it doesn't matter .. we have enough lines !
-                # This saves ~200 s or so ...
-                checked_ones = numpy.append(checked_ones, [j])
-
-        potential_line_inds = numpy.array(checked_ones)
+        prev_inds = numpy.unique(numpy.asarray(prev_centers).astype(int))
+        prev_lines = numpy.zeros(N + 2, dtype=bool)
+        prev_lines[prev_inds + 1] = True
+        # Find the shift between the lines of each row and the previous ones:
+        # the most common (and then the smallest) offset between them, as
+        # maximises the cross-correlation of their positions
+        pair_rows = numpy.repeat(line_rows, len(prev_inds))
+        pair_shifts = (prev_inds[None, :] - line_inds[:, None]).ravel()
+        pair_counts = numpy.bincount(
+            pair_rows * (2 * N) + pair_shifts + N, minlength=nrows * 2 * N
+        ).reshape(nrows, 2 * N)
+        row_shift = numpy.argmax(pair_counts, axis=1) - N
+        # Given the best shift, just select the lines that we could fit with
+        # mpfit previously, i.e. with a previous line within 1 pixel
+        shifted = line_inds + row_shift[line_rows]
+        in_range = (shifted >= 1) & (shifted < N - 1)
+        shifted = numpy.clip(shifted, 0, N - 1) + 1
+        matched = in_range & (
+            prev_lines[shifted] | prev_lines[shifted + 1] | prev_lines[shifted - 1]
+        )
+        line_rows = line_rows[matched]
+        line_inds = line_inds[matched]
+
+    return line_rows, line_inds
+
 
+def _good_fitted_lines(arc_data, fitted_ctrs, flux_threshold, line_rows=None):
+    # indices of the fitted lines that are not noise
+    arc_rows = numpy.atleast_2d(arc_data)
+    if line_rows is None:
+        line_rows = numpy.zeros(len(fitted_ctrs), dtype=int)
+    found = numpy.nonzero(fitted_ctrs == fitted_ctrs)[0]
+    next_peaks = numpy.zeros(len(fitted_ctrs), dtype="d")
+    next_peaks[found] = arc_rows[line_rows[found], fitted_ctrs[found].astype(int)]
+    return numpy.nonzero(next_peaks >= flux_threshold)[0]
+
+
+def quick_arcline_fit(
+    arc_data,
+    find_method="loggauss",
+    flux_threshold=100.0,
+    deriv_threshold=40.0,
+    width_guess=2.0,
+    flux_saturation=50000.0,
+    prev_centers=None,
+    multithread=None,
+):
+    # NOTE: multithread is deprecated and ignored, the Gaussian fits of a row
+    # are done in this process
+    if multithread is not None:
+        warnings.warn(
+            "quick_arcline_fit: multithread is deprecated and has no effect",
+            DeprecationWarning,
+            stacklevel=2,
+        )
+    _, potential_line_inds = _find_arcline_candidates(
+        arc_data,
+        find_method=find_method,
+        flux_threshold=flux_threshold,
+        deriv_threshold=deriv_threshold,
+        flux_saturation=flux_saturation,
+        prev_centers=prev_centers,
+    )
     # fit the centers, make sure it didn't fit noise
     next_ctrs = _get_arc_fit(
         arc_data,
         potential_line_inds,
         width_guess,
         find_method=find_method,
-        multithread=multithread,
     )
-    next_peak_list = []
-    for x in next_ctrs:
-        if x == x:
-            next_peak_list.append(arc_data[int(x)])
-        else:
-            next_peak_list.append(0.0)
-    next_peaks = numpy.array(next_peak_list)
-    good_inds = numpy.nonzero(next_peaks >= flux_threshold)[0]
-    return next_ctrs[good_inds]
+    return next_ctrs[_good_fitted_lines(arc_data, next_ctrs, flux_threshold)]
 
 
 # ------------------------------------------------------------------------
@@ -433,19 +615,6 @@ def evaluate_wsol_poly(x_array, y_array, xpoly, ypoly):
     return wave_array
 
 
-def _set_ref_array(row_refs_pairs, init_x_array, init_y_array):
-    # Create the storage array for the reference wavelength
-    ref_array = numpy.zeros_like(init_x_array)
-    for row_refs_pair in row_refs_pairs:
-        row_ind = row_refs_pair[0]
-        refs = row_refs_pair[1]
-
-        ref_row_inds = init_y_array == row_ind + 1
-        if len(ref_row_inds) > 0:
-            ref_array[ref_row_inds] = refs
-    return ref_array
-
-
 # ------------------------------------------------------------------------
 # FUNCTION TO FIND LINES AND GUESS THEIR WAVELENGTHS
 # NOTE: OPERATES ON DATA FROM A SINGLE SLITLET!!!
@@ -464,10 +633,18 @@ def find_lines_and_guess_refs(
     yzp=0,
     flux_threshold_nsig=3.0,
     deriv_threshold_nsig=1.0,
-    multithread=True,
+    multithread=None,
     plot=False,
     plot_dir=".",
 ):
+    # NOTE: multithread is deprecated and ignored, the slitlets are run in
+    # parallel by derive_wifes_optical_wave_solution instead
+    if multithread is not None:
+        warnings.warn(
+            "find_lines_and_guess_refs: multithread is deprecated and has no effect",
+            DeprecationWarning,
+            stacklevel=2,
+        )
     # -----------------------------------
     # get arclines
     if ref_arclines is None:
@@ -512,26 +689,48 @@ def find_lines_and_guess_refs(
             flux_threshold=flux_threshold,
             deriv_threshold=deriv_threshold,
             width_guess=2.0,
-            multithread=multithread,
         )
     else:
         mid_fit_centers = None  # don't do it for the loggauss method ...
-    # !!! MJI If we cared, this is the part here that should be parallelised.
-    for i in range(8 // bin_y, nrows - 8 // bin_y):
-        test_z = slitlet_data[i, :]
-        fitted_ctrs = quick_arcline_fit(
-            test_z,
+    if find_method == "loggauss":
+        for i in range(8 // bin_y, nrows - 8 // bin_y):
+            test_z = slitlet_data[i, :]
+            fitted_ctrs = quick_arcline_fit(
+                test_z,
+                find_method=find_method,
+                flux_threshold=flux_threshold,
+                deriv_threshold=deriv_threshold,
+                width_guess=2.0,
+            )
+            for ctr in fitted_ctrs:
+                full_fitted_x.append(ctr)
+                full_fitted_y.append(i + 1)
+        init_y_array = numpy.array(full_fitted_y)
+        init_x_array = numpy.array(full_fitted_x)
+    else:
+        # Find the candidate lines of every row, then fit the Gaussians
+        # of the whole slitlet at once.
+        first_row = 8 // bin_y
+        cand_rows, cand_ctrs = _find_arcline_candidates(
+            slitlet_data[first_row:nrows - first_row, :],
             find_method=find_method,
             flux_threshold=flux_threshold,
             deriv_threshold=deriv_threshold,
-            width_guess=2.0,
             prev_centers=mid_fit_centers,
         )
-        for ctr in fitted_ctrs:
-            full_fitted_x.append(ctr)
-            full_fitted_y.append(i + 1)
-    init_y_array = numpy.array(full_fitted_y)
-    init_x_array = numpy.array(full_fitted_x)
+        cand_rows += first_row
+        fitted_ctrs = _get_arc_fit(
+            slitlet_data,
+            cand_ctrs.astype(float),
+            2.0,
+            find_method=find_method,
+            line_rows=cand_rows,
+        )
+        good_inds = _good_fitted_lines(
+            slitlet_data, fitted_ctrs, flux_threshold, line_rows=cand_rows
+        )
+        init_y_array = cand_rows[good_inds] + 1
+        init_x_array = fitted_ctrs[good_inds]
     if verbose:
         print("  done in", datetime.datetime.now() - start)
     # ------------------------------
@@ -630,15 +829,6 @@ def find_lines_and_guess_refs(
             ref_arc[:, 0] = ncols - ref_arc[:, 0]
         f.close()
 
-        # Loop through each row (each spectrum of the slice)
-        # It is slow, so, I use the multiprocessing package to speed things up
-        # Package is installed by default for Python v.2.6 and above.
-        # I use the 'Pool' concept - check automatically the number of CPU
-        # available. No need to set mutlithread at all !
-        # Some quick tests showed that the 'Pool' approach is much faster than
-        # simply pilling up many 'Process' ...
-        #
-
         # Stretch value is not varying much over 1 slice.
         # So, get it in the middle, and use it throughout.
         # Gain some ~6.3 sec per slice by doing this !
@@ -648,32 +838,18 @@ def find_lines_and_guess_refs(
             (mid_row, ncols, init_x_array[mid_row_ind], ref_arc, None, True)
         )
 
-        jobs = []
-        for i in range(nrows):
-            row_inds = init_y_array == i + 1
-            # only use rows where enough lines are found
-            if len(init_x_array[row_inds]) >= 0.5 * len(ref_arc[:, 0]):
-                jobs.append(
-                    (i, ncols, init_x_array[row_inds], ref_arc, [best_stretch], False)
-                )
-
-        ref_array = None
-        if multithread:
-            # NOTE: The number of cores available to this process may be lower. See #36
-            num_cpus = os.cpu_count()
-            chunksize = math.ceil(len(jobs) / num_cpus)
-            if verbose:
-                print(f"  ... assign lambdas using up to {num_cpus} cpu(s) ...")
-            with multiprocessing.Pool(num_cpus) as pool:
-                # row_refs_pairs is lazily evaluated and must be read within the pool's scope.
-                row_refs_pairs = pool.imap_unordered(
-                    _xcorr_shift_all, jobs, chunksize=chunksize
-                )
-                ref_array = _set_ref_array(row_refs_pairs, init_x_array, init_y_array)
-        else:
-            # Completely avoid using Pool in case of an ipython debugging environment.
-            row_refs_pairs = [_xcorr_shift_all(job) for job in jobs]
-            ref_array = _set_ref_array(row_refs_pairs, init_x_array, init_y_array)
+        # Then get the shift of each row, and identify its lines, for all
+        # rows at once
+        line_rows = init_y_array.astype(int) - 1
+        _, shifts = _xcorr_correlate(
+            line_rows, init_x_array, nrows, ncols, ref_arc[:, 0], [best_stretch]
+        )
+        ref_array = _xcorr_identify(
+            line_rows, init_x_array, ncols, ref_arc, best_stretch, shifts[:, 0]
+        )
+        # only use rows where enough lines are found
+        row_counts = numpy.bincount(line_rows, minlength=nrows)
+        ref_array[row_counts[line_rows] < 0.5 * len(ref_arc[:, 0])] = 0.0
 
         # Create array with only detected lines
         good_inds = ref_array > 0
@@ -838,6 +1014,128 @@ def xcorr_shift_grid(slitlet_data, wave_guess, ref_interp):
     return shift_poly, best_stretch
 
 
+def _xcorr_correlate(line_rows, line_x, nrows, ncols, ref_x, stretches):
+    """
+    Cross-correlate the positions of the arc lines found in each row with the
+    stretched positions of the reference lines.
+
+    The correlation of the two pseudo-spectra (1 at the pixel of each line, 0
+    elsewhere) at each shift is the number of line pairs separated by that
+    shift, so it is counted from the pairwise offsets of the lines instead of
+    correlating arrays of `ncols` pixels, for all rows at once.
+
+    Parameters
+    ----------
+    line_rows : numpy.ndarray
+        Row (from 0) of each line.
+    line_x : numpy.ndarray
+        Pixel position of each line.
+    nrows, ncols : int
+        Dimensions of the slitlet.
+    ref_x : numpy.ndarray
+        Pixel positions of the reference lines.
+    stretches : array_like
+        Stretches of the reference positions to try.
+
+    Returns
+    -------
+    corrs, shifts : numpy.ndarray
+        Maximum of numpy.correlate(pseudo_obs, pseudo_ref, mode="full") and
+        (first) index of the maximum, for each row and stretch.
+    """
+    nlags = 2 * ncols - 1
+    obs_key = numpy.unique(
+        numpy.asarray(line_rows, dtype=int) * ncols + numpy.asarray(line_x).astype(int)
+    )
+    obs_rows, obs_pix = numpy.divmod(obs_key, ncols)
+    corrs = numpy.zeros((nrows, len(stretches)))
+    shifts = numpy.zeros((nrows, len(stretches)), dtype=int)
+    for k, stretch in enumerate(stretches):
+        ref_pix = _stretched_ref_pixels(ref_x, stretch, ncols)
+        ref_pix = numpy.unique(ref_pix[ref_pix >= 0])
+        lags = obs_pix[:, None] - ref_pix[None, :] + ncols - 1
+        counts = numpy.bincount(
+            (obs_rows[:, None] * nlags + lags).ravel(), minlength=nrows * nlags
+        ).reshape(nrows, nlags)
+        corrs[:, k] = numpy.max(counts, axis=1)
+        shifts[:, k] = numpy.argmax(counts, axis=1)
+    return corrs, shifts
+
+
+def _stretched_ref_pixels(ref_x, stretch, ncols):
+    # Pixels of the stretched reference lines that fall in a pseudo-spectrum
+    # of ncols pixels (negative pixels wrapping around, as when indexing it)
+    ref_pix = (ref_x * stretch).astype(int)
+    ref_pix = numpy.where(ref_pix < 0, ref_pix + ncols, ref_pix)
+    return numpy.where(ref_pix < ncols, ref_pix, -1)
+
+
+def _xcorr_identify(line_rows, line_x, ncols, ref_arc, stretch, row_shifts):
+    """
+    Associate the isolated arc lines of each row with the wavelength of the
+    reference line at the same position, once stretched and shifted.
+
+    Parameters
+    ----------
+    line_rows : numpy.ndarray
+        Row (from 0) of each line.
+    line_x : numpy.ndarray
+        Pixel position of each line.
+    ncols : int
+        Number of columns of the slitlet.
+    ref_arc : numpy.ndarray
+        Pixel positions and wavelengths of the reference lines.
+    stretch : float
+        Stretch of the reference positions.
+    row_shifts : numpy.ndarray
+        Shift of the reference positions in each row, as the index of the
+        maximum returned by _xcorr_correlate.
+
+    Returns
+    -------
+    numpy.ndarray
+        Wavelength of each line, or 0 if it was not identified.
+    """
+    line_rows = numpy.asarray(line_rows, dtype=int)
+    line_x = numpy.asarray(line_x)
+    ref_array = numpy.zeros_like(line_x)
+    if len(line_x) == 0:
+        return ref_array
+    # stretched reference spectrum, where the last of several lines falling
+    # in the same pixel wins
+    ref_pix = _stretched_ref_pixels(ref_arc[:, 0], stretch, ncols)
+    in_range = ref_pix >= 0
+    pseudo_lam_bes = numpy.zeros(ncols)
+    pseudo_lam_bes[ref_pix[in_range]] = ref_arc[:, 1][in_range]
+
+    # Make sure there are no other line within min_line_spacing
+    # on either side (in the same row)
+    min_line_spacing = 10  # Original: 10 "Angstroem" (probably pixels)
+    order = numpy.argsort(line_rows, kind="stable")
+    rows = line_rows[order]
+    pix = line_x[order].astype(int)
+    isolated = numpy.ones(len(pix), dtype=bool)
+    same_row = rows[1:] == rows[:-1]
+    isolated[1:] &= ~same_row | (pix[1:] > pix[:-1] + min_line_spacing)
+    isolated[:-1] &= ~same_row | (pix[:-1] < pix[1:] - min_line_spacing)
+
+    # Finally, associate each identified line with the wavelength of the one
+    # reference line within 2 pixels of the shifted reference spectrum
+    window = pix[:, None] + numpy.arange(-2, 3)
+    src = window - (row_shifts[rows] - ncols)[:, None]
+    valid = (window < ncols) & (src >= 0) & (src < ncols)
+    window_lam = numpy.where(
+        valid, pseudo_lam_bes[numpy.clip(src, 0, ncols - 1)], 0.0
+    )
+    found = (
+        isolated
+        & (pix >= 2)
+        & (numpy.count_nonzero(window_lam > 0, axis=1) == 1)
+    )
+    ref_array[order[found]] = numpy.max(window_lam[found], axis=1)
+    return ref_array
+
+
 def _xcorr_shift_all(packaged_args):
     (
         this_row,
@@ -851,90 +1149,24 @@ def _xcorr_shift_all(packaged_args):
     if stretches is None:
         stretches = numpy.arange(0.98, 1.03, 0.001)
 
-    corrs = numpy.zeros_like(stretches)
-    shifts = numpy.zeros_like(stretches)
     # Try different 'stretch and shift values to match the
     # reference line position. This can be approximative, but not too much !
-    for k, stretch in enumerate(stretches):
-        # Create stretched, temporary "spectrum"
-        pseudo_x_obs = numpy.zeros(ncols)
-        pseudo_x_bes = numpy.zeros(ncols)
-        for j in this_init_x_array:
-            pseudo_x_obs[int(j)] = 1.0
-        for j in this_ref_arc[:, 0]:
-            if int(j * stretch) < len(pseudo_x_bes):
-                pseudo_x_bes[int(j * stretch)] = 1.0
-
-        # Cross-correlate pseudo-ref spectrum with real arc lines
-        corr_out = numpy.correlate(pseudo_x_obs, pseudo_x_bes, mode="full")
-        corrs[k] = numpy.max(corr_out)
-        shifts[k] = numpy.argmax(corr_out)
+    line_rows = numpy.zeros(len(this_init_x_array), dtype=int)
+    corrs, shifts = _xcorr_correlate(
+        line_rows, this_init_x_array, 1, ncols, this_ref_arc[:, 0], stretches
+    )
 
     # Find best shift and stretch based on X correlation results
-    best_shift = int(shifts[numpy.argmax(corrs)])
-    best_stretch = stretches[numpy.argmax(corrs)]
+    best = numpy.argmax(corrs[0])
+    best_stretch = stretches[best]
 
     # Just get the best stretch and return, or keep going.
     if get_stretch:
         return best_stretch
 
-    # if verbose :
-    #    print('   row:',this_row+1,'best_shift/stretch:',best_shift,best_stretch)
-
-    # Some more temporary storage structures
-    x_obs = numpy.zeros(ncols)
-    pseudo_x_obs = numpy.zeros(ncols)
-    pseudo_x_bes = numpy.zeros(ncols)
-    final_x_bes = numpy.zeros(ncols)
-    pseudo_lam_bes = numpy.zeros(ncols)
-    final_lam_bes = numpy.zeros(ncols)
-
-    # re-create best matching pseudo reference spectrum
-    for j in this_init_x_array:
-        pseudo_x_obs[int(j)] = 1.0
-        x_obs[int(j)] = j
-    for line, j in enumerate(this_ref_arc[:, 0]):
-        # Stretch it ...
-        if int(j * best_stretch) < len(pseudo_x_bes):
-            pseudo_x_bes[int(j * best_stretch)] = 1.0
-            pseudo_lam_bes[int(j * best_stretch)] = this_ref_arc[:, 1][line]
-        # Shift it ...
-        if best_shift <= ncols:
-            final_x_bes[0:best_shift] = pseudo_x_bes[-best_shift:]
-            final_lam_bes[0:best_shift] = pseudo_lam_bes[-best_shift:]
-        else:
-            final_x_bes[best_shift - ncols:] = pseudo_x_bes[0:ncols - best_shift]
-            final_lam_bes[best_shift - ncols:] = pseudo_lam_bes[0:ncols - best_shift]
-
-    # Make sure there are no other line within min_line_spacing
-    # on either side
-    min_line_spacing = 10  # Original: 10 "Angstroem" (probably pixels)
-    this_ref_array = numpy.zeros_like(this_init_x_array)
-    for j, item in enumerate(this_init_x_array):
-        if j > 0:
-            cond1 = int(item) > (int(this_init_x_array[j - 1]) + min_line_spacing)
-        else:
-            cond1 = True
-        if j < len(this_init_x_array) - 1:
-            cond2 = int(item) < (int(this_init_x_array[j + 1]) - min_line_spacing)
-        else:
-            cond2 = True
-        # Finally, associate each identified line
-        # with appropriate wavelength.
-        if cond1 and cond2:
-            loc = int(numpy.where(x_obs == item)[0])
-            if (
-                len(
-                    final_lam_bes[loc - 2:loc + 3][
-                        final_lam_bes[loc - 2:loc + 3] > 0
-                    ]
-                )
-                == 1
-            ):
-                this_ref_array[numpy.where(this_init_x_array == item)] = numpy.max(
-                    final_lam_bes[loc - 2:loc + 3]
-                )
-
+    this_ref_array = _xcorr_identify(
+        line_rows, this_init_x_array, ncols, this_ref_arc, best_stretch, shifts[0, [best]]
+    )
     return [this_row, this_ref_array]
 
 
@@ -1367,6 +1599,9 @@ def derive_wifes_skyline_solution(
 # Tolerance for stopping the fit.  0.001 rmse should be good enough I think.
 FTOL = 1e-3
 
+# Initial RMSE (Angstroms) below which a warm-started fit skips the staged fits.
+WARM_START_TOL = 0.5
+
 
 def excludeLines(lines, exclude, index=3, epsilon=0.05, verbose=False):
     """Work out if any of the lines we read in are to be excluded
@@ -1406,6 +1641,8 @@ def _fit_optical_model(
     decimate,
     plot_dir=None,
     taros=False,
+    init_params=None,
+    warm_start_tol=WARM_START_TOL,
 ):
 
     # Don't do the alphap fit initially
@@ -1452,6 +1689,29 @@ def _fit_optical_model(
     if verbose:
         print(f"Initial diagnostics: var={var}, bias={bias}, RMSE={rmse}")
 
+    # Start instead from a stored solution (e.g. from a previous night), if it
+    # already fits the lines well
+    warm = False
+    if init_params is not None:
+        init_params = numpy.asarray(init_params, dtype=float)
+        if len(init_params) > om.nparams:
+            init_alphap = init_params[om.nparams:]
+        else:
+            init_alphap = alphap
+        resid = om.errfunc(grating, init_params[: om.nparams], init_alphap, alls, ally, allx, allarcs)
+        warm_var = numpy.sum(resid**2) / len(allx)
+        warm_bias = numpy.sum(resid) / len(allx)
+        warm_rmse = math.sqrt(warm_var + warm_bias**2)
+        if warm_rmse <= warm_start_tol:
+            print(f"Warm start: initial RMSE {warm_rmse}, fitting all parameters at once")
+            warm = True
+            plorig = init_params[: om.nparams].copy()
+            alphap = init_alphap.copy()
+            rmse = warm_rmse
+        else:
+            print(f"Warm start initial RMSE {warm_rmse} exceeds {warm_start_tol}; "
+                  "starting from the default parameters")
+
     # Set up parameter info ready for fitting
     parinfo = [
         {"value": 0.0, "fixed": 1, "limited": [0, 0], "limits": [0.0, 0.0]}
@@ -1481,6 +1741,11 @@ def _fit_optical_model(
         paramlist = [(1,),
                      (2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 16, 17)]
 
+    # A warm start only needs the final joint fit, on the full data set
+    if warm:
+        paramlist = paramlist[-1:]
+        decimate = False
+
     # Work with decimated data first, if asked to
     if decimate:
         if verbose:
@@ -1544,7 +1809,8 @@ def _fit_optical_model(
             while (not fitdone):
                 fitcount += 1
                 # Actually do the fit
-                m = mpfit(om.mpfitfunc, functkw=fa, parinfo=parinfo, iterfunct=None, ftol=FTOL)
+                m = mpfit(om.mpfitfunc, functkw=fa, parinfo=parinfo, iterfunct=None, ftol=FTOL,
+                          autoderivative=0)
                 # Report on it
                 if (verbose):
                     print(f"status = {m.status}")
@@ -1622,6 +1888,37 @@ def _fit_optical_model(
     return (allx, ally, alls, allarcs, pl, rmse)
 
 
+def load_optical_model_params(wsol_fn, grating):
+    """
+    Read the optical model parameters of a previous wavelength solution, to start
+    a new fit from.
+
+    Parameters
+    ----------
+    wsol_fn : str
+        Path of the wavelength solution, or of its '_extra.pkl' file.
+    grating : str
+        Grating of the new solution, which the stored one must match (the grating
+        names also identify the camera).
+
+    Returns
+    -------
+    numpy.ndarray or None
+        The parameters, followed by the alphap terms; or None if there is no stored
+        optical model solution for this grating.
+    """
+    extra_fn = wsol_fn if wsol_fn.endswith("_extra.pkl") else wsol_fn + "_extra.pkl"
+    if not os.path.isfile(extra_fn):
+        print(f"No optical model solution found at {extra_fn}; not warm starting")
+        return None
+    stored_grating, params, _, _ = om.loadData(extra_fn)
+    if stored_grating.lower() != grating.lower():
+        print(f"Optical model solution {extra_fn} is for grating {stored_grating}, "
+              f"not {grating}; not warm starting")
+        return None
+    return numpy.asarray(params, dtype=float)
+
+
 def run_slice(packaged_args):
     """
     A function to be used by multiprocessing in derive_wifes_optical_wave_solution to derive the wifes optical wave solution for each slice `s`.
@@ -1634,8 +1931,6 @@ def run_slice(packaged_args):
 
     # a dict to hold the results of this function
     return_dict = {}
-    # since we are using multiprocessing over each slice, no need to use multiprocessing for each call to find_lines_and_guess_refs
-    multithread = False
 
     # pasted from derive_wifes_optical_wave_solution
     # step 1 - gather metadata from header
@@ -1711,7 +2006,6 @@ def run_slice(packaged_args):
         verbose=verbose,
         flux_threshold_nsig=flux_threshold_nsig,
         deriv_threshold_nsig=1.0,
-        multithread=multithread,
         plot=plot_slices,
         plot_dir=plot_dir,
     )
@@ -1752,6 +2046,8 @@ def derive_wifes_optical_wave_solution(
     decimate=False,
     sigma=1.0,
     alphapfile=None,
+    warm_start=None,
+    warm_start_tol=WARM_START_TOL,
     # global parameters
     plot=False,
     plot_dir=".",
@@ -1802,6 +2098,17 @@ def derive_wifes_optical_wave_solution(
         Sigma value for fitting.
     alphapfile : str, optional
         Path to the file containing alphap values.
+    warm_start : str, optional
+        Path of a previous optical model wavelength solution (or its '_extra.pkl'
+        file) for the same grating, to start the fit from instead of the default
+        parameters. Its alphap values replace any from `alphapfile`.
+        Default: None.
+    warm_start_tol : float, optional
+        Initial RMSE (Angstroms) of the `warm_start` solution below which the fit
+        goes straight to the final joint fit of all parameters, skipping the staged
+        fits of parameter groups. Otherwise the fit starts from the default
+        parameters.
+        Default: 0.5.
 
     plot : bool, optional
         Whether to plot the results.
@@ -1938,6 +2245,10 @@ def derive_wifes_optical_wave_solution(
     if verbose:
         print("Grating", grating)
 
+    init_params = None
+    if warm_start is not None:
+        init_params = load_optical_model_params(warm_start, grating)
+
     title = "Arc " + grating.upper() + f"   ({os.path.splitext(os.path.basename(inimg))[0]})"
 
     allx, ally, alls, allarcs, params, rmse = _fit_optical_model(
@@ -1955,6 +2266,8 @@ def derive_wifes_optical_wave_solution(
         decimate,
         plot_dir,
         taros,
+        init_params=init_params,
+        warm_start_tol=warm_start_tol,
     )
 
     if not (params is None):
@@ -2067,6 +2380,14 @@ def derive_wifes_wave_solution(inimg, out_file, method="optical", **args):
             decimate : bool
                 Whether to perform initial fit with 10% of data.
                 Default: False.
+            warm_start : str
+                Path of a previous optical model wavelength solution for the same
+                grating to start the fit from.
+                Default: None.
+            warm_start_tol : float
+                Initial RMSE in Angstroms below which the warm-started fit skips
+                the staged fits of parameter groups.
+                Default: 0.5.
             multithread : bool
                 Whether to run step using "multiprocessing" module.
                 Default: true.
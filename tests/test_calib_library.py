@@ -0,0 +1,63 @@
+import os
+
+from pywifes.calib_library import CalibLibrary, library_step_id
+
+
+CONFIG = {"arm": "blue", "grating": "B3000", "beamsplitter": "RT560", "binning": "1 2",
+          "halfframe": 0, "taros": 1}
+
+
+def _gargs(master_dir, text):
+    os.makedirs(master_dir, exist_ok=True)
+    gargs = {}
+    for key, fn in [("superbias_fn", "superbias.fits"), ("wsol_out_fn", "wave_soln.fits"),
+                    ("wsol_extra_fn", "wave_soln.fits_extra.pkl"), ("super_arc_raw", "super_arc_raw.fits")]:
+        gargs[key] = os.path.join(master_dir, fn)
+        with open(gargs[key], "w") as f:
+            f.write(f"{text} {key}")
+    return gargs
+
+
+def test_nearest_epoch_fills_missing_calibrations(tmp_path):
+    library = CalibLibrary(str(tmp_path / "library"))
+    library.add(_gargs(str(tmp_path / "n1"), "night1"), CONFIG, 60100.0, "2023-06-24",
+                ["superbias_fn", "wsol_out_fn", "wsol_extra_fn", "super_arc_raw"])
+    library.add(_gargs(str(tmp_path / "n2"), "night2"), CONFIG, 60110.0, "2023-07-04",
+                ["superbias_fn", "super_arc_raw"])
+    library.add(_gargs(str(tmp_path / "n3"), "night3"), dict(CONFIG, grating="B7000"), 60104.0,
+                "2023-06-28", ["superbias_fn", "wsol_out_fn", "wsol_extra_fn"])
+
+    # only entries of the same configuration that hold the products qualify
+    entry_dir, products, mjd = library.nearest(CONFIG, 60108.0, ["wsol_out_fn"])
+    assert mjd == 60100.0 and products["wsol_out_fn"] == "wave_soln.fits"
+    assert library.nearest(CONFIG, 60108.0, ["superbias_fn"])[2] == 60110.0
+    assert library.nearest(CONFIG, 60108.0, ["wsol_out_fn"], max_days=5.0) is None
+
+    # a night without arcs takes its arc products from the nearest epoch with them
+    steps = [{"step": "superbias", "args": {}}, {"step": "superflat", "args": {"source": "arc"}},
+             {"step": "wave_soln", "args": {}}]
+    assert library_step_id(steps[1]) == "superflat_arc"
+    gargs = _gargs(str(tmp_path / "tonight"), "tonight")
+    os.remove(gargs["wsol_extra_fn"])
+    skip, entry_dir = library.fill(gargs, CONFIG, 60108.0, steps, ["arc"])
+    assert skip == ["superflat_arc", "wave_soln"]
+    assert entry_dir.endswith(os.path.join("blue", "B3000_RT560_1x2_0_1", "2023-06-24"))
+    for key, text in [("superbias_fn", "tonight"), ("wsol_out_fn", "night1"),
+                      ("wsol_extra_fn", "night1"), ("super_arc_raw", "night1")]:
+        with open(gargs[key]) as f:
+            assert f.read() == f"{text} {key}"
+    # nothing to fill when no frame type is missing
+    assert library.fill(gargs, CONFIG, 60108.0, steps, []) == ([], None)
+    library.close()
+
+
+def test_adding_to_an_entry_keeps_earlier_products(tmp_path):
+    library = CalibLibrary(str(tmp_path / "library"))
+    gargs = _gargs(str(tmp_path / "n1"), "first")
+    library.add(gargs, CONFIG, 60100.0, "2023-06-24", ["superbias_fn"])
+    gargs = _gargs(str(tmp_path / "n1"), "second")
+    library.add(gargs, CONFIG, 60100.0, "2023-06-24", ["wsol_out_fn"])
+    entry_dir, products, _ = library.nearest(CONFIG, 60100.0, ["superbias_fn", "wsol_out_fn"])
+    with open(os.path.join(entry_dir, products["superbias_fn"])) as f:
+        assert f.read() == "first superbias_fn"
+    library.close()
@@ -0,0 +1,168 @@
+import astropy.io.fits as fits
+import numpy
+import os
+import pytest
+import scipy.interpolate as interp
+
+from pywifes import pywifes
+from pywifes.wifes_adr import adr_x_y
+
+
+NSLITS = 25
+NY = 38
+NX = 120
+
+
+def _write_frame(path, rng, pointing=None):
+    # Full-frame MEF with SCI, VAR and DQ extensions for each slitlet
+    pri = fits.PrimaryHDU()
+    pri.header["DETSEC"] = "[1:4202,1:4112]"
+    if pointing is not None:
+        pri.header.update(pointing)
+    hdus = [pri]
+    for kind in ["SCI", "VAR", "DQ"]:
+        for s in range(NSLITS):
+            if kind == "SCI":
+                data = 100.0 + rng.normal(0, 5, (NY, NX))
+            elif kind == "VAR":
+                data = 25.0 + rng.uniform(0, 1, (NY, NX))
+            else:
+                data = (rng.uniform(0, 1, (NY, NX)) > 0.98).astype("int16")
+            hdu = fits.ImageHDU(data)
+            hdu.header["CCDSUM"] = "1 2"
+            hdus.append(hdu)
+    fits.HDUList(hdus).writeto(path)
+
+
+def _write_solutions(wsol_path, wire_path):
+    x = numpy.arange(NX)
+    hdus = [fits.PrimaryHDU()]
+    for s in range(NSLITS):
+        rows = numpy.arange(NY)[:, None]
+        hdus.append(fits.ImageHDU(5000.0 + 1.5 * x[None, :] + 0.01 * rows + 0.2 * s))
+    fits.HDUList(hdus).writeto(wsol_path)
+    fits.PrimaryHDU(numpy.full((NSLITS, NX), NY / 2.0) + 0.002 * x[None, :]).writeto(wire_path)
+
+
+def _pointing(ha):
+    return {"DEC": "-30:00:00", "HA": ha, "HAEND": ha, "ZD": 40.0, "ZDEND": 40.0,
+            "TELPAN": 30.0, "LAT-OBS": -31.27336}
+
+
+@pytest.fixture
+def cube_inputs(tmp_path):
+    rng = numpy.random.default_rng(1)
+    paths = {}
+    for name, ha in [("a", "01:00:00"), ("b", "-02:30:00")]:
+        paths[name] = str(tmp_path / f"{name}.fits")
+        _write_frame(paths[name], rng, _pointing(ha))
+    paths["wsol"] = str(tmp_path / "wsol.fits")
+    paths["wire"] = str(tmp_path / "wire.fits")
+    _write_solutions(paths["wsol"], paths["wire"])
+    return paths
+
+
+def test_resampling_operator_matches_griddata():
+    rng = numpy.random.default_rng(0)
+    points = (rng.uniform(0, 100, 2000), rng.uniform(0, 30, 2000))
+    out_y, out_lam = numpy.meshgrid(numpy.linspace(2, 28, 13), numpy.linspace(-5, 105, 50))
+    flux = rng.normal(size=2000)
+    var = rng.uniform(1, 2, 2000)
+    dq = rng.integers(0, 3, 2000)
+    operator = pywifes._build_resampling_operator(points, (out_lam, out_y))
+    out_flux, out_var, out_dq = pywifes._apply_resampling_operator(
+        operator, flux, var, dq, out_lam.shape, scale_factor=2.0)
+
+    ref_flux = 2.0 * interp.griddata(points, flux, (out_lam, out_y), method="linear", fill_value=0).T
+    ref_dq = interp.griddata(points, dq, (out_lam, out_y), method="nearest").T
+    numpy.testing.assert_allclose(out_flux, ref_flux, atol=1e-10)
+    numpy.testing.assert_array_equal(out_dq, ref_dq)
+    # variance propagated with the squared weights, zero outside the convex hull
+    weights = operator[0].toarray()
+    ref_var = 4.0 * ((weights**2) @ var).reshape(out_lam.shape).T
+    numpy.testing.assert_allclose(out_var, ref_var)
+    assert numpy.all(out_var[ref_flux == 0] == 0)
+
+
+def test_shift_along_slitlets_matches_interp1d():
+    rng = numpy.random.default_rng(2)
+    cube = rng.normal(size=(7, 5, 11))
+    shift = numpy.linspace(-1.7, 1.3, 11)
+    out = pywifes._shift_along_slitlets(cube, shift, kind="linear", fill_value=0.0)
+    out_dq = pywifes._shift_along_slitlets(cube, shift, kind="nearest", fill_value=3)
+    in_x = numpy.arange(-1, 8, dtype="d")
+    for i in range(11):
+        for j in range(5):
+            padded = numpy.concatenate([cube[:1, j, i], cube[:, j, i], cube[-1:, j, i]])
+            f = interp.interp1d(in_x - shift[i], padded, kind="linear", fill_value=0.0, bounds_error=False)
+            h = interp.interp1d(in_x - shift[i], padded, kind="nearest", fill_value=3, bounds_error=False)
+            numpy.testing.assert_allclose(out[:, j, i], f(numpy.arange(7)), atol=1e-12)
+            numpy.testing.assert_allclose(out_dq[:, j, i], h(numpy.arange(7)))
+
+
+def _adr(wave):
+    return adr_x_y(wave, secz=1.0 / numpy.cos(numpy.radians(40.0)), objha=15.0, objdec=-30.0,
+                   tellat=-31.27336, teltemp=12.0, telpres=665.0, telwvp=6.0,
+                   telpa=numpy.radians(30.0), ref_wl=5600.)
+
+
+def test_adr_y_resampled_with_the_wire(cube_inputs, tmp_path):
+    # The y refraction of each input pixel enters the 2D resampling like the wire
+    # offset does, so with a wavelength solution that is the same along every
+    # column the ADR cube is the cube of a wire shifted by the refraction, then
+    # shifted along x.
+    x = numpy.arange(NX)
+    waves = [5000.0 + 1.5 * x + 0.2 * s for s in range(NSLITS)]
+    wsol = str(tmp_path / "flat_wsol.fits")
+    fits.HDUList([fits.PrimaryHDU()] + [fits.ImageHDU(numpy.tile(w, (NY, 1))) for w in waves]).writeto(wsol)
+    wire = fits.getdata(cube_inputs["wire"])
+    adr_wire = str(tmp_path / "adr_wire.fits")
+    fits.PrimaryHDU(wire + numpy.array([_adr(w)[1] * 0.5 * 2 for w in waves])).writeto(adr_wire)
+
+    shifted = str(tmp_path / "shifted.fits")
+    with_adr = str(tmp_path / "adr.fits")
+    pywifes.generate_wifes_cube(cube_inputs["a"], shifted, adr_wire, wsol, verbose=False, adr=False)
+    pywifes.generate_wifes_cube(cube_inputs["a"], with_adr, cube_inputs["wire"], wsol, verbose=False, adr=True)
+    with fits.open(shifted) as f, fits.open(with_adr) as g:
+        assert g[0].header["PYWADR"]
+        nlam = f[1].data.shape[1]
+        out_lambda = g[1].header["CRVAL1"] + g[1].header["CDELT1"] * numpy.arange(nlam)
+        adr_x = _adr(out_lambda)[0]
+        for ext, kind, fill in [(1, "linear", 0.0), (1 + NSLITS, "linear", 0.0), (1 + 2 * NSLITS, "nearest", 3)]:
+            cube = numpy.array([f[ext + i].data for i in range(NSLITS)], dtype="d")
+            expected = pywifes._shift_along_slitlets(cube, adr_x, kind=kind, fill_value=fill)
+            result = numpy.array([g[ext + i].data for i in range(NSLITS)], dtype="d")
+            numpy.testing.assert_allclose(result, expected, rtol=1e-5, atol=1e-3)
+
+
+def test_operator_cache_keyed_on_pointing(cube_inputs, tmp_path):
+    cache_dir = str(tmp_path / "cube_operators")
+    for name in ["a", "b", "b"]:
+        pywifes.generate_wifes_cube(cube_inputs[name], str(tmp_path / f"{name}.cube.fits"),
+                                    cube_inputs["wire"], cube_inputs["wsol"], verbose=False,
+                                    adr=True, operator_cache_dir=cache_dir)
+    # the y refraction is in the operators, so each pointing has its own entry
+    assert len(os.listdir(cache_dir)) == 2
+    # a cached run gives the same cube as an uncached one
+    pywifes.generate_wifes_cube(cube_inputs["b"], str(tmp_path / "b.nocache.fits"),
+                                cube_inputs["wire"], cube_inputs["wsol"], verbose=False, adr=True)
+    with fits.open(str(tmp_path / "b.cube.fits")) as f, fits.open(str(tmp_path / "b.nocache.fits")) as g:
+        for i in range(1, 3 * NSLITS + 1):
+            numpy.testing.assert_array_equal(f[i].data, g[i].data)
+    # without ADR the operators are shared between pointings
+    for name in ["a", "b"]:
+        pywifes.generate_wifes_cube(cube_inputs[name], str(tmp_path / f"{name}.noadr.fits"),
+                                    cube_inputs["wire"], cube_inputs["wsol"], verbose=False,
+                                    adr=False, operator_cache_dir=cache_dir)
+    assert len(os.listdir(cache_dir)) == 3
+
+
+def test_operator_cache_is_bounded(tmp_path):
+    cache_dir = tmp_path / "cube_operators"
+    cache_dir.mkdir()
+    for i in range(6):
+        fn = cache_dir / f"{i}.pkl"
+        fn.write_bytes(b"x")
+        os.utime(fn, (1000 + i, 1000 + i))
+    pywifes._prune_operator_cache(str(cache_dir), 2)
+    assert sorted(os.listdir(cache_dir)) == ["4.pkl", "5.pkl"]
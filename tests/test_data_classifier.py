@@ -0,0 +1,104 @@
+import astropy.io.fits as fits
+import numpy
+import os
+import pytest
+
+from pywifes.data_classifier import HeaderCatalogue, INDEX_KEYWORDS, build_header_index, get_header_overrides
+
+
+def _write_raw(path, compressed=False, **keywords):
+    header = fits.Header()
+    header["CAMERA"] = "WiFeSBlue"
+    header["IMAGETYP"] = "object"
+    header["EXPTIME"] = 100.0
+    header["MJD-OBS"] = 60500.5
+    header["DATE-OBS"] = "2024-07-20T12:00:00"
+    header.update(keywords)
+    data = numpy.zeros((8, 8), dtype="int16")
+    if compressed:
+        fits.HDUList([fits.PrimaryHDU(), fits.CompImageHDU(data, header)]).writeto(path, overwrite=True)
+    else:
+        fits.PrimaryHDU(data, header).writeto(path, overwrite=True)
+
+
+def _raw_dir(tmp_path):
+    _write_raw(str(tmp_path / "a.fits"), OBJECT="HD1", GRATINGB="B3000")
+    _write_raw(str(tmp_path / "b.fits.fz"), compressed=True, IMAGETYP="arc")
+    # TAROS Nod & Shuffle frame, recording the exposure time of one sub-exposure
+    _write_raw(str(tmp_path / "c.fits"), OBSEQID="x", WIFESOBS="NodAndShuffle", NSUBEXPS=4, EXPTIME=50.0)
+    (tmp_path / "notes.txt").write_text("not a FITS file")
+    return tmp_path
+
+
+def test_header_index_matches_headers(tmp_path):
+    data_dir = _raw_dir(tmp_path)
+    index = build_header_index(str(data_dir), max_threads=2)
+    # compressed files are indexed under the name of their staged copies
+    assert list(index.index) == ["a.fits", "b.fits", "c.fits"]
+    assert list(index.columns) == INDEX_KEYWORDS + ["OVERRIDES"]
+    for fn, ext in [("a.fits", 0), ("b.fits.fz", 1), ("c.fits", 0)]:
+        header = fits.getheader(str(data_dir / fn), ext=ext)
+        row = index.loc[fn.replace(".fz", "")]
+        for key in INDEX_KEYWORDS:
+            assert row[key] == header.get(key, None)
+    assert index.loc["b.fits", "IMAGETYP"] == "arc"
+    # the TAROS exposure time correction is recorded, not written to the file
+    assert get_header_overrides(index) == {"c": {"EXPTIME": 200.0, "SEXPTIME": 200.0}}
+    assert fits.getheader(str(data_dir / "c.fits"))["EXPTIME"] == 50.0
+
+
+def test_catalogue_reuses_unchanged_files(tmp_path):
+    data_dir = tmp_path / "raw"
+    data_dir.mkdir()
+    _raw_dir(data_dir)
+    catalogue = HeaderCatalogue(str(tmp_path / "headers.sqlite"))
+    first = build_header_index(str(data_dir), catalogue=catalogue)
+    # unchanged files come from the catalogue, giving the same index
+    again = build_header_index(str(data_dir), catalogue=catalogue)
+    assert first.equals(again)
+    # a rewritten file is read again
+    _write_raw(str(data_dir / "a.fits"), OBJECT="HD2")
+    os.utime(data_dir / "a.fits", (1e9, 1e9))
+    assert build_header_index(str(data_dir), catalogue=catalogue).loc["a.fits", "OBJECT"] == "HD2"
+    arcs = catalogue.query(mjd=60500.0, within_days=1.0, IMAGETYP="arc")
+    assert [os.path.basename(path) for path in arcs.index] == ["b.fits.fz"]
+    assert catalogue.query(mjd=60510.0, within_days=1.0).empty
+    with pytest.raises(ValueError):
+        catalogue.query(FOO=1)
+    catalogue.close()
+
+
+def test_catalogue_stores_keywords_without_a_value(tmp_path):
+    path = str(tmp_path / "a.fits")
+    _write_raw(path, OBJECT=None)
+    catalogue = HeaderCatalogue(str(tmp_path / "headers.sqlite"))
+    index = build_header_index(str(tmp_path), filenames=["a.fits"], catalogue=catalogue)
+    row = dict(index.loc["a.fits"])
+    assert catalogue.lookup([path])[0]["OBJECT"] is None
+    # keywords read as astropy's Undefined (older astropy) are stored as NULL, and
+    # other non-scalar values as strings
+    catalogue.store([path], [dict(row, RA=fits.card.UNDEFINED, DEC=complex(1, 2),
+                                  OVERRIDES={"EXPTIME": 5.0})])
+    row = catalogue.lookup([path])[0]
+    assert row["RA"] is None
+    assert row["DEC"] == "(1+2j)"
+    assert row["OVERRIDES"] == {"EXPTIME": 5.0}
+    catalogue.close()
+
+
+def test_catalogue_emptied_by_another_version(tmp_path, monkeypatch):
+    path = str(tmp_path / "c.fits")
+    _write_raw(path, OBSEQID="x", WIFESOBS="NodAndShuffle", NSUBEXPS=4, EXPTIME=50.0)
+    db_path = str(tmp_path / "headers.sqlite")
+    catalogue = HeaderCatalogue(db_path)
+    build_header_index(str(tmp_path), filenames=["c.fits"], catalogue=catalogue)
+    catalogue.close()
+    # reopened by the same version, the rows are kept
+    catalogue = HeaderCatalogue(db_path)
+    assert catalogue.lookup([path])[0]["OVERRIDES"] == {"EXPTIME": 200.0, "SEXPTIME": 200.0}
+    catalogue.close()
+    # rows written before a change to the overrides are not reused
+    monkeypatch.setattr(HeaderCatalogue, "revision", HeaderCatalogue.revision + 1)
+    catalogue = HeaderCatalogue(db_path)
+    assert catalogue.lookup([path]) == [None]
+    catalogue.close()
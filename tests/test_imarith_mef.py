@@ -0,0 +1,85 @@
+import astropy.io.fits as fits
+import filecmp
+import numpy
+import pytest
+
+from pywifes import pywifes
+
+
+NSLITS = 25
+
+
+def _write_mef(path, rng, var_dtype, exptime):
+    pri = fits.PrimaryHDU()
+    pri.header["DETSEC"] = "[1:4202,1:4112]"
+    hdus = [pri]
+    for kind in ["SCI", "VAR", "DQ"]:
+        for s in range(NSLITS):
+            if kind == "SCI":
+                data = (100.0 + rng.normal(0, 5, (6, 20))).astype("float32")
+            elif kind == "VAR":
+                data = (25.0 + rng.uniform(0, 1, (6, 20))).astype(var_dtype)
+            else:
+                data = (rng.uniform(0, 1, (6, 20)) > 0.9).astype("int16")
+            hdu = fits.ImageHDU(data)
+            hdu.header["EXPTIME"] = exptime
+            hdus.append(hdu)
+    fits.HDUList(hdus).writeto(path)
+
+
+def _expected(f1, f2, operator, s, scale=1.0):
+    # per-extension arithmetic with float64 variances, as before memory-mapping
+    data1 = f1[s + 1].data
+    data2 = scale * f2[s + 1].data
+    var1 = f1[NSLITS + s + 1].data.astype("float64")
+    var2 = scale**2 * f2[NSLITS + s + 1].data.astype("float64")
+    if operator == "+":
+        data = data1 + data2
+    elif operator == "-":
+        data = data1 - data2
+    elif operator == "*":
+        data = data1 * data2
+    else:
+        data = data1 / data2
+    data = data.astype("float32")
+    # the variances are computed after the output SCI data replace those of the
+    # first input, as they always have been
+    if operator in "+-":
+        var = var1 + var2
+    elif operator == "*":
+        var = var1 * data2**2 + var2 * data**2
+    else:
+        var = var1 / data2**2 + var2 * (data / data2**2)**2
+    return data, var
+
+
+@pytest.mark.parametrize("var_dtype", ["float64", "float32"])
+@pytest.mark.parametrize("operator", ["+", "-", "*", "/"])
+def test_imarith_mef_keeps_variance_precision(tmp_path, var_dtype, operator):
+    rng = numpy.random.default_rng(17)
+    in1, in2 = str(tmp_path / "in1.fits"), str(tmp_path / "in2.fits")
+    _write_mef(in1, rng, var_dtype, 100.0)
+    _write_mef(in2, rng, var_dtype, 50.0)
+    out_fn = str(tmp_path / "out.fits")
+    scaled_fn = str(tmp_path / "scaled.fits")
+    pywifes.imarith_mef(in1, operator, in2, out_fn)
+    pywifes.scaled_imarith_mef(in1, operator, in2, scaled_fn, scale="exptime")
+    with fits.open(in1) as f1, fits.open(in2) as f2, fits.open(out_fn) as out, fits.open(scaled_fn) as scaled:
+        for s in range(NSLITS):
+            for result, scale in [(out, 1.0), (scaled, 2.0)]:
+                data, var = _expected(f1, f2, operator, s, scale=scale)
+                assert result[s + 1].data.dtype == numpy.dtype(">f4")
+                assert result[NSLITS + s + 1].data.dtype == numpy.dtype(var_dtype).newbyteorder(">")
+                numpy.testing.assert_allclose(result[s + 1].data, data, rtol=1e-6)
+                rtol = 1e-12 if var_dtype == "float64" else 1e-6
+                numpy.testing.assert_allclose(result[NSLITS + s + 1].data, var, rtol=rtol)
+                numpy.testing.assert_array_equal(result[2 * NSLITS + s + 1].data,
+                                                 f1[2 * NSLITS + s + 1].data + f2[2 * NSLITS + s + 1].data)
+
+
+def test_imcopy_copies_the_file(tmp_path):
+    rng = numpy.random.default_rng(18)
+    in_fn = str(tmp_path / "in.fits")
+    _write_mef(in_fn, rng, "float32", 10.0)
+    pywifes.imcopy(in_fn, str(tmp_path / "out.fits"))
+    assert filecmp.cmp(in_fn, str(tmp_path / "out.fits"), shallow=False)
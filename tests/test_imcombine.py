@@ -0,0 +1,146 @@
+import astropy.io.fits as fits
+import numpy
+import pytest
+
+from pywifes import pywifes
+
+
+def _write_images(tmp_path, stack, imagetyp="BIAS"):
+    fns = []
+    for i, data in enumerate(stack):
+        hdu = fits.PrimaryHDU(data.astype("float32"))
+        hdu.header["CCDSUM"] = "1 2"
+        hdu.header["DETSEC"] = "[1:4202,1:4112]"
+        hdu.header["EXPTIME"] = 10.0
+        hdu.header["IMAGETYP"] = imagetyp
+        for key in ["LSTEND", "UTCEND", "HAEND"]:
+            hdu.header[key] = f"0{i}:00:00"
+        hdu.header["ZDEND"] = 30.0 + i
+        hdu.header["AIRMASS"] = 1.1
+        fn = str(tmp_path / f"in{i}.fits")
+        hdu.writeto(fn)
+        fns.append(fn)
+    return fns
+
+
+def _combine(tmp_path, stack, **kwargs):
+    fns = _write_images(tmp_path, stack)
+    out_fn = str(tmp_path / "out.fits")
+    pywifes.imcombine(fns, out_fn, **kwargs)
+    return fits.getdata(out_fn)
+
+
+@pytest.mark.parametrize("nimg", [2, 3])
+def test_minmax_keeps_a_value_for_every_pixel(tmp_path, nimg):
+    rng = numpy.random.default_rng(6)
+    stack = rng.normal(100, 5, (nimg, 20, 30))
+    # one input missing at some pixels
+    stack[0, :5, :5] = numpy.nan
+    out = _combine(tmp_path, stack, method="minmax", nlow=1, nhigh=1)
+    assert numpy.all(numpy.isfinite(out))
+    expected = numpy.nanmedian(stack, axis=0) if nimg == 2 else numpy.median(stack, axis=0)
+    if nimg == 3:
+        # pixels with only two valid values take their median
+        expected[:5, :5] = numpy.nanmedian(stack[:, :5, :5], axis=0)
+    numpy.testing.assert_allclose(out, expected.astype("float32"), rtol=1e-6)
+
+
+def test_minmax_rejects_extremes(tmp_path):
+    rng = numpy.random.default_rng(7)
+    stack = rng.normal(100, 5, (6, 20, 30))
+    stack[2, 3, 4] = 1e5
+    out = _combine(tmp_path, stack, method="minmax", nlow=1, nhigh=2)
+    srt = numpy.sort(stack, axis=0)
+    numpy.testing.assert_allclose(out, numpy.mean(srt[1:4], axis=0).astype("float32"), rtol=1e-6)
+
+
+@pytest.mark.parametrize("method", ["median", "mean", "sum", "clipped_mean"])
+def test_strips_match_whole_stack(tmp_path, method):
+    # combining in strips of a few rows gives the whole-stack result
+    rng = numpy.random.default_rng(8)
+    stack = rng.normal(100, 5, (10, 40, 50))
+    stack[1, 10, 10] = 1e4
+    out = _combine(tmp_path, stack, method=method, max_memory_mb=0.05)
+    if method == "median":
+        expected = numpy.median(stack, axis=0)
+    elif method == "mean":
+        expected = numpy.mean(stack, axis=0)
+    elif method == "sum":
+        expected = numpy.sum(stack, axis=0)
+    else:
+        from astropy.stats import sigma_clip
+        expected = numpy.nanmean(sigma_clip(stack.astype("float32").astype("d"), sigma=3.0, maxiters=5,
+                                            axis=0, masked=False), axis=0)
+        assert abs(out[10, 10] - 100) < 20
+    numpy.testing.assert_allclose(out, expected.astype("float32"), rtol=1e-5)
+
+
+def test_weighted_mean_favours_less_noisy_inputs(tmp_path):
+    rng = numpy.random.default_rng(9)
+    stack = numpy.array([100 + rng.normal(0, sig, (64, 64)) for sig in [1.0, 10.0]])
+    out = _combine(tmp_path, stack, method="weighted_mean")
+    assert numpy.std(out - 100) < 1.2
+
+
+def _write_mef(path, rng, exptime, mjd, with_nan=False, nslits=25, ny=12, nx=30, var_dtype="float64"):
+    pri = fits.PrimaryHDU()
+    pri.header["DETSEC"] = "[1:4202,1:4112]"
+    pri.header["EXPTIME"] = exptime
+    pri.header["MJD-OBS"] = mjd
+    pri.header["HAEND"] = f"0{int(mjd) % 10}:00:00"
+    hdus = [pri]
+    for kind in ["SCI", "VAR", "DQ"]:
+        for s in range(nslits):
+            if kind == "SCI":
+                data = (100.0 + rng.normal(0, 5, (ny, nx))).astype("float32")
+                if with_nan:
+                    data[0, s] = numpy.nan
+            elif kind == "VAR":
+                data = (25.0 + rng.uniform(0, 1, (ny, nx))).astype(var_dtype)
+            else:
+                data = (rng.uniform(0, 1, (ny, nx)) > 0.9).astype("int16")
+            hdu = fits.ImageHDU(data)
+            hdu.header["EXPTIME"] = exptime
+            hdus.append(hdu)
+    fits.HDUList(hdus).writeto(path)
+
+
+@pytest.mark.parametrize("method,scale", [("median", None), ("sum", None),
+                                          ("nansafesum", "exptime"), ("median", "per_slice_median")])
+def test_imcombine_mef_matches_per_extension(tmp_path, method, scale):
+    rng = numpy.random.default_rng(10)
+    in_fns = [str(tmp_path / f"in{i}.fits") for i in range(3)]
+    for i, fn in enumerate(in_fns):
+        _write_mef(fn, rng, exptime=10.0 * (i + 1), mjd=60000.0 + i, with_nan=(i == 0))
+    out_fn = str(tmp_path / "out.fits")
+    pywifes.imcombine_mef(in_fns, out_fn, scale=scale, method=method, max_threads=4)
+    with fits.open(out_fn) as out:
+        ins = [fits.open(fn) for fn in in_fns]
+        assert len(out) == 76
+        for ext in range(1, 76):
+            stack = numpy.array([f[ext].data for f in ins], dtype="d")
+            if ext > 50:
+                numpy.testing.assert_array_equal(out[ext].data, numpy.nansum(stack, axis=0))
+                continue
+            if scale == "exptime":
+                stack /= numpy.array([10.0, 20.0, 30.0])[:, None, None]
+            elif scale == "per_slice_median":
+                stack /= numpy.nanmedian(stack, axis=(1, 2))[:, None, None]
+            if method == "median":
+                expected = numpy.nanmedian(stack, axis=0)
+            elif method == "sum":
+                expected = numpy.sum(stack, axis=0)
+            else:
+                expected = numpy.nanmean(stack, axis=0) * 3
+            numpy.testing.assert_allclose(out[ext].data, expected.astype(out[ext].data.dtype), rtol=1e-6)
+        if method == "sum":
+            assert out[0].header["EXPTIME"] == 60.0
+            assert out[0].header["HAEND"] == "02:00:00"
+        for f in ins:
+            f.close()
+    # a single thread gives the same result
+    one_fn = str(tmp_path / "one.fits")
+    pywifes.imcombine_mef(in_fns, one_fn, scale=scale, method=method, max_threads=1)
+    with fits.open(out_fn) as f, fits.open(one_fn) as g:
+        for ext in range(1, 76):
+            numpy.testing.assert_array_equal(f[ext].data, g[ext].data)
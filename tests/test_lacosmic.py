@@ -0,0 +1,70 @@
+import astropy.io.fits as fits
+import numpy
+import os
+
+from pywifes.lacosmic import lacos_spec_data, lacos_wifes_frames, lacos_wifes_oneproc
+
+
+def test_cosmic_ray_repair_matches_per_pixel_median():
+    rng = numpy.random.default_rng(3)
+    ny, nx = 60, 80
+    data = 200.0 + rng.normal(0, 10, (ny, nx))
+    # cosmic rays, including at the frame edges and in adjacent pixels
+    for y, x in [(0, 5), (30, 40), (31, 40), (59, 79), (10, 0), (45, 60), (20, 70)]:
+        data[y, x] += 5000.0
+    input_dq = numpy.zeros((ny, nx))
+    input_dq[33, 40] = 1
+    input_dq[12:14, 1] = 1
+
+    clean, bpm = lacos_spec_data(data, input_dq=input_dq.copy(), niter=1, verbose=False)
+
+    new = (bpm > 0) & (input_dq == 0)
+    assert new[30, 40] and new[31, 40] and new[0, 5] and new[59, 79]
+    # each flagged pixel takes the median of the unflagged data in its window,
+    # as found by the original per-pixel scan of the whole frame
+    x_mg, y_mg = numpy.meshgrid(numpy.arange(nx), numpy.arange(ny))
+    expected = data.copy()
+    for bpy, bpx in zip(*numpy.nonzero(new)):
+        n_inds = numpy.nonzero(
+            (numpy.abs(y_mg - bpy) <= 5) * (numpy.abs(x_mg - bpx) <= 1) * (bpm == 0)
+        )
+        if n_inds[0].size > 0:
+            expected[bpy, bpx] = numpy.nanmedian(data[n_inds])
+    numpy.testing.assert_allclose(clean, expected)
+    assert numpy.all(numpy.abs(clean[new] - 200.0) < 50.0)
+
+
+def _write_frame(path, rng, nslits=25, ny=38, nx=100):
+    pri = fits.PrimaryHDU()
+    pri.header["DETSEC"] = "[1:4202,1:4112]"
+    sci = []
+    for s in range(nslits):
+        data = 200.0 + rng.normal(0, 10, (ny, nx))
+        hits = rng.integers(0, [ny, nx], (4, 2))
+        data[hits[:, 0], hits[:, 1]] += 3000.0
+        sci.append(fits.ImageHDU(data.astype("float32")))
+    var = [fits.ImageHDU(numpy.full((ny, nx), 100.0)) for s in range(nslits)]
+    dq = [fits.ImageHDU(numpy.zeros((ny, nx), dtype="int16")) for s in range(nslits)]
+    fits.HDUList([pri] + sci + var + dq).writeto(path)
+
+
+def test_multiframe_cleaning_matches_per_frame(tmp_path):
+    rng = numpy.random.default_rng(5)
+    wsol_fn = str(tmp_path / "wsol.fits")
+    x = numpy.arange(100)
+    fits.HDUList([fits.PrimaryHDU()] + [
+        fits.ImageHDU(5000.0 + 1.2 * x[None, :] + 0.02 * numpy.arange(38)[:, None]) for s in range(25)
+    ]).writeto(wsol_fn)
+    in_fns = [str(tmp_path / f"in{i}.fits") for i in range(3)]
+    for fn in in_fns:
+        _write_frame(fn, rng)
+    out_fns = [str(tmp_path / f"out{i}.fits") for i in range(3)]
+    lacos_wifes_frames(in_fns, out_fns, rdnoises=[5.0, 3.0, 5.0], wsol_filepath=wsol_fn,
+                       niter=2, max_processes=2)
+    for fn, out_fn, rdnoise in zip(in_fns, out_fns, [5.0, 3.0, 5.0]):
+        ref_fn = str(tmp_path / ("ref_" + os.path.basename(out_fn)))
+        lacos_wifes_oneproc(fn, ref_fn, rdnoise=rdnoise, wsol_filepath=wsol_fn, niter=2)
+        with fits.open(out_fn) as f, fits.open(ref_fn) as g:
+            assert len(f) == len(g)
+            for i in range(1, len(f)):
+                numpy.testing.assert_array_equal(f[i].data, g[i].data)
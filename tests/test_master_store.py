@@ -0,0 +1,110 @@
+import os
+
+from pywifes.master_store import MasterStore, master_step_keys
+
+
+def _gargs(tmp_path):
+    gargs = {"arm": "blue", "master_dir": str(tmp_path / "master"),
+             "out_dir_arm": str(tmp_path / "intermediate"), "output_master_dir": None}
+    for key in ["master_dir", "out_dir_arm"]:
+        os.makedirs(gargs[key])
+    gargs["superbias_fn"] = os.path.join(gargs["master_dir"], "wifes_blue_superbias.fits")
+    gargs["superbias_fit_fn"] = os.path.join(gargs["master_dir"], "wifes_blue_superbias_fit.fits")
+    return gargs
+
+
+METADATA = {"bias": ["b1", "b2"], "sci": [{"sci": ["s1"], "bias": ["b3"]}], "std": []}
+
+
+def _superbias(metadata, gargs, prev_suffix, curr_suffix, **args):
+    for key in ["superbias_fn", "superbias_fit_fn"]:
+        with open(gargs[key], "w") as f:
+            f.write(key)
+    with open(os.path.join(gargs["out_dir_arm"], "b3.lsb.fits"), "w") as f:
+        f.write("local")
+    # files of other steps and temporary files are not products of this step
+    with open(os.path.join(gargs["out_dir_arm"], "s1.p05.fits"), "w") as f:
+        f.write("frame")
+    with open(os.path.join(gargs["master_dir"], "wifes_blue_wave_soln.fits.part123"), "w") as f:
+        f.write("partial")
+
+
+def test_store_records_declared_products_and_restores_them(tmp_path):
+    store = MasterStore(str(tmp_path / "store"))
+    gargs = _gargs(tmp_path)
+    store.run_step("abcd", "superbias", _superbias, METADATA, gargs, "01", None)
+    entry_dir = tmp_path / "store" / "ab" / "abcd"
+    assert sorted(os.listdir(entry_dir)) == ["intermediate", "manifest.json5", "master"]
+    assert sorted(os.listdir(entry_dir / "master")) == ["wifes_blue_superbias.fits",
+                                                       "wifes_blue_superbias_fit.fits"]
+    assert os.listdir(entry_dir / "intermediate") == ["b3.lsb.fits"]
+
+    # a fresh reduction takes the products from the store without running the step
+    gargs = _gargs(tmp_path / "again")
+
+    def _fail(*args, **kwargs):
+        raise AssertionError("step should not run")
+
+    store.wrap(_fail, "abcd", "superbias")(METADATA, gargs, prev_suffix="01", curr_suffix=None)
+    with open(gargs["superbias_fit_fn"]) as f:
+        assert f.read() == "superbias_fit_fn"
+    assert sorted(os.listdir(gargs["out_dir_arm"])) == ["b3.lsb.fits"]
+
+
+def test_nothing_stored_when_no_product_is_written(tmp_path):
+    store = MasterStore(str(tmp_path / "store"))
+    gargs = _gargs(tmp_path)
+    _superbias(METADATA, gargs, "01", None)
+    # outputs already done, e.g. with skip_done
+    store.run_step("abcd", "superbias", lambda *args, **kwargs: None, METADATA, gargs, "01", None)
+    assert not os.path.exists(tmp_path / "store" / "ab" / "abcd")
+
+
+def test_key_follows_the_warm_start_solution(tmp_path):
+    data_dir = tmp_path / "raw"
+    data_dir.mkdir()
+    (data_dir / "a1.fits").write_text("arc")
+    metadata = {"bias": [], "dark": [], "domeflat": [], "twiflat": [], "wire": [], "arc": ["a1"],
+                "sci": [{"sci": ["s1"], "arc": ["a1"]}], "std": []}
+    library_fn = str(tmp_path / "library_wave_soln.fits_extra.pkl")
+    gargs = {"wsol_warm_start": library_fn,
+             "wsol_out_fn": str(tmp_path / "wifes_blue_wave_soln.fits")}
+
+    def _keys(args, gargs=gargs):
+        # the keys of the wavelength solution and of a later step
+        steps = [{"step": "superbias", "suffix": None, "args": {}},
+                 {"step": "wave_soln", "suffix": None, "args": args},
+                 {"step": "wire_soln", "suffix": None, "args": {}}]
+        return master_step_keys(steps, metadata, str(data_dir), "blue", gargs=gargs)[1:]
+
+    cold = _keys({})
+    warm = _keys({"warm_start": True})
+    assert warm[0] != cold[0] and warm[1] != cold[1]
+    # a new library entry changes the keys
+    with open(library_fn, "w") as f:
+        f.write("night 1")
+    night1 = _keys({"warm_start": True})
+    assert night1[0] != warm[0] and night1[1] != warm[1]
+    with open(library_fn, "w") as f:
+        f.write("night 2")
+    night2 = _keys({"warm_start": True})
+    assert night2[0] != night1[0]
+    # the master solution this step writes, which the local arc solutions start
+    # from, does not: a rerun gets the same keys
+    with open(gargs["wsol_out_fn"] + "_extra.pkl", "w") as f:
+        f.write("master")
+    assert _keys({"warm_start": True}) == night2
+    # an explicit solution is hashed in place of the library entry
+    other_fn = str(tmp_path / "other_wave_soln.fits")
+    with open(other_fn + "_extra.pkl", "w") as f:
+        f.write("other 1")
+    other = _keys({"warm_start": other_fn})
+    with open(library_fn, "w") as f:
+        f.write("night 3")
+    assert _keys({"warm_start": other_fn}) == other
+    with open(other_fn + "_extra.pkl", "w") as f:
+        f.write("other 2")
+    assert _keys({"warm_start": other_fn})[0] != other[0]
+    # the polynomial solutions do not start from a stored solution
+    assert _keys({"method": "poly", "warm_start": True}) == _keys({"method": "poly", "warm_start": True},
+                                                                   gargs=None)
@@ -0,0 +1,110 @@
+import numpy
+import pytest
+
+from pywifes import optical_model as om
+from pywifes.mpfit import mpfit
+
+GRATINGS = ["u7000", "b7000", "r7000", "i7000", "r3000", "b3000"]
+
+# Wavelengths of the points below, from the original np.matrix implementation
+# of fitfunc
+EXPECTED = {
+    "u7000": [4294.47209325, 4082.45077591, 3835.72223544, 3600.08657410, 3310.81169013],
+    "b7000": [5465.99745145, 5195.99876654, 4881.81934894, 4581.77726801, 4213.44716204],
+    "r7000": [5297.94204094, 5738.59590806, 6177.01613059, 6548.19645486, 6950.84079504],
+    "i7000": [6834.91902932, 7404.03390299, 7970.31208342, 8449.78005098, 8969.93768408],
+    "r3000": [5869.40155064, 6669.78049805, 7384.33729686, 7920.02853830, 8412.66591614],
+    "b3000": [5217.48596440, 4992.57564999, 4659.33355458, 4294.32163726, 3794.50447658],
+}
+
+
+def _params(grating):
+    # the default model, with every term of the geometry switched on
+    p = om.defaultParams(grating)
+    p[2] = 0.01
+    p[3] = 2000
+    p[5] = 1e-6
+    p[6] = 1e-10
+    p[9] = 0.002
+    p[10] = -0.003
+    p[11] = 2100
+    p[12] = 1990
+    p[16] = 1e-4
+    p[17] = -1e-4
+    alphap = 1e-4 * (numpy.arange(25) - 12)
+    return p, alphap
+
+
+@pytest.mark.parametrize("grating", GRATINGS)
+def test_fitfunc_matches_original(grating):
+    p, alphap = _params(grating)
+    s = numpy.array([1, 7, 13, 19, 25])
+    y = numpy.array([150.0, 1200.0, 2048.0, 3000.0, 3950.0])
+    x = numpy.array([200.0, 1100.0, 2048.0, 2900.0, 3900.0])
+    numpy.testing.assert_allclose(om.fitfunc(grating, p, alphap, s, y, x), EXPECTED[grating],
+                                  rtol=0, atol=1e-6)
+    model, _ = om.fitfunc_jacobian(grating, p, alphap, s, y, x)
+    numpy.testing.assert_allclose(model, EXPECTED[grating], rtol=0, atol=1e-6)
+
+
+@pytest.mark.parametrize("grating", GRATINGS)
+def test_jacobian_matches_finite_differences(grating):
+    rng = numpy.random.default_rng(25)
+    n = 200
+    s = rng.integers(1, 26, n)
+    y = rng.uniform(0, 4096, n)
+    x = rng.uniform(0, 4096, n)
+    p, alphap = _params(grating)
+    allp = numpy.concatenate([p, alphap])
+    # steps small against the scale of each parameter
+    steps = numpy.array([1e-3, 1e-7, 1e-7, 1e-3, 1e-3, 1e-11, 1e-15, 1e-19, 1e-4,
+                         1e-7, 1e-7, 1e-3, 1e-3, 1e-4, 1e-7, 1e-7, 1e-7, 1e-7] + [1e-7] * 25)
+    model, jac = om.fitfunc_jacobian(grating, p, alphap, s, y, x)
+    numpy.testing.assert_array_equal(model, om.fitfunc(grating, p, alphap, s, y, x))
+    fd = numpy.zeros_like(jac)
+    for i in range(len(allp)):
+        hi = allp.copy()
+        lo = allp.copy()
+        hi[i] += steps[i]
+        lo[i] -= steps[i]
+        fd[:, i] = (om.fitfunc(grating, hi[:om.nparams], hi[om.nparams:], s, y, x)
+                    - om.fitfunc(grating, lo[:om.nparams], lo[om.nparams:], s, y, x)) / (2 * steps[i])
+    # the refractive index iteration of the 3000 gratings limits the finite differences
+    scale = numpy.maximum(numpy.max(numpy.abs(fd), axis=0), 1e-30)
+    assert numpy.all(numpy.max(numpy.abs(jac - fd), axis=0) / scale < 1e-4)
+    # each point only depends on the alphap term of its slitlet
+    for j in range(25):
+        assert numpy.all(jac[(s - 1) != j, om.nparams + j] == 0)
+
+    # only the free parameters are differentiated, as asked by mpfit
+    free = numpy.zeros(len(allp), dtype=int)
+    free[[0, 1, 8, 13, om.nparams + 3]] = 1
+    err = numpy.full(n, 2.0)
+    arc = model + 1.0
+    status, resid, fjac = om.mpfitfunc(allp, fjac=free, s=s, y=y, x=x, grating=grating, arc=arc, err=err)
+    numpy.testing.assert_allclose(resid, 0.5)
+    numpy.testing.assert_allclose(fjac[:, free == 1], jac[:, free == 1] / 2.0, rtol=1e-12)
+    assert numpy.all(fjac[:, free == 0] == 0)
+
+
+@pytest.mark.parametrize("grating", ["r7000", "b3000"])
+def test_fit_with_exact_derivatives_matches_finite_differences(grating):
+    rng = numpy.random.default_rng(26)
+    n = 2000
+    s = rng.integers(1, 26, n)
+    y = rng.uniform(0, 4096, n)
+    x = rng.uniform(0, 4096, n)
+    p, alphap = _params(grating)
+    allp = numpy.concatenate([p, alphap])
+    arc = om.fitfunc(grating, p, alphap, s, y, x)
+    fa = {"s": s, "y": y, "x": x, "grating": grating, "arc": arc, "err": numpy.ones(n)}
+    parinfo = [{"value": v, "fixed": 1} for v in allp]
+    # start away from the true model, in a few of the parameters
+    for i, offset in [(0, 0.5), (8, 0.2), (11, 3.0), (13, 2.0)]:
+        parinfo[i] = {"value": allp[i] + offset, "fixed": 0}
+    fits = [mpfit(om.mpfitfunc, functkw=fa, parinfo=parinfo, quiet=True, autoderivative=autoderivative)
+            for autoderivative in [1, 0]]
+    for m in fits:
+        assert m.status > 0
+        numpy.testing.assert_allclose(m.params[[0, 8, 11, 13]], allp[[0, 8, 11, 13]], rtol=1e-6)
+    numpy.testing.assert_allclose(fits[0].params, fits[1].params, rtol=1e-6)
@@ -0,0 +1,26 @@
+import astropy.io.fits as fits
+import numpy
+import os
+
+from pywifes import pywifes
+from pywifes.recipes.overscan_sub import _run_overscan_sub
+
+
+def test_overrides_follow_half_frame_standards(tmp_path, monkeypatch):
+    # calib_to_half_frame renames full-frame standards to 'cut_<name>', while the
+    # classifier records their header corrections under the raw name
+    for fn in ["sci", "cut_std"]:
+        header = fits.Header()
+        header["CCDSUM"] = "1 2"
+        fits.PrimaryHDU(numpy.zeros((4, 4), dtype="int16"), header).writeto(str(tmp_path / f"{fn}.fits"))
+    metadata = {"bias": [], "arc": [], "wire": [], "dark": [], "domeflat": [], "twiflat": [],
+                "sci": [{"sci": ["sci"], "sky": []}],
+                "std": [{"sci": ["cut_std"], "name": "HD1", "stdtype": ["flux"]}]}
+    gargs = {"data_dir": str(tmp_path), "out_dir_arm": str(tmp_path), "skip_done": False, "my_data_hdu": 0,
+             "header_overrides": {"std": {"EXPTIME": 200.0, "SEXPTIME": 200.0}}}
+    applied = {}
+    monkeypatch.setattr(pywifes, "subtract_overscan",
+                        lambda in_fn, out_fn, header_overrides=None, **kwargs:
+                        applied.update({os.path.basename(in_fn): header_overrides}))
+    _run_overscan_sub(metadata, gargs, None, "00", poly_high_oscan=False)
+    assert applied == {"sci.fits": None, "cut_std.fits": {"EXPTIME": 200.0, "SEXPTIME": 200.0}}
@@ -0,0 +1,76 @@
+import astropy.io.fits as fits
+import numpy
+import os
+import pytest
+
+from pywifes.session_store import SessionStore
+
+
+def _write_frame(path, rng, value=100.0):
+    hdus = [fits.PrimaryHDU(header=fits.Header({"OBJECT": "HD1"}))]
+    for kind, dtype in [("SCI", "float32"), ("VAR", "float64"), ("DQ", "int16")]:
+        for s in range(1, 3):
+            data = (value + rng.normal(0, 5, (6, 10))).astype(dtype)
+            hdus.append(fits.ImageHDU(data, name=f"{kind}{s}"))
+    fits.HDUList(hdus).writeto(path, overwrite=True)
+
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_datasets_round_trip(tmp_path, compress):
+    rng = numpy.random.default_rng(18)
+    work_dir = tmp_path / "work"
+    work_dir.mkdir()
+    frame = "OBK-1-WiFeS-Blue-UT20240101T000000"
+    for suffix in ["p03", "p08", "s03"]:
+        _write_frame(str(work_dir / f"{frame}.{suffix}.fits"), rng)
+    originals = {}
+    for fn in os.listdir(work_dir):
+        with fits.open(str(work_dir / fn)) as f:
+            originals[fn] = [(hdu.name, hdu.header.get("OBJECT"), None if hdu.data is None else hdu.data.copy())
+                             for hdu in f]
+        originals[fn].append(os.path.getmtime(work_dir / fn))
+    (work_dir / "wifes_blue_superbias.fits").write_text("not a frame")
+
+    store = SessionStore(str(tmp_path / "store"), compress=compress)
+    assert store.pack(str(work_dir), suffixes=["03"], remove=False) == 2
+    assert store.pack(str(work_dir)) == 3
+    assert sorted(os.listdir(work_dir)) == ["wifes_blue_superbias.fits"]
+    assert store.frames() == [frame]
+    assert store.datasets(frame) == ["p03", "s03", "p08"]
+    numpy.testing.assert_array_equal(store.read(frame, "p08", "VAR2"), originals[f"{frame}.p08.fits"][4][2])
+
+    # only the datasets asked for are written back out
+    out_dir = tmp_path / "out"
+    out_dir.mkdir()
+    assert store.unpack(str(out_dir), datasets=["p08"]) == 1
+    assert store.unpack(str(out_dir)) == 2
+    for fn, original in originals.items():
+        with fits.open(str(out_dir / fn)) as f:
+            assert len(f) == len(original) - 1
+            for hdu, (name, obj, data) in zip(f, original[:-1]):
+                assert hdu.name == name and hdu.header.get("OBJECT") == obj
+                if data is not None:
+                    assert hdu.data.dtype == data.dtype
+                    numpy.testing.assert_array_equal(hdu.data, data)
+        assert os.path.getmtime(out_dir / fn) == original[-1]
+
+
+def test_changed_dataset_replaces_the_stored_copy(tmp_path):
+    rng = numpy.random.default_rng(19)
+    fn = str(tmp_path / "frame.p05.fits")
+    store = SessionStore(str(tmp_path / "store"))
+    _write_frame(fn, rng, value=10.0)
+    store.put(fn, remove=False)
+    # unchanged: nothing is rewritten
+    mtime = os.path.getmtime(store._container("frame"))
+    store.put(fn, remove=False)
+    assert os.path.getmtime(store._container("frame")) == mtime
+    _write_frame(fn, rng, value=20.0)
+    os.utime(fn, (mtime + 10, mtime + 10))
+    store.put(fn)
+    assert not os.path.exists(fn)
+    assert abs(numpy.mean(store.read("frame", "p05", "SCI1")) - 20.0) < 5.0
+    with fits.open(store._container("frame")) as f:
+        assert len(f) == 8
+    with pytest.raises(ValueError):
+        store.put(str(tmp_path / "wifes_blue_superbias.fits"))
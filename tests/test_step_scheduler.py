@@ -0,0 +1,118 @@
+import os
+import pytest
+import types
+
+from pywifes.step_scheduler import build_step_graph, run_step_graph, split_metadata
+
+
+def _frames(metadata):
+    return metadata["bias"] + [fn for obs in metadata["sci"] for fn in obs["sci"]]
+
+
+def _copy_frames(metadata, gargs, prev_suffix, curr_suffix, **args):
+    for fn in _frames(metadata):
+        src = os.path.join(gargs["out_dir_arm"], f"{fn}.p{prev_suffix}.fits")
+        with open(src) as f:
+            text = f.read()
+        with open(os.path.join(gargs["out_dir_arm"], f"{fn}.p{curr_suffix}.fits"), "w") as f:
+            f.write(text + curr_suffix)
+
+
+def _read_frames(metadata, gargs, prev_suffix, curr_suffix, **args):
+    for fn in metadata["bias"]:
+        with open(os.path.join(gargs["out_dir_arm"], f"{fn}.p{prev_suffix}.fits")) as f:
+            f.read()
+    with open(os.path.join(gargs["out_dir_arm"], "superbias.txt"), "w") as f:
+        f.write("done")
+
+
+def _fail(metadata, gargs, prev_suffix, curr_suffix, **args):
+    raise ValueError("failed")
+
+
+RECIPES = types.SimpleNamespace(run_overscan_sub=_copy_frames, run_bpm_repair=_copy_frames,
+                                run_superbias=_read_frames, run_bias_sub=_copy_frames)
+
+STEPS = [
+    {"step": "overscan_sub", "suffix": "00", "prev_suffix": None, "args": {}},
+    {"step": "bpm_repair", "suffix": "01", "prev_suffix": "00", "args": {}},
+    {"step": "superbias", "suffix": None, "prev_suffix": "01", "args": {}},
+    {"step": "bias_sub", "suffix": "02", "prev_suffix": "01", "args": {}},
+]
+
+
+def _metadata():
+    return {"bias": ["b1", "b2"], "arc": [],
+            "sci": [{"sci": ["s1"], "sky": []}, {"sci": ["s2"], "sky": []}],
+            "std": []}
+
+
+def _setup(tmp_path):
+    for fn in ["b1", "b2", "s1", "s2"]:
+        (tmp_path / f"{fn}.pNone.fits").write_text("raw")
+    return {"arm": "blue", "out_dir_arm": str(tmp_path)}
+
+
+def test_split_metadata_and_graph():
+    units = split_metadata(_metadata())
+    assert [u["sci"] for u in units] == [[], [{"sci": ["s1"], "sky": []}], [{"sci": ["s2"], "sky": []}]]
+    nodes = build_step_graph(STEPS, len(units))
+    # one barrier, a frame step per unit, a barrier, a frame step per unit
+    assert [node["unit"] for node in nodes] == [None, 0, 1, 2, None, 0, 1, 2]
+    # bias_sub waits for the superbias and for its own unit's bpm_repair
+    assert nodes[5]["deps"] == {0, 1, 4}
+
+
+def test_consumed_suffixes_are_released_after_their_readers(tmp_path):
+    gargs = _setup(tmp_path)
+    released = []
+
+    def on_consumed(suffix):
+        present = sorted(os.listdir(tmp_path))
+        released.append((suffix, present))
+
+    run_step_graph(RECIPES, STEPS, _metadata(), gargs, max_processes=2, on_consumed=on_consumed)
+    # the final suffix has no readers and is kept
+    assert [suffix for suffix, _ in released] == ["00", "01"]
+    present = dict(released)
+    # every reader of '01' had finished when it was released
+    assert "superbias.txt" in present["01"]
+    assert all(f"{fn}.p02.fits" in present["01"] for fn in ["b1", "b2", "s1", "s2"])
+    assert all(f"{fn}.p01.fits" in present["00"] for fn in ["b1", "b2", "s1", "s2"])
+
+
+def test_steps_reported_once_finished_for_every_unit(tmp_path):
+    gargs = _setup(tmp_path)
+    finished = []
+
+    def on_finished(step):
+        finished.append((step["step"], sorted(os.listdir(tmp_path))))
+
+    run_step_graph(RECIPES, STEPS, _metadata(), gargs, max_processes=3, on_finished=on_finished)
+    assert sorted(name for name, _ in finished) == sorted(step["step"] for step in STEPS)
+    present = dict(finished)
+    # each step is reported once all of its frames have been written
+    for name, suffix in [("overscan_sub", "00"), ("bpm_repair", "01"), ("bias_sub", "02")]:
+        assert all(f"{fn}.p{suffix}.fits" in present[name] for fn in ["b1", "b2", "s1", "s2"])
+    assert "superbias.txt" in present["superbias"]
+
+
+def test_closure_steps_run_and_failures_are_reported(tmp_path):
+    gargs = _setup(tmp_path)
+    calls = tmp_path / "calls.txt"
+
+    def wrapped(metadata, gargs, prev_suffix, curr_suffix, **args):
+        # a closure, as made by MasterStore.wrap, cannot be pickled for a spawned process
+        with open(calls, "a") as f:
+            f.write(f"{prev_suffix}->{curr_suffix}\n")
+        _copy_frames(metadata, gargs, prev_suffix, curr_suffix, **args)
+
+    steps = [dict(step, func=wrapped) if step["step"] == "overscan_sub" else step for step in STEPS]
+    metadata = run_step_graph(RECIPES, steps, _metadata(), gargs, max_processes=3)
+    assert calls.read_text() == "None->00\n"
+    assert metadata["sci"] == _metadata()["sci"]
+    assert (tmp_path / "s2.p02.fits").read_text() == "raw000102"
+
+    steps[2] = dict(steps[2], func=_fail)
+    with pytest.raises(RuntimeError, match="superbias"):
+        run_step_graph(RECIPES, steps, _metadata(), gargs, max_processes=3)
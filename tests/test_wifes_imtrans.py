@@ -0,0 +1,46 @@
+import astropy.io.fits as fits
+import numpy
+import pytest
+
+from pywifes import wifes_imtrans
+from pywifes.wifes_imtrans import Rectifier, detransform_data, get_rectifier, transform_data
+
+
+def _wave(ny=20, nx=150, sign=1.0):
+    x = numpy.arange(nx)
+    rows = numpy.arange(ny)[:, None]
+    return 6000.0 + sign * (0.8 * x[None, :] + 1e-4 * x[None, :]**2) + 0.3 * rows
+
+
+@pytest.mark.parametrize("sign", [1.0, -1.0])
+def test_rectifier_matches_transform_data(sign):
+    rng = numpy.random.default_rng(4)
+    wave = _wave(sign=sign)
+    data = rng.normal(100, 10, wave.shape)
+    rect = Rectifier(wave)
+    out, out_lambda = rect.transform(data, return_lambda=True)
+    ref, ref_lambda = transform_data(data, wave, return_lambda=True)
+    numpy.testing.assert_allclose(out_lambda, ref_lambda)
+    numpy.testing.assert_allclose(out, ref, rtol=1e-12, atol=1e-9)
+    numpy.testing.assert_allclose(rect.detransform(out), detransform_data(ref, data, wave),
+                                  rtol=1e-12, atol=1e-9)
+    # with a given output grid
+    grid = numpy.arange(6050.0, 6100.0, 0.5)
+    numpy.testing.assert_allclose(Rectifier(wave, out_lambda=grid).transform(data),
+                                  transform_data(data, wave, out_lambda=grid), rtol=1e-12, atol=1e-9)
+
+
+def test_get_rectifier_cache_is_bounded(tmp_path):
+    fn = str(tmp_path / "wsol.fits")
+    fits.HDUList([fits.PrimaryHDU()] + [fits.ImageHDU(_wave(ny=4, nx=20)) for _ in range(3)]).writeto(fn)
+    wifes_imtrans._cached_rectifier.cache_clear()
+    first = get_rectifier(fn, 1)
+    assert get_rectifier(fn, 1) is first
+    assert get_rectifier(fn, 2) is not first
+    # a rewritten file is reloaded
+    fits.HDUList([fits.PrimaryHDU()] + [fits.ImageHDU(_wave(ny=4, nx=21)) for _ in range(3)]).writeto(
+        fn, overwrite=True)
+    assert get_rectifier(fn, 1).nx == 21
+    for i in range(wifes_imtrans.RECTIFIER_CACHE_SIZE + 10):
+        wifes_imtrans._cached_rectifier(fn, float(i), 0, 1)
+    assert wifes_imtrans._cached_rectifier.cache_info().currsize == wifes_imtrans.RECTIFIER_CACHE_SIZE
@@ -0,0 +1,127 @@
+import astropy.io.fits as fits
+import gzip
+import numpy
+import os
+import pytest
+import shutil
+import time
+
+from pywifes import wifes_utils
+from pywifes.wifes_utils import copy_files, link_files, unpack_files, wifes_recipe, write_fits
+
+
+def _raw_frames(raw_dir):
+    # a plain, an fpack-compressed and a gzip-compressed raw frame
+    rng = numpy.random.default_rng(13)
+    images = {name: rng.integers(0, 1000, (16, 24)).astype("int16") for name in ["a", "b", "c"]}
+    header = fits.Header({"IMAGETYP": "object"})
+    fits.PrimaryHDU(images["a"], header).writeto(str(raw_dir / "a.fits"))
+    fits.HDUList([fits.PrimaryHDU(), fits.CompImageHDU(images["b"], header)]).writeto(
+        str(raw_dir / "b.fits.fz"))
+    fits.PrimaryHDU(images["c"], header).writeto(str(raw_dir / "c.fits"))
+    with open(raw_dir / "c.fits", "rb") as f_in, gzip.open(raw_dir / "c.fits.gz", "wb") as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(raw_dir / "c.fits")
+    return images
+
+
+@pytest.mark.parametrize("hardlink", [False, True])
+def test_linked_frames_are_unpacked_without_touching_raw(tmp_path, hardlink):
+    raw_dir = tmp_path / "raw"
+    stage_dir = tmp_path / "stage"
+    raw_dir.mkdir()
+    stage_dir.mkdir()
+    images = _raw_frames(raw_dir)
+    raw_names = sorted(os.listdir(raw_dir))
+    raw_bytes = {fn: (raw_dir / fn).read_bytes() for fn in raw_names}
+
+    link_files(str(raw_dir), str(stage_dir), raw_names, hardlink=hardlink)
+    # linking again replaces the existing links
+    link_files(str(raw_dir), str(stage_dir), raw_names, hardlink=hardlink)
+    assert sorted(os.listdir(stage_dir)) == raw_names
+    assert os.path.islink(stage_dir / "a.fits") != hardlink
+
+    # only the frames asked for are decompressed
+    unpack_files(str(stage_dir), ["a", "b"], max_processes=2)
+    assert not (stage_dir / "c.fits").exists()
+    unpack_files(str(stage_dir), ["a", "b", "c"], max_processes=2)
+    for name in ["a", "b", "c"]:
+        numpy.testing.assert_array_equal(fits.getdata(str(stage_dir / f"{name}.fits")), images[name])
+    assert not [fn for fn in os.listdir(stage_dir) if ".part" in fn]
+    # the raw files are never written to
+    assert sorted(os.listdir(raw_dir)) == raw_names
+    assert all((raw_dir / fn).read_bytes() == raw_bytes[fn] for fn in raw_names)
+
+
+@pytest.mark.parametrize("max_processes,wait", [(1, True), (2, True), (2, False)])
+def test_copy_files_decompresses_in_the_background(tmp_path, max_processes, wait):
+    raw_dir = tmp_path / "raw"
+    stage_dir = tmp_path / "stage"
+    raw_dir.mkdir()
+    stage_dir.mkdir()
+    images = _raw_frames(raw_dir)
+    names = sorted(os.listdir(raw_dir)) + ["missing.fits"]
+    result = copy_files(str(raw_dir), str(stage_dir), names, max_processes=max_processes, wait=wait)
+    if wait:
+        assert result is None
+    else:
+        result()
+    # a failed copy does not stop the others
+    assert sorted(os.listdir(stage_dir)) == ["a.fits", "b.fits", "c.fits"]
+    for name in ["a", "b", "c"]:
+        numpy.testing.assert_array_equal(fits.getdata(str(stage_dir / f"{name}.fits")), images[name])
+    # up-to-date copies are left alone
+    mtime = os.path.getmtime(stage_dir / "b.fits")
+    copy_files(str(raw_dir), str(stage_dir), ["b.fits.fz"], max_processes=max_processes)
+    assert os.path.getmtime(stage_dir / "b.fits") == mtime
+
+
+def test_recipe_write_behind_is_flushed_and_restored(tmp_path):
+    written = []
+
+    @wifes_recipe
+    def _run_writes(metadata, gargs, fail=False):
+        """Write a few frames."""
+        for i in range(5):
+            out_fn = str(tmp_path / f"out{i}.fits")
+            write_fits(fits.HDUList([fits.PrimaryHDU(numpy.full((64, 64), i))]), out_fn)
+            written.append(out_fn)
+        if fail:
+            raise ValueError("failed")
+
+    assert _run_writes.__name__ == "_run_writes"
+    assert _run_writes.__doc__ == "Write a few frames."
+    _run_writes({}, {"write_behind": 2})
+    # every queued write has finished when the recipe returns
+    for i, out_fn in enumerate(written):
+        assert fits.getdata(out_fn)[0, 0] == i
+    assert not [fn for fn in os.listdir(tmp_path) if ".part" in fn]
+    # outside a recipe, writes are synchronous again, also after a failed recipe
+    assert wifes_utils._write_behind["max_pending"] == 0
+    with pytest.raises(ValueError):
+        _run_writes({}, {"write_behind": 2}, fail=True)
+    assert wifes_utils._write_behind["max_pending"] == 0
+    assert wifes_utils._write_behind["recipe_pid"] is None
+
+
+@pytest.mark.parametrize("ahead", [0, 1, 2])
+def test_prefetch_reads_the_next_items_once(monkeypatch, ahead):
+    read = []
+    monkeypatch.setattr(wifes_utils, "_read_file", read.append)
+    files = {"a": ["a.fits", "shared.fits"], "b": ["b.fits", "shared.fits"],
+             "c": ["c.fits"], "d": ["d.fits", "missing.fits"]}
+    items = list(files)
+    processed = []
+    for i, item in enumerate(wifes_utils.prefetch(items, files.get, ahead=ahead)):
+        processed.append(item)
+        # give the reader thread time to catch up, as processing an item would
+        time.sleep(0.1)
+        # the files of the next items have been read while this one is processed
+        for next_item in items[i + 1:i + 1 + ahead]:
+            assert set(files[next_item]) - {"shared.fits"} <= set(read)
+    assert processed == items
+    if ahead == 0:
+        assert read == []
+    else:
+        # the first item is not read ahead, and each file is read only once
+        assert sorted(read) == ["b.fits", "c.fits", "d.fits", "missing.fits"]
@@ -0,0 +1,344 @@
+import numpy
+import pytest
+
+from pywifes import optical_model as om
+from pywifes import wifes_wsol
+from pywifes.mpfit import mpfit
+from pywifes.wifes_wsol import (
+    _find_arcline_candidates,
+    _get_gauss_arc_fit,
+    _lsq_gauss_line,
+    _mpfit_gauss_line,
+    _xcorr_correlate,
+    _xcorr_identify,
+    _xcorr_shift_all,
+)
+
+
+def _arc_rows(rng, nrows=3, ncols=400):
+    # isolated lines of different strengths and widths, on a noisy background
+    x = numpy.arange(ncols, dtype="d")
+    rows = rng.normal(0, 2, (nrows, ncols))
+    centers = []
+    for r in range(nrows):
+        ctrs = numpy.arange(20, ncols - 20, 30) + rng.uniform(-0.5, 0.5)
+        for ctr, amp, sig in zip(ctrs, rng.uniform(200, 5000, len(ctrs)), rng.uniform(0.8, 1.6, len(ctrs))):
+            rows[r] += amp * numpy.exp(-((x - ctr) ** 2) / (2 * sig**2))
+        centers.append(ctrs)
+    return rows, centers
+
+
+def _per_line(fit_function, row, guesses, width_guess):
+    # the original fits, one window at a time
+    x = numpy.arange(len(row), dtype="d")
+    fitted = []
+    for i, ctr in enumerate(guesses):
+        lo, hi = int(ctr - 5 * width_guess), int(ctr + 5 * width_guess)
+        yfit = row[lo:hi]
+        if len(yfit) > 0 and numpy.count_nonzero(yfit > 0.2 * yfit.max()) > 0:
+            fitted.append(fit_function((i, ctr, width_guess, x[lo:hi], yfit))[1])
+        else:
+            fitted.append(float("nan"))
+    return numpy.array(fitted, dtype="d")
+
+
+@pytest.mark.parametrize("find_method", ["mpfit", "least_squares"])
+def test_arc_line_fits_match_per_line_fits(find_method):
+    rng = numpy.random.default_rng(21)
+    rows, centers = _arc_rows(rng)
+    width_guess = 2.0
+    guesses = [numpy.round(ctrs).astype(int) for ctrs in centers]
+    # a few lines at the edges of the row, and a guess without a line
+    guesses[0] = numpy.concatenate([guesses[0], [3, rows.shape[1] - 2]])
+    fit_function = _mpfit_gauss_line if find_method == "mpfit" else _lsq_gauss_line
+    expected = [_per_line(fit_function, row, g, width_guess) for row, g in zip(rows, guesses)]
+
+    # row by row
+    for row, g, exp in zip(rows, guesses, expected):
+        fitted = _get_gauss_arc_fit(find_method, row, g, width_guess)
+        numpy.testing.assert_array_equal(numpy.isnan(fitted), numpy.isnan(exp))
+        if find_method == "mpfit":
+            numpy.testing.assert_allclose(fitted, exp, atol=1e-4)
+        else:
+            numpy.testing.assert_array_equal(fitted, exp)
+    # and all rows of the slitlet at once
+    line_rows = numpy.concatenate([numpy.full(len(g), r) for r, g in enumerate(guesses)])
+    fitted = _get_gauss_arc_fit(find_method, rows, numpy.concatenate(guesses), width_guess,
+                                line_rows=line_rows)
+    numpy.testing.assert_allclose(fitted, numpy.concatenate(expected), atol=1e-4)
+    # the isolated lines are found close to their true centers
+    found = fitted[:len(centers[0])]
+    assert numpy.all(numpy.abs(found - centers[0]) < 0.1)
+
+
+def _per_row_candidates(arc_data, flux_threshold, deriv_threshold, flux_saturation=50000.0,
+                        prev_centers=None):
+    # the original candidate search of one row
+    N = len(arc_data)
+    arc_deriv = arc_data[1:] - arc_data[:-1]
+    p1_data = numpy.zeros(N, dtype="d")
+    p1_data[:-1] = arc_data[1:]
+    m1_data = numpy.zeros(N, dtype="d")
+    m1_data[1:] = arc_data[:-1]
+    p1_deriv = numpy.zeros(N, dtype="d")
+    p1_deriv[:-1] = arc_deriv
+    m1_deriv = numpy.zeros(N, dtype="d")
+    m1_deriv[1:] = arc_deriv
+    p2_deriv = numpy.zeros(N, dtype="d")
+    p2_deriv[:-2] = arc_deriv[1:]
+    m2_deriv = numpy.zeros(N, dtype="d")
+    m2_deriv[2:] = arc_deriv[:-1]
+    init_inds = numpy.nonzero(
+        (arc_data <= flux_saturation)
+        * (arc_data >= flux_threshold)
+        * (m1_data >= flux_threshold)
+        * (p1_data >= flux_threshold)
+        * ((m1_deriv >= deriv_threshold) + (m2_deriv >= deriv_threshold))
+        * ((p1_deriv <= -1.0 * deriv_threshold) + (p2_deriv <= -1.0 * deriv_threshold))
+    )[0]
+    ind_diffs = init_inds[1:] - init_inds[:-1]
+    full_diffs = numpy.zeros(len(init_inds))
+    full_diffs[1:] = ind_diffs
+    full_diffs[0] = full_diffs[1]
+    potential_line_inds = init_inds[numpy.nonzero(full_diffs != 1)[0]]
+    if prev_centers is None:
+        return potential_line_inds
+    prev_lines = numpy.zeros(N)
+    curr_lines = numpy.zeros(N)
+    for j in prev_centers:
+        prev_lines[int(j)] = 1.0
+    for j in potential_line_inds:
+        curr_lines[int(j)] = 1.0
+    corr_out = numpy.correlate(prev_lines, curr_lines, mode="full")
+    shift = (numpy.where(corr_out == numpy.max(corr_out))[0] - N)[0] + 1
+    checked_ones = []
+    for j in potential_line_inds:
+        if (1 <= j + shift < len(prev_lines) - 1) and (
+            (prev_lines[j + shift] + curr_lines[j] == 2.0)
+            or (prev_lines[j + shift + 1] + curr_lines[j] == 2.0)
+            or (prev_lines[j + shift - 1] + curr_lines[j] == 2.0)
+        ):
+            checked_ones = numpy.append(checked_ones, [j])
+    return numpy.array(checked_ones)
+
+
+def test_slitlet_candidates_match_per_row_search():
+    rng = numpy.random.default_rng(23)
+    nrows, ncols = 30, 500
+    x = numpy.arange(ncols, dtype="d")
+    slitlet = rng.normal(0, 3, (nrows, ncols))
+    base = numpy.arange(15, ncols - 15, 23).astype("d")
+    amps = rng.uniform(300, 8000, len(base))
+    for r in range(nrows):
+        # tilted lines, drifting by a few pixels over the slitlet
+        for ctr, amp in zip(base + 0.15 * r, amps):
+            slitlet[r] += amp * numpy.exp(-((x - ctr) ** 2) / (2 * 1.2**2))
+        # lines seen in some rows only, and a flat-topped (adjacent) peak
+        if r % 4 == 0:
+            slitlet[r] += 900 * numpy.exp(-((x - 127.3 - r) ** 2) / (2 * 1.0**2))
+        slitlet[r, 300:302] += 3000
+    slitlet[:, 200:204] += 60000  # saturated
+    flux_threshold, deriv_threshold = 50.0, 20.0
+
+    rows, inds = _find_arcline_candidates(
+        slitlet, find_method="mpfit", flux_threshold=flux_threshold, deriv_threshold=deriv_threshold)
+    mid_centers = inds[rows == nrows // 2] + rng.uniform(0, 0.9, numpy.sum(rows == nrows // 2))
+    # drop a few of the middle-row lines, as a middle-row fit would
+    mid_centers = mid_centers[::3]
+    for prev_centers in [None, mid_centers]:
+        rows, inds = _find_arcline_candidates(
+            slitlet, find_method="mpfit", flux_threshold=flux_threshold,
+            deriv_threshold=deriv_threshold, prev_centers=prev_centers)
+        assert numpy.all(numpy.diff(rows) >= 0)
+        for r in range(nrows):
+            expected = _per_row_candidates(slitlet[r], flux_threshold, deriv_threshold,
+                                           prev_centers=prev_centers)
+            numpy.testing.assert_array_equal(inds[rows == r], expected)
+            # a single row gives the same candidates
+            row_rows, row_inds = _find_arcline_candidates(
+                slitlet[r], find_method="mpfit", flux_threshold=flux_threshold,
+                deriv_threshold=deriv_threshold, prev_centers=prev_centers)
+            assert numpy.all(row_rows == 0)
+            numpy.testing.assert_array_equal(row_inds, expected)
+        assert len(inds) > nrows * (5 if prev_centers is not None else 15)
+
+
+def _per_row_xcorr(packaged_args):
+    # the original stretch/shift search and identification of one row
+    (
+        this_row,
+        ncols,
+        this_init_x_array,
+        this_ref_arc,
+        stretches,  # if provided, will only try these ones !
+        get_stretch  # if yes, get the best stretch+exit
+    ) = packaged_args
+
+    if stretches is None:
+        stretches = numpy.arange(0.98, 1.03, 0.001)
+
+    corrs = numpy.zeros_like(stretches)
+    shifts = numpy.zeros_like(stretches)
+    for k, stretch in enumerate(stretches):
+        pseudo_x_obs = numpy.zeros(ncols)
+        pseudo_x_bes = numpy.zeros(ncols)
+        for j in this_init_x_array:
+            pseudo_x_obs[int(j)] = 1.0
+        for j in this_ref_arc[:, 0]:
+            if int(j * stretch) < len(pseudo_x_bes):
+                pseudo_x_bes[int(j * stretch)] = 1.0
+
+        corr_out = numpy.correlate(pseudo_x_obs, pseudo_x_bes, mode="full")
+        corrs[k] = numpy.max(corr_out)
+        shifts[k] = numpy.argmax(corr_out)
+
+    best_shift = int(shifts[numpy.argmax(corrs)])
+    best_stretch = stretches[numpy.argmax(corrs)]
+
+    if get_stretch:
+        return best_stretch
+
+    x_obs = numpy.zeros(ncols)
+    pseudo_x_obs = numpy.zeros(ncols)
+    pseudo_x_bes = numpy.zeros(ncols)
+    final_x_bes = numpy.zeros(ncols)
+    pseudo_lam_bes = numpy.zeros(ncols)
+    final_lam_bes = numpy.zeros(ncols)
+
+    for j in this_init_x_array:
+        pseudo_x_obs[int(j)] = 1.0
+        x_obs[int(j)] = j
+    for line, j in enumerate(this_ref_arc[:, 0]):
+        if int(j * best_stretch) < len(pseudo_x_bes):
+            pseudo_x_bes[int(j * best_stretch)] = 1.0
+            pseudo_lam_bes[int(j * best_stretch)] = this_ref_arc[:, 1][line]
+        if best_shift <= ncols:
+            final_x_bes[0:best_shift] = pseudo_x_bes[-best_shift:]
+            final_lam_bes[0:best_shift] = pseudo_lam_bes[-best_shift:]
+        else:
+            final_x_bes[best_shift - ncols:] = pseudo_x_bes[0:ncols - best_shift]
+            final_lam_bes[best_shift - ncols:] = pseudo_lam_bes[0:ncols - best_shift]
+
+    min_line_spacing = 10  # Original: 10 "Angstroem" (probably pixels)
+    this_ref_array = numpy.zeros_like(this_init_x_array)
+    for j, item in enumerate(this_init_x_array):
+        if j > 0:
+            cond1 = int(item) > (int(this_init_x_array[j - 1]) + min_line_spacing)
+        else:
+            cond1 = True
+        if j < len(this_init_x_array) - 1:
+            cond2 = int(item) < (int(this_init_x_array[j + 1]) - min_line_spacing)
+        else:
+            cond2 = True
+        if cond1 and cond2:
+            loc = numpy.where(x_obs == item)[0][0]
+            if (
+                len(
+                    final_lam_bes[loc - 2:loc + 3][
+                        final_lam_bes[loc - 2:loc + 3] > 0
+                    ]
+                )
+                == 1
+            ):
+                this_ref_array[numpy.where(this_init_x_array == item)] = numpy.max(
+                    final_lam_bes[loc - 2:loc + 3]
+                )
+
+    return [this_row, this_ref_array]
+
+
+def _observed_lines(rng, ref_arc, nrows, ncols, stretch):
+    # the reference lines as seen in each row: stretched, shifted by a few pixels
+    # from row to row, with some lines missing and a few spurious ones
+    line_rows, line_x = [], []
+    for r in range(nrows):
+        x = ref_arc[:, 0] * stretch + (r - nrows // 2) * 0.4 + 3.0 + rng.normal(0, 0.2, len(ref_arc))
+        x = x[rng.uniform(0, 1, len(x)) > 0.15]
+        x = numpy.concatenate([x, rng.uniform(0, ncols, 3)])
+        x = numpy.sort(x[(x >= 0) & (x < ncols)])
+        # one line per pixel, as the candidate search gives
+        x = x[numpy.concatenate([[True], numpy.diff(x.astype(int)) > 0])]
+        line_rows.append(numpy.full(len(x), r))
+        line_x.append(x)
+    return numpy.concatenate(line_rows), numpy.concatenate(line_x)
+
+
+def test_xcorr_identification_matches_per_row_correlation():
+    rng = numpy.random.default_rng(24)
+    nrows, ncols = 12, 1000
+    ref_x = numpy.arange(20, ncols - 20, 25) + rng.uniform(-3, 3, 39)
+    # close pairs, which are never identified
+    ref_x = numpy.sort(numpy.concatenate([ref_x, ref_x[::10] + 4]))
+    ref_arc = numpy.stack([ref_x, 5000.0 + 1.5 * ref_x], axis=1)
+    line_rows, line_x = _observed_lines(rng, ref_arc, nrows, ncols, stretch=1.013)
+
+    mid = line_rows == nrows // 2
+    best_stretch = _xcorr_shift_all((nrows // 2, ncols, line_x[mid], ref_arc, None, True))
+    assert best_stretch == _per_row_xcorr((nrows // 2, ncols, line_x[mid], ref_arc, None, True))
+    assert abs(best_stretch - 1.013) < 0.003
+
+    _, shifts = _xcorr_correlate(line_rows, line_x, nrows, ncols, ref_arc[:, 0], [best_stretch])
+    ref_array = _xcorr_identify(line_rows, line_x, ncols, ref_arc, best_stretch, shifts[:, 0])
+    for r in range(nrows):
+        row = line_rows == r
+        expected = _per_row_xcorr((r, ncols, line_x[row], ref_arc, [best_stretch], False))[1]
+        numpy.testing.assert_array_equal(ref_array[row], expected)
+        numpy.testing.assert_array_equal(
+            _xcorr_shift_all((r, ncols, line_x[row], ref_arc, [best_stretch], False))[1], expected)
+    # most of the lines are identified, nearly all with their own wavelength
+    found = ref_array > 0
+    assert numpy.count_nonzero(found) > 0.4 * len(line_x)
+    true_x = (ref_array[found] - 5000.0) / 1.5
+    expected_x = true_x * 1.013 + (line_rows[found] - nrows // 2) * 0.4 + 3.0
+    assert numpy.mean(numpy.abs(line_x[found] - expected_x) < 1.5) > 0.95
+
+
+def test_multithread_is_deprecated():
+    rng = numpy.random.default_rng(22)
+    row = _arc_rows(rng, nrows=1)[0][0]
+    with pytest.warns(DeprecationWarning, match="multithread"):
+        with_arg = wifes_wsol.quick_arcline_fit(row, find_method="mpfit", flux_threshold=50.0,
+                                                multithread=True)
+    numpy.testing.assert_array_equal(
+        with_arg, wifes_wsol.quick_arcline_fit(row, find_method="mpfit", flux_threshold=50.0))
+
+
+@pytest.mark.parametrize("offset,warm", [(0.0, True), (30.0, False)])
+def test_warm_start_skips_the_staged_fits(monkeypatch, offset, warm):
+    rng = numpy.random.default_rng(27)
+    grating = "r7000"
+    p = om.defaultParams(grating)
+    p[2] = 0.002
+    p[11] = 2100
+    p[12] = 1990
+    alphap = numpy.zeros(25)
+    n = 3000
+    s = rng.integers(1, 26, n)
+    y = rng.uniform(0, 4096, n)
+    x = rng.uniform(0, 4096, n)
+    arcs = om.fitfunc(grating, p, alphap, s, y, x) + rng.normal(0, 0.05, n)
+    lines = numpy.stack([s, y, x, arcs], axis=1)
+
+    fits = []
+
+    def _mpfit(func, functkw=None, parinfo=None, **kwargs):
+        fits.append(([i for i, par in enumerate(parinfo) if not par["fixed"]], len(functkw["x"])))
+        return mpfit(func, functkw=functkw, parinfo=parinfo, **kwargs)
+
+    monkeypatch.setattr(wifes_wsol, "mpfit", _mpfit)
+    init_params = numpy.concatenate([p, alphap])
+    init_params[13] += offset
+    init_rmse = numpy.sqrt(numpy.mean(om.errfunc(grating, init_params[:om.nparams], alphap, s, y, x, arcs) ** 2))
+    assert (init_rmse <= wifes_wsol.WARM_START_TOL) == warm
+    result = wifes_wsol._fit_optical_model(
+        "test", grating, 1, 1, lines, alphap, False, False, 0, 1.0, False, True,
+        init_params=init_params)
+    final_group = [2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 16, 17]
+    if warm:
+        # straight to the final joint fit, on all the lines
+        assert fits == [(final_group, n)]
+        assert result[-1] < 0.06
+    else:
+        # the staged fits from the default parameters, on the decimated lines (the
+        # fit data are not rebuilt when the full data set is restored)
+        assert fits == [([1], n // 10), (final_group, n // 10)]